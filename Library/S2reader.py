@@ -1077,13 +1077,30 @@ class SentinelProductReader:
     ) -> list:
         """Export a 3x3 grid of ESRI-aligned 8-bit **RGBA** GeoTIFF patches.
 
+        Thin wrapper around :meth:`export_esri_aligned_rgba_grid` with
+        ``rows=cols=3`` (≈ 10980x10980 → 9× ~3660x3660 @10m), kept for callers
+        that rely on the historical 1..9 file naming.
+        """
+        return self.export_esri_aligned_rgba_grid(out_dir, resolution=resolution, rows=3, cols=3)
+
+    def export_esri_aligned_rgba_grid(
+        self,
+        out_dir: str,
+        resolution: Optional[int] = 10,
+        rows: Optional[int] = None,
+        cols: Optional[int] = None,
+        block_size: int = 0,
+    ) -> list:
+        """Export a rows x cols grid of ESRI-aligned 8-bit **RGBA** GeoTIFF patches.
+
         Each patch is built from Sentinel-2 natural-color bands (R=B04, G=B03, B=B02)
         and an **alpha** channel so that rotated/expanded areas after reprojection
         are transparent (not black).
 
         Workflow per patch
         ------------------
-        1) Split the full native UTM grid into a 3x3 grid (≈ 10980x10980 → 9× ~3660x3660 @10m).
+        1) Split the full native UTM grid into rows x cols windows
+           (see :meth:`grid_edges`).
         2) For each window (patch), read B04/B03/B02.
         3) Reproject UTM  → EPSG:3857 (nearest, dst_nodata = NaN).
         4) Reproject 3857 → EPSG:4326 (nearest, preserve NaN).
@@ -1093,7 +1110,7 @@ class SentinelProductReader:
 
         Filenames
         ---------
-        <TILE_ID>_<idx>.tif  where idx = 1..9 in row-major order (1=top-left).
+        <TILE_ID>_<idx>.tif  where idx = 1..rows*cols in row-major order (1=top-left).
         Example:  T39RXN_1.tif  ...  T39RXN_9.tif
 
         Parameters
@@ -1103,11 +1120,16 @@ class SentinelProductReader:
         resolution : int, optional (default=10)
             Which native resolution variant to read for the bands (10/20/60).
             If None, the finest available per band is used.
+        rows, cols : int, optional
+            Grid size. If omitted, derived from ``block_size`` (at least 1), or 3.
+        block_size : int, optional
+            Patch edge in native pixels; windows are cut at multiples of it
+            and the last row/column takes the remainder.
 
         Returns
         -------
         list of str
-            Absolute paths of the 9 written RGBA GeoTIFF patches.
+            Absolute paths of the written RGBA GeoTIFF patches.
 
         Notes
         -----
@@ -1155,13 +1177,15 @@ class SentinelProductReader:
                     raise ValueError("Source CRS is missing.")
 
                 H, W = ds_r.height, ds_r.width
-                row_edges = np.linspace(0, H, 4, dtype=int)  # 0, r1, r2, H
-                col_edges = np.linspace(0, W, 4, dtype=int)  # 0, c1, c2, W
+                n_rows = rows or (-(-H // block_size) if block_size else 3)
+                n_cols = cols or (-(-W // block_size) if block_size else 3)
+                row_edges = self.grid_edges(H, n_rows, block_size)
+                col_edges = self.grid_edges(W, n_cols, block_size)
 
                 written = []
                 idx = 0
-                for i in range(3):          # rows (top → bottom)
-                    for j in range(3):      # cols (left → right)
+                for i in range(n_rows):          # rows (top → bottom)
+                    for j in range(n_cols):      # cols (left → right)
                         idx += 1
                         r0, r1 = row_edges[i],   row_edges[i+1]
                         c0, c1 = col_edges[j],   col_edges[j+1]
@@ -1272,6 +1296,26 @@ class SentinelProductReader:
         return rdr.export_esri_aligned_rgba_grid_3x3(out_dir=out_dir, resolution=resolution)
 
     # ------------------------------ Helpers -------------------------------- #
+    @staticmethod
+    def grid_edges(size: int, n: int, block_size: int = 0) -> List[int]:
+        """Pixel edges (n+1 values, 0..size) splitting `size` into `n` parts.
+
+        If ``block_size`` fits (``(n-1)*block_size < size <= n*block_size``) the
+        cuts fall on multiples of it and the last part takes the remainder;
+        otherwise the parts are split evenly.
+
+        Examples
+        --------
+        >>> SentinelProductReader.grid_edges(2500, 3, 1024)
+        [0, 1024, 2048, 2500]
+        >>> SentinelProductReader.grid_edges(900, 3)
+        [0, 300, 600, 900]
+        """
+        size, n, block_size = int(size), max(1, int(n)), int(block_size or 0)
+        if block_size > 0 and (n - 1) * block_size < size <= n * block_size:
+            return [k * block_size for k in range(n)] + [size]
+        return [int(v) for v in np.linspace(0, size, n + 1)]
+
     @staticmethod
     def native_resolution_of_path(path_in_zip: str) -> int:
         """Extract the native resolution in meters from a JP2 filename.
@@ -1,15 +1,16 @@
 # app.py
 from __future__ import annotations
 
+import threading
+
+from services.startup import StartupTimer  # اول از همه: زمان بوت از همین‌جا حساب می‌شود
 from flask import Flask, session
-from flask_migrate import Migrate
 from models import db, User
 from config import settings
-from project2 import project2_bp
-
 
 
 def create_app() -> Flask:
+    timer = StartupTimer()
     app = Flask(__name__, static_folder="static", template_folder="templates")
     app.config["SECRET_KEY"] = "change-this-in-prod-please"
 
@@ -27,25 +28,45 @@ def create_app() -> Flask:
     )
 
     # ---- DB ----
-    db.init_app(app)
-    Migrate(app, db)
+    with timer.step("db.init_app"):
+        db.init_app(app)
+    # `flask db …` comes from flask_migrate's own CLI entry point, which takes
+    # precedence over app.cli — it only works if the extension is set up here
+    with timer.step("flask_migrate"):
+        from flask_migrate import Migrate
+        Migrate(app, db)
 
     # ---- Blueprints ----
-    from routes.api import api_bp
-    from routes.masks_api import bp_masks
-    from routes.polygons_api import bp_polygons
-    from routes.auth import auth_bp
-    from routes.pages import pages_bp
-    from routes.admin import admin_bp
+    with timer.step("routes.api"):
+        from routes.api import api_bp
+    with timer.step("routes.masks_api"):
+        from routes.masks_api import bp_masks
+    with timer.step("routes.uploads_api"):
+        from routes.uploads_api import bp_uploads
+    with timer.step("routes.polygons_api"):
+        from routes.polygons_api import bp_polygons
+    with timer.step("routes.auth/pages/admin"):
+        from routes.auth import auth_bp
+        from routes.pages import pages_bp
+        from routes.admin import admin_bp
+    with timer.step("project2"):
+        from project2 import project2_bp
 
     app.register_blueprint(api_bp, url_prefix="/api")
     app.register_blueprint(bp_masks, url_prefix="/api/masks")
+    app.register_blueprint(bp_uploads, url_prefix="/api/uploads")
     app.register_blueprint(bp_polygons, url_prefix="/api/polygons")
     app.register_blueprint(auth_bp)          # /login, /logout
     app.register_blueprint(pages_bp)         # /, /brush, /polygon, /no-access
     app.register_blueprint(admin_bp, url_prefix="/admin")
     app.register_blueprint(project2_bp)
 
+    # ---- Metrics: latency/bytes/in-flight per endpoint + /metrics ----
+    if settings.METRICS_ENABLED:
+        with timer.step("metrics"):
+            from services.metrics import install_metrics
+            install_metrics(app)
+
     # ---- Context Processor (جهت دسترسی به کاربر در تمام قالب‌ها) ----
     @app.context_processor
     def inject_current_user():
@@ -56,7 +77,21 @@ def create_app() -> Flask:
             "is_admin": bool(getattr(u, "is_admin", False)) if u else False,
         }
 
-    # ---- (اختیاری) sanity checks و Bootstrap پلیگان‌ها ----
+    # ---- (اختیاری) sanity checks و Bootstrap پلیگان‌ها — در پس‌زمینه تا بوت معطل MySQL/ogr2ogr نشود ----
+    if settings.STARTUP_BOOTSTRAP_ASYNC:
+        threading.Thread(target=_bootstrap, args=(app,), name="startup-bootstrap", daemon=True).start()
+    else:
+        _bootstrap(app)
+
+    # ---- آماده‌سازی صحنه‌های انتساب‌یافته: flask prewarm sweep|nightly (یک پروسه، نه هر worker) ----
+    from services.prewarm import prewarm_cli
+    app.cli.add_command(prewarm_cli)
+
+    app.extensions["startup_report"] = timer.report() if settings.STARTUP_REPORT else timer.as_dict()
+    return app
+
+
+def _bootstrap(app: Flask) -> None:
     from services.polygons_bootstrap import ensure_geojson_from_shapefile
     with app.app_context():
         try:
@@ -64,14 +99,14 @@ def create_app() -> Flask:
             print("MySQL connection OK ✅")
         except Exception as e:
             print("MySQL connection ERROR ❌", e)
+        finally:
+            db.session.remove()
 
         try:
             ensure_geojson_from_shapefile()
         except Exception as e:
             print("[polygons] bootstrap failed:", e)
 
-    return app
-
 
 if __name__ == "__main__":
     app = create_app()
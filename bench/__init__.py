@@ -0,0 +1,2 @@
+# bench/__init__.py
+# benchmark scripts (run with: python -m bench.<name>)
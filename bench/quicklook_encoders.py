@@ -0,0 +1,89 @@
+# bench/quicklook_encoders.py
+"""
+Encode-time vs file-size benchmark for the quicklook encoders.
+
+    python -m bench.quicklook_encoders output/s2_rgb.tif --out output/bench_quicklook.json
+
+Each encoder is run on the native raster and on the QUICKLOOK_MAX_W-capped
+raster; the baseline is PIL's PNG at its default zlib level (the old path).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.enums import Resampling
+
+from config import settings
+from services.s2 import _stretch_rgb8, encode_image, encode_png_parallel
+
+
+def _read(tif: Path, max_w: int | None) -> np.ndarray:
+    with rasterio.open(tif) as src:
+        W, H = src.width, src.height
+        if max_w and W > max_w:
+            shape = (3, max(1, round(H * max_w / W)), max_w)
+            rgb = src.read([1, 2, 3], out_shape=shape, resampling=Resampling.average)
+        else:
+            rgb = src.read([1, 2, 3])
+    return _stretch_rgb8(rgb)
+
+
+def _time(fn, repeat: int) -> tuple[float, int]:
+    best, size = float("inf"), 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        data = fn()
+        best = min(best, time.perf_counter() - t0)
+        size = len(data)
+    return best, size
+
+
+def _pil_png_default(arr: np.ndarray) -> bytes:
+    bio = BytesIO()
+    Image.fromarray(arr).save(bio, format="PNG")
+    return bio.getvalue()
+
+
+def run(tif: Path, repeat: int = 3) -> dict:
+    results = {"tif": str(tif), "workers": settings.ENCODE_WORKERS, "cases": []}
+    for label, max_w in (("native", None), ("capped", settings.QUICKLOOK_MAX_W)):
+        arr = _read(tif, max_w)
+        H, W = arr.shape[:2]
+        encoders = {
+            "pil_png_default": lambda: _pil_png_default(arr),
+            "png_fast_1thread": lambda: encode_png_parallel(arr, workers=1),
+            "png_fast_parallel": lambda: encode_png_parallel(arr),
+            "webp": lambda: encode_image(arr, "webp"),
+            "jpeg": lambda: encode_image(arr, "jpeg"),
+        }
+        for name, fn in encoders.items():
+            secs, size = _time(fn, repeat)
+            row = {"size": label, "width": W, "height": H, "encoder": name,
+                   "seconds": round(secs, 4), "bytes": size,
+                   "mpix_per_s": round(W * H / 1e6 / max(secs, 1e-9), 1)}
+            results["cases"].append(row)
+            print(f"{label:7s} {W}x{H} {name:18s} {secs:8.3f}s {size / 1e6:9.2f} MB")
+    return results
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("tif", type=Path, nargs="?", default=settings.S2_RGB_TIF)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out", type=Path, default=None)
+    a = ap.parse_args()
+    res = run(a.tif, a.repeat)
+    if a.out:
+        a.out.parent.mkdir(parents=True, exist_ok=True)
+        a.out.write_text(json.dumps(res, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
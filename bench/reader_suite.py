@@ -0,0 +1,145 @@
+# bench/reader_suite.py
+"""
+Benchmark suite for the scene pipeline: index → decode → stack → export →
+quicklook → tile (and the whole prepare step).
+
+    python -m bench.reader_suite --synth 2196 --out output/bench_reader.json
+    python -m bench.reader_suite data/scenes/S2A_MSIL2A_....zip --repeat 3
+
+With ``--synth N`` a synthetic L2A product of N×N 10 m pixels is generated
+first (bench.synth_s2). Every step reports the best of ``--repeat`` runs;
+the JSON also records the environment so results from different machines
+or commits can be compared side by side.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+import rasterio
+
+from config import settings
+from Library.S2reader import SentinelProductReader
+from services.s2 import (
+    SceneItem, prepare_scene_artifacts, save_quicklook_from_tif, scene_cache_dir,
+    slice_tif_to_grid, tiles_root,
+)
+
+
+def _best(fn: Callable[[], object], repeat: int) -> tuple[float, object]:
+    best, out = float("inf"), None
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def run(zip_path: Path, repeat: int = 1) -> dict:
+    zip_path = Path(zip_path).resolve()
+    steps: List[dict] = []
+    scene_id = f"bench-{zip_path.stem[:40]}"
+
+    def step(name: str, fn: Callable[[], object], extra: Callable[[object], dict] = lambda _: {}):
+        secs, out = _best(fn, repeat)
+        info = extra(out)
+        steps.append({"name": name, "seconds": round(secs, 4), **info})
+        print(f"{name:22s} {secs:9.3f}s  {json.dumps(info)}")
+        return out
+
+    rdr = step("index", lambda: SentinelProductReader(str(zip_path)),
+               lambda r: {"bands": len(r._band_index)})
+    step("decode_B04_10m", lambda: rdr.read_band("B04", 10)[0],
+         lambda a: {"shape": list(a.shape)})
+    step("decode_B11_20m", lambda: rdr.read_band("B11", 20)[0], lambda a: {"shape": list(a.shape)})
+    step("stack_4x10m", lambda: rdr.stack_bands(["B02", "B03", "B04", "B08"],
+                                                {b: 10 for b in ("B02", "B03", "B04", "B08")},
+                                                align_to=10)[0],
+         lambda a: {"shape": list(a.shape)})
+    step("stack_6_mixed_to_10m", lambda: rdr.stack_bands(
+        ["B02", "B03", "B04", "B08", "B11", "B12"],
+        {"B02": 10, "B03": 10, "B04": 10, "B08": 10, "B11": 20, "B12": 20}, align_to=10)[0],
+         lambda a: {"shape": list(a.shape)})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tif = Path(tmp) / "rgb.tif"
+        step("export_rgb_tif", lambda: rdr.export_esri_aligned_rgb_tif(str(tif), resolution=10),
+             lambda _: {"bytes": tif.stat().st_size})
+        with rasterio.open(tif) as src:
+            wh = [src.width, src.height]
+        ql = Path(tmp) / "ql.png"
+        step("quicklook", lambda: save_quicklook_from_tif(tif, out_path=ql),
+             lambda _: {"bytes": ql.stat().st_size, "tif_size": wh})
+        step("tile_grid", lambda: slice_tif_to_grid(tif, scene_id=scene_id),
+             lambda m: {"rows": m["rows"], "cols": m["cols"],
+                        "bytes": sum(t["bytes"] for t in m["tiles"])})
+
+    # whole cold prepare (what select/prewarm pay for an uncached scene)
+    st = zip_path.stat()
+    item = SceneItem(id=scene_id, name=zip_path.name, kind="zip", path=str(zip_path),
+                     tile=None, date=None, size_mb=round(st.st_size / 2**20, 1))
+
+    def _cold():
+        import shutil
+        shutil.rmtree(scene_cache_dir(scene_id), ignore_errors=True)
+        shutil.rmtree(tiles_root() / scene_id, ignore_errors=True)
+        return prepare_scene_artifacts(item)
+
+    step("prepare_scene_cold", _cold, lambda _: {})
+    step("prepare_scene_warm", lambda: prepare_scene_artifacts(item), lambda _: {})
+
+    return {
+        "product": zip_path.name,
+        "zip_bytes": st.st_size,
+        "repeat": repeat,
+        "created": time.time(),
+        "env": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "rasterio": rasterio.__version__,
+            "gdal": rasterio.__gdal_version__,
+            "cpus": os.cpu_count(),
+            "encode_workers": settings.ENCODE_WORKERS,
+            "tile_formats": list(settings.TILE_FORMATS),
+            "machine": platform.machine(),
+        },
+        "item": asdict(item),
+        "steps": steps,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("zip", type=Path, nargs="?", default=None)
+    ap.add_argument("--synth", type=int, default=0, help="generate a synthetic product of this 10 m size first")
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--out", type=Path, default=None)
+    a = ap.parse_args()
+
+    if a.synth:
+        from bench.synth_s2 import make_synthetic_l2a
+        t0 = time.perf_counter()
+        zp = make_synthetic_l2a(Path(tempfile.gettempdir()) / "s2_synth", size=a.synth)
+        print(f"synthetic product {zp.name} ({zp.stat().st_size / 1e6:.1f} MB) in {time.perf_counter() - t0:.1f}s")
+    elif a.zip:
+        zp = a.zip
+    else:
+        ap.error("give a product ZIP or --synth N")
+
+    res = run(zp, a.repeat)
+    if a.out:
+        a.out.parent.mkdir(parents=True, exist_ok=True)
+        a.out.write_text(json.dumps(res, indent=2), encoding="utf-8")
+        print("wrote", a.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# bench/startup.py
+"""
+Import-time report for application startup.
+
+    python -m bench.startup --top 25 --out output/bench_startup.json
+
+Runs ``create_app()`` in a fresh interpreter under ``python -X importtime``
+and aggregates the per-module timings: the slowest modules by cumulative
+time and the self time summed per top-level package. The wall time of the
+child process is the number to keep under a second.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+_SNIPPET = "from app import create_app; create_app()"
+
+
+def run(top: int = 25) -> dict:
+    root = Path(__file__).resolve().parent.parent
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", _SNIPPET],
+                          cwd=root, capture_output=True, text=True)
+    wall = time.perf_counter() - t0
+
+    mods, per_pkg = [], defaultdict(int)
+    for line in proc.stderr.splitlines():
+        m = _LINE.match(line)
+        if not m:
+            continue
+        self_us, cum_us, indent, name = int(m.group(1)), int(m.group(2)), m.group(3), m.group(4)
+        depth = (len(indent) - 1) // 2
+        mods.append({"module": name, "self_ms": self_us / 1000, "cumulative_ms": cum_us / 1000, "depth": depth})
+        per_pkg[name.split(".")[0]] += self_us
+
+    slowest = sorted(mods, key=lambda m: -m["cumulative_ms"])[:top]
+    packages = sorted(({"package": k, "self_ms": v / 1000} for k, v in per_pkg.items()),
+                      key=lambda p: -p["self_ms"])[:top]
+    return {
+        "wall_ms": round(wall * 1000, 1),
+        "returncode": proc.returncode,
+        "modules_imported": len(mods),
+        "slowest_modules": slowest,
+        "packages": packages,
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--top", type=int, default=25)
+    ap.add_argument("--out", type=Path, default=None)
+    a = ap.parse_args()
+    res = run(a.top)
+    print(f"create_app in a fresh interpreter: {res['wall_ms']:.0f} ms, "
+          f"{res['modules_imported']} modules (exit {res['returncode']})")
+    print("\nslowest modules (cumulative):")
+    for m in res["slowest_modules"]:
+        print(f"  {m['cumulative_ms']:8.1f} ms  {'  ' * min(m['depth'], 6)}{m['module']}")
+    print("\nself time per top-level package:")
+    for p in res["packages"]:
+        print(f"  {p['self_ms']:8.1f} ms  {p['package']}")
+    if a.out:
+        a.out.parent.mkdir(parents=True, exist_ok=True)
+        a.out.write_text(json.dumps(res, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
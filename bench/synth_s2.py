@@ -0,0 +1,216 @@
+# bench/synth_s2.py
+"""
+Synthetic Sentinel-2 L2A product generator.
+
+    python -m bench.synth_s2 --size 2196 --out data/scenes
+    python -m bench.synth_s2 --size 10980 --tile T39RXN --date 2024-03-15   # full-size tile
+
+Writes a ZIP laid out like a real L2A product, with the same names
+SentinelProductReader and the upload validator look for:
+
+    <PRODUCT>.SAFE/MTD_MSIL2A.xml
+    <PRODUCT>.SAFE/GRANULE/L2A_<TILE>_A<ORBIT>_<DATETIME>/MTD_TL.xml
+    <PRODUCT>.SAFE/GRANULE/.../IMG_DATA/R10m/<TILE>_<DATETIME>_B02_10m.jp2
+    ...                       IMG_DATA/R20m/..._B05_20m.jp2, ..._SCL_20m.jp2
+    ...                       IMG_DATA/R60m/..._B01_60m.jp2, ..._SCL_60m.jp2
+
+Bands are lossless JPEG2000 (uint16 DN with the 1000 BOA offset), SCL is
+uint8, all in the tile's UTM zone (EPSG:326xx). The picture is a smooth,
+deterministic field/water/cloud landscape, so compression ratios and decode
+times are closer to a real scene than random noise. ``--size`` is the 10 m
+width in pixels and must be a multiple of 6 (so 20 m and 60 m grids line up).
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+# band → native resolutions in a real L2A product
+L2A_BANDS = {
+    10: ["B02", "B03", "B04", "B08"],
+    20: ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B11", "B12"],
+    60: ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B09", "B11", "B12"],
+}
+# rough surface reflectance per land-cover (vegetation, bare soil, water, cloud)
+_REFL = {
+    "B01": (0.03, 0.10, 0.05, 0.55), "B02": (0.04, 0.12, 0.06, 0.55),
+    "B03": (0.07, 0.15, 0.07, 0.55), "B04": (0.04, 0.20, 0.04, 0.55),
+    "B05": (0.12, 0.22, 0.03, 0.55), "B06": (0.30, 0.24, 0.02, 0.55),
+    "B07": (0.36, 0.25, 0.02, 0.55), "B08": (0.40, 0.26, 0.02, 0.55),
+    "B8A": (0.42, 0.27, 0.02, 0.55), "B09": (0.12, 0.08, 0.01, 0.40),
+    "B11": (0.20, 0.34, 0.01, 0.45), "B12": (0.10, 0.30, 0.01, 0.40),
+}
+_SCL_CODE = (4, 5, 6, 9)   # vegetation, not-vegetated, water, cloud high probability
+BOA_ADD_OFFSET = -1000
+QUANTIFICATION = 10000
+
+
+def _utm_epsg(tile: str) -> int:
+    zone = int(tile[1:3])
+    north = tile[3].upper() >= "N"
+    return (32600 if north else 32700) + zone
+
+
+def _smooth_noise(h: int, w: int, cell: int, rng: np.random.Generator) -> np.ndarray:
+    """Bilinear-upsampled value noise in [0, 1] (cheap, no scipy)."""
+    gh, gw = h // cell + 2, w // cell + 2
+    g = rng.random((gh, gw), dtype=np.float32)
+    ys = np.arange(h, dtype=np.float32) / cell
+    xs = np.arange(w, dtype=np.float32) / cell
+    y0, x0 = ys.astype(np.int32), xs.astype(np.int32)
+    fy, fx = (ys - y0)[:, None], (xs - x0)[None, :]
+    a = g[y0][:, x0]; b = g[y0][:, x0 + 1]
+    c = g[y0 + 1][:, x0]; d = g[y0 + 1][:, x0 + 1]
+    return (a * (1 - fx) + b * fx) * (1 - fy) + (c * (1 - fx) + d * fx) * fy
+
+
+def landcover(size: int, seed: int = 0) -> np.ndarray:
+    """uint8 class map (0 veg, 1 bare, 2 water, 3 cloud) at 10 m."""
+    rng = np.random.default_rng(seed)
+    fields = _smooth_noise(size, size, max(8, size // 60), rng)
+    relief = _smooth_noise(size, size, max(16, size // 8), rng)
+    clouds = _smooth_noise(size, size, max(16, size // 12), rng)
+    lc = np.where(fields > 0.5, 0, 1).astype(np.uint8)
+    lc[relief < 0.18] = 2
+    lc[clouds > 0.86] = 3
+    return lc
+
+
+def _band_dn(lc: np.ndarray, band: str, rng: np.random.Generator) -> np.ndarray:
+    lut = np.array(_REFL[band], dtype=np.float32)
+    refl = lut[lc] * (1.0 + 0.08 * rng.standard_normal(lc.shape, dtype=np.float32))
+    dn = np.clip(refl * QUANTIFICATION - BOA_ADD_OFFSET, 1, 65534)
+    return dn.astype(np.uint16)
+
+
+def _down(a: np.ndarray, f: int) -> np.ndarray:
+    if f == 1:
+        return a
+    h, w = a.shape[0] // f, a.shape[1] // f
+    return a[: h * f, : w * f].reshape(h, f, w, f)[:, 0, :, 0]
+
+
+def _write_jp2(path: Path, arr: np.ndarray, epsg: int, ulx: float, uly: float, res: int) -> None:
+    h, w = arr.shape
+    profile = dict(driver="JP2OpenJPEG", width=w, height=h, count=1, dtype=arr.dtype,
+                   crs=f"EPSG:{epsg}", transform=from_origin(ulx, uly, res, res),
+                   QUALITY="100", REVERSIBLE="YES", RESOLUTIONS="5",
+                   BLOCKXSIZE=str(min(1024, w)), BLOCKYSIZE=str(min(1024, h)))
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(arr, 1)
+
+
+def _mtd_product(product: str, start: str, tile: str) -> str:
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-2A_User_Product xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-2A.xsd">
+  <n1:General_Info>
+    <Product_Info>
+      <PRODUCT_START_TIME>{start}</PRODUCT_START_TIME>
+      <PRODUCT_URI>{product}.SAFE</PRODUCT_URI>
+      <PROCESSING_LEVEL>Level-2A</PROCESSING_LEVEL>
+      <PRODUCT_TYPE>S2MSI2A</PRODUCT_TYPE>
+      <PROCESSING_BASELINE>05.10</PROCESSING_BASELINE>
+      <Datatake SPACECRAFT_NAME="Sentinel-2A"/>
+      <Query_Options><PRODUCT_FORMAT>SAFE_COMPACT</PRODUCT_FORMAT></Query_Options>
+    </Product_Info>
+    <Product_Image_Characteristics>
+      <QUANTIFICATION_VALUES_LIST>
+        <BOA_QUANTIFICATION_VALUE unit="none">{QUANTIFICATION}</BOA_QUANTIFICATION_VALUE>
+      </QUANTIFICATION_VALUES_LIST>
+      <BOA_ADD_OFFSET_VALUES_LIST>
+{"".join(f'        <BOA_ADD_OFFSET band_id="{i}">{BOA_ADD_OFFSET}</BOA_ADD_OFFSET>{chr(10)}' for i in range(13))}      </BOA_ADD_OFFSET_VALUES_LIST>
+    </Product_Image_Characteristics>
+  </n1:General_Info>
+  <!-- synthetic product for benchmarks, tile {tile} -->
+</n1:Level-2A_User_Product>
+"""
+
+
+def _mtd_tile(tile: str, epsg: int, size: int, ulx: float, uly: float, start: str) -> str:
+    sizes = "".join(
+        f'        <Size resolution="{r}"><NROWS>{size * 10 // r}</NROWS><NCOLS>{size * 10 // r}</NCOLS></Size>\n'
+        for r in (10, 20, 60))
+    geopos = "".join(
+        f'        <Geoposition resolution="{r}"><ULX>{ulx:.0f}</ULX><ULY>{uly:.0f}</ULY>'
+        f'<XDIM>{r}</XDIM><YDIM>-{r}</YDIM></Geoposition>\n' for r in (10, 20, 60))
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-2A_Tile_ID xmlns:n1="https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-2A_Tile_Metadata.xsd">
+  <n1:General_Info>
+    <TILE_ID>L2A_{tile}_{start}</TILE_ID>
+    <SENSING_TIME>{start}</SENSING_TIME>
+  </n1:General_Info>
+  <n1:Geometric_Info>
+    <Tile_Geocoding>
+      <HORIZONTAL_CS_NAME>WGS84 / UTM zone {tile[1:3]}{"N" if epsg < 32700 else "S"}</HORIZONTAL_CS_NAME>
+      <HORIZONTAL_CS_CODE>EPSG:{epsg}</HORIZONTAL_CS_CODE>
+{sizes}{geopos}    </Tile_Geocoding>
+  </n1:Geometric_Info>
+</n1:Level-2A_Tile_ID>
+"""
+
+
+def make_synthetic_l2a(out_dir: Path, size: int = 2196, tile: str = "T39RXN",
+                       date: str = "2024-03-15", seed: int = 0) -> Path:
+    """Write a synthetic L2A ZIP into `out_dir` and return its path."""
+    if size % 6:
+        raise ValueError("size must be a multiple of 6 (10/20/60 m grids)")
+    tile = tile.upper() if tile.upper().startswith("T") else "T" + tile.upper()
+    d = datetime.strptime(date, "%Y-%m-%d")
+    dt = d.strftime("%Y%m%dT070000")
+    product = f"S2A_MSIL2A_{dt}_N0510_R063_{tile}_{d.strftime('%Y%m%dT090000')}"
+    granule = f"L2A_{tile}_A045000_{dt}"
+    epsg = _utm_epsg(tile)
+    ulx, uly = 600000.0, 3400020.0
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_zip = out_dir / f"{product}.zip"
+    rng = np.random.default_rng(seed)
+    lc = landcover(size, seed)
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            zipfile.ZipFile(out_zip.with_suffix(".zip.tmp"), "w", zipfile.ZIP_STORED) as z:
+        root = f"{product}.SAFE"
+        start = d.strftime("%Y-%m-%dT07:00:00.000Z")
+        z.writestr(f"{root}/MTD_MSIL2A.xml", _mtd_product(product, start, tile))
+        z.writestr(f"{root}/GRANULE/{granule}/MTD_TL.xml", _mtd_tile(tile, epsg, size, ulx, uly, start))
+        for res, bands in L2A_BANDS.items():
+            f = res // 10
+            lc_r = _down(lc, f)
+            items = [(b, _band_dn(lc_r, b, rng)) for b in bands]
+            if res in (20, 60):
+                items.append(("SCL", np.array(_SCL_CODE, dtype=np.uint8)[lc_r]))
+            for name, arr in items:
+                fn = f"{tile}_{dt}_{name}_{res}m.jp2"
+                p = Path(tmp) / fn
+                _write_jp2(p, arr, epsg, ulx, uly, res)
+                z.write(p, f"{root}/GRANULE/{granule}/IMG_DATA/R{res}m/{fn}")
+                p.unlink()
+    os.replace(out_zip.with_suffix(".zip.tmp"), out_zip)
+    return out_zip
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--size", type=int, default=2196, help="10 m width/height in pixels (multiple of 6)")
+    ap.add_argument("--tile", default="T39RXN")
+    ap.add_argument("--date", default="2024-03-15")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", type=Path, default=Path("data/scenes"))
+    a = ap.parse_args()
+    t0 = time.perf_counter()
+    p = make_synthetic_l2a(a.out, a.size, a.tile, a.date, a.seed)
+    print(f"{p}  {p.stat().st_size / 1e6:.1f} MB  in {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# bench/tile_encodings.py
+"""
+Bytes per tile and encode time per format for the editing grid.
+
+    python -m bench.tile_encodings --scene <scene_id>            # report an already sliced scene
+    python -m bench.tile_encodings output/s2_rgb.tif --out output/bench_tiles.json
+
+With a GeoTIFF the grid is sliced into temp_tiles/bench-<stem> using every
+supported tile format; either way the numbers come from the grid manifest
+(sizes and encode times recorded by services.s2._render_grid_tile).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+from config import settings
+from services.s2 import TILE_EXT, load_grid_manifest, slice_tif_to_grid
+
+
+def summarize(man: dict) -> dict:
+    fmts = man.get("formats") or ["png"]
+    tiles = man.get("tiles", [])
+    out = {"scene_id": man.get("scene_id"), "W": man.get("W"), "H": man.get("H"),
+           "rows": man.get("rows"), "cols": man.get("cols"), "tiles": len(tiles), "formats": {}}
+    png_total = sum(t["variants"]["png"]["bytes"] for t in tiles if "variants" in t) or None
+    for fmt in fmts:
+        vs = [t["variants"][fmt] for t in tiles if fmt in t.get("variants", {})]
+        if not vs:
+            continue
+        total = sum(v["bytes"] for v in vs)
+        ms = sum(v["encode_ms"] for v in vs)
+        out["formats"][fmt] = {
+            "total_bytes": total, "mean_bytes": round(total / len(vs)),
+            "max_bytes": max(v["bytes"] for v in vs),
+            "encode_ms_total": round(ms, 1), "encode_ms_mean": round(ms / len(vs), 1),
+            "vs_png": round(total / png_total, 3) if png_total else None,
+        }
+    return out
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("tif", type=Path, nargs="?", default=None)
+    ap.add_argument("--scene", default=None)
+    ap.add_argument("--out", type=Path, default=None)
+    a = ap.parse_args()
+
+    if a.scene:
+        man = load_grid_manifest(a.scene)
+        if not man:
+            raise SystemExit(f"no grid manifest for scene {a.scene}")
+    else:
+        tif = a.tif or settings.S2_RGB_TIF
+        settings.TILE_FORMATS = list(TILE_EXT)
+        t0 = time.perf_counter()
+        man = slice_tif_to_grid(tif, scene_id=f"bench-{Path(tif).stem}")
+        print(f"sliced {man['rows']}x{man['cols']} in {time.perf_counter() - t0:.2f}s")
+
+    res = summarize(man)
+    for fmt, f in res["formats"].items():
+        print(f"{fmt:5s} total {f['total_bytes'] / 1e6:8.2f} MB  mean {f['mean_bytes'] / 1e3:8.1f} kB"
+              f"  encode {f['encode_ms_mean']:7.1f} ms/tile  vs png {f['vs_png']}")
+    if a.out:
+        a.out.parent.mkdir(parents=True, exist_ok=True)
+        a.out.write_text(json.dumps(res, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
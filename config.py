@@ -31,6 +31,12 @@ class Settings:
 
     # ماسک کلی صحنه (در صورت نیاز)
     MASK_PNG: Path = field(init=False)
+    MASK_STORE_DIR: Path = field(init=False)   # chunked label store (source of truth for the scene mask)
+    MASK_CHUNK: int = 512                      # chunk edge in pixels
+    MASK_PYRAMID_LEVELS: int = 2               # mode-downsampled levels per store (1/4, 1/16 of the pixels)
+    MASK_RAW_MAX_PIXELS: int = 4096 * 4096     # largest window /api/mask_raw returns (after level reduction)
+    MASK_HISTORY_KEEP_LAST: int = 20           # tile PNG versions always kept
+    MASK_HISTORY_HOURLY_HOURS: int = 72        # + newest version of each hour within this window
 
     # مسیرهای شِیپ‌فایل و خروجی GeoJSON
     POLYGONS_SHP_DIR: Path = field(default_factory=lambda: Path(__file__).resolve().parent / "data" / "polygons" / "shp")
@@ -77,9 +83,52 @@ class Settings:
     SELECTED_SCENE_FILE: Path = field(init=False)
 
     # Tile/Grid/UI
-    TILE_GRID_N: int = 3
+    TILE_GRID_N: int = 3                # minimum tiles per side of the editing grid
     QUICKLOOK_MAX_W: int = 2048
-    TILE_BLOCK_SIZE: int = 1024
+    TILE_BLOCK_SIZE: int = 1024         # max tile edge in px (0 → exactly TILE_GRID_N × TILE_GRID_N)
+    TILE_FORMATS: List[str] = field(default_factory=lambda: ["png", "webp"])  # side-by-side tile encodings (png always)
+    TILE_WEBP_METHOD: int = 0           # lossless WebP effort 0..6 (0 = fastest)
+    TILE_SENDFILE_MODE: str = ""        # "" (stream from Flask) | "x-sendfile" | "x-accel" (nginx)
+    TILE_ACCEL_PREFIX: str = "/_tiles/" # nginx internal location aliased to output/temp_tiles
+
+    # Quicklook encoder: "png" | "webp" | "jpeg"
+    QUICKLOOK_FORMAT: str = "png"
+    QUICKLOOK_PNG_LEVEL: int = 1        # zlib level for fast-PNG (1=fastest)
+    QUICKLOOK_QUALITY: int = 85         # WebP/JPEG quality
+    QUICKLOOK_STRIP_ROWS: int = 256     # rows per parallel encode strip
+    ENCODE_WORKERS: int = 0             # 0 → os.cpu_count()
+
+    # Progress (in-memory per job; optional JSON snapshot to output/progress.json)
+    PROGRESS_PERSIST: bool = False
+    PROGRESS_PERSIST_INTERVAL: float = 2.0
+    PROGRESS_TTL: float = 3600.0           # finished/idle jobs older than this are forgotten (s)
+
+    # Chunked scene uploads (/api/uploads)
+    UPLOAD_CHUNK_SIZE: int = 8 * 1024 * 1024
+    UPLOAD_MAX_BYTES: int = 4 * 1024 * 1024 * 1024
+    UPLOAD_EXPIRE_HOURS: float = 48.0      # unfinished uploads untouched this long are deleted (0 = never)
+
+    # Startup: MySQL probe + polygon GeoJSON bootstrap in a background thread; print timings
+    STARTUP_BOOTSTRAP_ASYNC: bool = True
+    STARTUP_REPORT: bool = True
+
+    # Scene pre-warming (background build of per-scene artifacts on assignment)
+    PREWARM_ENABLED: bool = True
+    PREWARM_NICE: int = 10                      # niceness of the prewarm worker thread
+    PREWARM_NIGHTLY_HOUR: Optional[int] = None  # e.g. 2 → `flask prewarm nightly` sweeps assigned scenes at 02:00
+
+    # Request/job metrics at /metrics (Prometheus text format)
+    METRICS_ENABLED: bool = True
+    METRICS_TOKEN: Optional[str] = None         # if set, /metrics requires "Authorization: Bearer <token>"
+    METRICS_PROFILE_SAMPLE: float = 0.0         # fraction of requests run under cProfile (0 = off)
+    METRICS_PROFILE_SLOW_MS: float = 1000.0     # profiled requests slower than this → output/profiles/*.prof
+
+    # Exports of labelled masks (output/exports/<scene>/…)
+    EXPORTS_DIR: Path = field(init=False)
+    VECTORIZE_SIMPLIFY_PX: float = 1.0          # polygon simplification tolerance in pixels (0 = exact pixel edges)
+    TRAIN_SHARD_PATCHES: int = 128              # patches per .npz shard of the training export
+    TRAIN_MIN_LABELLED: float = 0.01            # min share of labelled pixels for a patch to be exported
+    TRAIN_EXPORT_WORKERS: int = 0               # processes of the training export (0 = ENCODE_WORKERS / CPU count)
 
     def __post_init__(self):
         # پوشه‌ها
@@ -94,6 +143,8 @@ class Settings:
         self.BACKDROP_IMAGE      = self.OUTPUT_DIR / "rgb_quicklook.png"
         self.S2_RGB_TIF          = self.OUTPUT_DIR / "s2_rgb.tif"
         self.MASK_PNG            = self.OUTPUT_DIR / "mask.png"
+        self.MASK_STORE_DIR      = self.OUTPUT_DIR / "mask_store"
+        self.EXPORTS_DIR         = self.OUTPUT_DIR / "exports"
         self.ACTIVE_MODEL_PATH   = self.MODELS_DIR / "active.onnx"
         self.ALIGN_OFFSET_FILE   = self.OUTPUT_DIR / "align_offset.json"
         self.SELECTED_SCENE_FILE = self.OUTPUT_DIR / "selected_scene.json"
@@ -1,26 +1,18 @@
 from __future__ import annotations
 
-import os
 import json
 from pathlib import Path
 from functools import lru_cache
-from typing import Tuple
+from typing import TYPE_CHECKING, Tuple
 
 from flask import Blueprint, render_template, jsonify, request, url_for
-import geopandas as gpd
 import numpy as np
-from shapely.geometry import mapping, shape
-from pyproj import Transformer
 from PIL import Image
 
-import rasterio
-from rasterio.windows import from_bounds
-from rasterio.warp import transform_geom
-from rasterio.features import rasterize
-from scipy.ndimage import binary_erosion
-
-# ---- Local module
-from .S2reader import SentinelProductReader
+# geopandas / shapely / pyproj / rasterio / scipy و S2reader سنگین‌اند (~۰٫۹ ثانیه)؛
+# داخل همان توابعی import می‌شوند که لازمشان دارند تا بوت سرور سریع بماند.
+if TYPE_CHECKING:
+    import geopandas as gpd
 
 # ================== PATHS ==================
 PKG_DIR    = Path(__file__).resolve().parent            # .../project2
@@ -44,6 +36,7 @@ project2_bp = Blueprint(
 
 # ================== DATA LOADING ==================
 def _empty_gdf() -> gpd.GeoDataFrame:
+    import geopandas as gpd
     return gpd.GeoDataFrame(
         {"index": [], "status": [], "status_reviewed": [], "code": []},
         geometry=gpd.GeoSeries([], crs="EPSG:4326"),
@@ -56,6 +49,7 @@ def load_gdf() -> gpd.GeoDataFrame:
         print(f"[project2] ⚠️ Shapefile not found: {shp}")
         return _empty_gdf()
 
+    import geopandas as gpd
     gdf = gpd.read_file(shp)
 
     # ensure geometry column / cleanup
@@ -91,6 +85,7 @@ def load_gdf() -> gpd.GeoDataFrame:
     return gdf
 
 def serialize_polygons(gdf: gpd.GeoDataFrame) -> dict:
+    from shapely.geometry import mapping
     feats = []
     for i, row in gdf.iterrows():
         geom = row.geometry
@@ -178,6 +173,8 @@ def generate_all_tifs():
     if gdf.empty:
         return jsonify({"success": False, "message": "Shapefile missing or empty"})
 
+    from .S2reader import SentinelProductReader
+
     created = 0
     for z in zips:
         print(f"📦 Processing Sentinel ZIP: {z.name}")
@@ -231,6 +228,7 @@ def get_polygon_rgb_by_index(idx: int):
     bbox_wgs84 = None
     if bbox and epsg:
         try:
+            from pyproj import Transformer
             tr = Transformer.from_crs(f"EPSG:{epsg}", "EPSG:4326", always_xy=True)
             sw_lon, sw_lat = tr.transform(bbox["minx"], bbox["miny"])
             ne_lon, ne_lat = tr.transform(bbox["maxx"], bbox["maxy"])
@@ -262,6 +260,7 @@ def get_polygon_rgb_by_code(code: str):
         epsg = meta.get("epsg")
         if bbox and epsg:
             try:
+                from pyproj import Transformer
                 tr = Transformer.from_crs(f"EPSG:{epsg}", "EPSG:4326", always_xy=True)
                 sw_lon, sw_lat = tr.transform(bbox["minx"], bbox["miny"])
                 ne_lon, ne_lat = tr.transform(bbox["maxx"], bbox["maxy"])
@@ -348,6 +347,14 @@ def _generate_all_pngs_fast(create_masks: bool = False):
     if gdf.empty:
         return False, "Shapefile missing or empty"
 
+    import rasterio
+    from rasterio.features import rasterize
+    from rasterio.warp import transform_geom
+    from rasterio.windows import from_bounds
+    from scipy.ndimage import binary_erosion
+    from shapely.geometry import mapping, shape
+    from .S2reader import SentinelProductReader
+
     for z in zips:
         print(f"\n📦 Reading Sentinel ZIP: {z.name}")
         try:
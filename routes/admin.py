@@ -10,6 +10,7 @@ from werkzeug.security import generate_password_hash
 
 from models import db, User, AssignedTile
 from routes.guards import admin_required  # گارد مرکزی ادمین
+from services.prewarm import enqueue_prewarm, sweep_assigned
 
 # اگر templates در روت پروژه است، نیازی به template_folder نیست
 admin_bp = Blueprint("admin_bp", __name__)
@@ -74,7 +75,16 @@ def tiles_assign():
     )
     db.session.add(at)
     db.session.commit()
-    flash("Tile assigned", "ok")
+    # آماده‌سازی صحنه در پس‌زمینه تا اولین باز شدن برای کاربر سریع باشد
+    queued = enqueue_prewarm(scene_id)
+    flash("Tile assigned" + (" (preparing in background)" if queued else ""), "ok")
+    return redirect(url_for("admin_bp.home"))
+
+@admin_bp.post("/prewarm/sweep")
+@admin_required
+def prewarm_sweep():
+    n = sweep_assigned(current_app._get_current_object())
+    flash(f"{n} scene(s) queued for background preparation", "ok")
     return redirect(url_for("admin_bp.home"))
 
 # --- اختیاری: لاگ دیباگ برای اطمینان از وضعیت دسترسی ---
@@ -2,16 +2,28 @@
 from __future__ import annotations
 import json
 from pathlib import Path
-from flask import Blueprint, jsonify, make_response, request, send_from_directory, current_app
+from flask import Blueprint, Response, jsonify, make_response, request, send_from_directory, current_app, stream_with_context
 import numpy as np
+from werkzeug.utils import send_file as werkzeug_send_file
 from models import db, User, AssignedTile
 from flask import session
 from services.polygons import load_polygons_dict
 from services.s2 import current_selected_scene, tiles_root
 from config import settings
-from services.masks import load_mask, mask_bytes, save_mask_bytes
+from services.mask_artifacts import (
+    mask_artifacts_pending, overlay_png_bytes, palette_tag, wait_mask_artifacts,
+)
+from services.mask_store import scene_mask_store
+from services.masks import (
+    save_mask_bytes, mask_window, mask_window_at, mask_class_counts, pick_encoding, encode_body,
+)
+from services.tile_masks import (
+    PatchConflict, ShapeConflict, apply_tile_patch, class_counts, read_tile_classes, save_tile_classes,
+    scene_label_users, tile_version, user_label_store,
+)
+from routes import guards
 from services.polygons import load_polygons_text  # فقط این
-from services.progress import get_progress
+from services.progress import get_progress, progress_job, set_progress, stream_progress
 from services.s2 import (
     backdrop_meta,
     ensure_backdrop,
@@ -19,6 +31,10 @@ from services.s2 import (
     list_s2_scenes,
     select_scene_by_id,
     current_selected_scene,
+    load_grid_manifest,
+    grid_geometry,
+    QUICKLOOK_MIME,
+    TILE_EXT,
     tiles_root,
 )
 api_bp = Blueprint("api", __name__, url_prefix="/api")
@@ -77,20 +93,29 @@ import time
 
 # --- بقیه APIها بدون تغییر ---
 from io import BytesIO
-from PIL import Image
 
 @api_bp.get("/grid/meta")
 def api_grid_meta():
-    rows = int(request.args.get("rows", 3))
-    cols = int(request.args.get("cols", 3))
-    ensure_backdrop()
-    im = Image.open(settings.BACKDROP_IMAGE)
-    W, H = im.size
+    sel = current_selected_scene()
+    scene_id = request.args.get("scene_id") or (sel.id if sel else "")
+    man = load_grid_manifest(scene_id) if scene_id else None
+    tw = th = 0
+    if man:
+        W, H, rows, cols = man["W"], man["H"], man["rows"], man["cols"]
+        block = man.get("block") or 0
+        t0 = next((t for t in man.get("tiles", []) if t["r"] == 0 and t["c"] == 0), None)
+        if t0:   # the real (first) tile size; even splits are not block-sized
+            tw, th = t0["w"], t0["h"]
+    else:
+        W, H = backdrop_meta()
+        rows, cols, block = grid_geometry(W, H)
+        rows = int(request.args.get("rows", rows))
+        cols = int(request.args.get("cols", cols))
     b = s2_bounds_wgs84() or {}
     return jsonify({
-        "rows": rows, "cols": cols,
+        "rows": rows, "cols": cols, "block": block,
         "image_width": W, "image_height": H,
-        "tile_pixel_w": W // cols, "tile_pixel_h": H // rows,
+        "tile_pixel_w": tw or block or W // cols, "tile_pixel_h": th or block or H // rows,
         "bounds_wgs84": b
     })
 from flask import abort, session
@@ -105,22 +130,146 @@ def api_grid_tile():
 
     r = int(request.args.get("r", 0))
     c = int(request.args.get("c", 0))
-    fn = tiles_root() / scene_id / f"tile_{r}_{c}.png"
+    man = load_grid_manifest(scene_id)
+    if man and not (0 <= r < man["rows"] and 0 <= c < man["cols"]):
+        return jsonify({"error": "r/c outside grid"}), 404
+    fmt = _negotiate_tile_format(man)
+    fn = tiles_root() / scene_id / f"tile_{r}_{c}{TILE_EXT[fmt]}"
+    if not fn.exists() and fmt != "png":
+        fmt = "png"
+        fn = tiles_root() / scene_id / f"tile_{r}_{c}.png"
     if not fn.exists():
         return jsonify({"error": "tile not found"}), 404
-    resp = make_response(fn.read_bytes())
-    resp.headers["Content-Type"] = "image/png"
-    resp.headers["Cache-Control"] = "public, max-age=3600, immutable"
+    resp = _send_tile(fn, QUICKLOOK_MIME[fmt])
+    resp.headers["Vary"] = "Accept, Cookie"
+    return resp
+
+def _negotiate_tile_format(man: dict | None) -> str:
+    """WebP when the client names it in Accept (browsers do for <img>) and the
+    scene has a WebP variant; PNG otherwise. ``?fmt=`` overrides for testing."""
+    have = (man or {}).get("formats") or ["png"]
+    want = (request.args.get("fmt") or "").lower()
+    if want in have:
+        return want
+    if "webp" in have and any(v == "image/webp" and q > 0 for v, q in request.accept_mimetypes):
+        return "webp"
+    return "png"
+
+def _send_tile(fn: Path, mimetype: str):
+    """Stream a tile file with ETag/Last-Modified, 304 and Range support.
+
+    TILE_SENDFILE_MODE="x-accel" hands the file to nginx (internal location
+    TILE_ACCEL_PREFIX mapped to tiles_root()); "x-sendfile" uses werkzeug's
+    X-Sendfile support (Apache/lighttpd). Tiles are re-sliced in place, so
+    clients must revalidate (no-cache) instead of trusting a long max-age.
+    """
+    mode = (settings.TILE_SENDFILE_MODE or "").lower()
+    if mode == "x-accel":
+        rel = fn.resolve().relative_to(tiles_root().resolve()).as_posix()
+        resp = make_response("")
+        resp.headers["X-Accel-Redirect"] = settings.TILE_ACCEL_PREFIX.rstrip("/") + "/" + rel
+        resp.headers["Content-Type"] = mimetype
+    else:
+        resp = werkzeug_send_file(fn, request.environ, mimetype=mimetype, conditional=True,
+                                  etag=True, max_age=0, use_x_sendfile=(mode == "x-sendfile"),
+                                  response_class=current_app.response_class)
+    resp.headers["Cache-Control"] = "private, no-cache"
     return resp
 
 @api_bp.get("/mask_raw")
 def api_mask_raw():
+    """Raw uint8 class indices for a window: ?x=&y=&w=&h=&level= (level-0 pixels).
+
+    w and h are required and the returned window is capped at
+    MASK_RAW_MAX_PIXELS. The body is compressed with zstd or deflate per
+    Accept-Encoding; the actual origin (snapped to the level grid) and size
+    are in X-Mask-* headers.
+    """
     ensure_backdrop()
-    w, h = backdrop_meta()
-    b = mask_bytes(w, h)
-    resp = make_response(b)
+    W, H = backdrop_meta()
+    a = request.args
+    try:
+        x, y = int(a.get("x", 0)), int(a.get("y", 0))
+        w, h = int(a["w"]), int(a["h"])
+        level = int(a.get("level", 0))
+    except KeyError:
+        return jsonify({"error": "window required: x, y, w, h"}), 400
+    except ValueError:
+        return jsonify({"error": "x/y/w/h/level must be integers"}), 400
+    if w <= 0 or h <= 0 or level < 0:
+        return jsonify({"error": "bad window"}), 400
+    s = 1 << min(level, 8)
+    if -(-min(w, W) // s) * -(-min(h, H) // s) > int(settings.MASK_RAW_MAX_PIXELS):
+        return jsonify({"error": "window too large; use a smaller window or a higher level"}), 413
+
+    arr, (ox, oy) = mask_window_at(W, H, x, y, w, h, level)
+    enc = pick_encoding(request.headers.get("Accept-Encoding", ""))
+    resp = make_response(encode_body(arr.tobytes(), enc))
     resp.headers["Content-Type"] = "application/octet-stream"
+    if enc:
+        resp.headers["Content-Encoding"] = enc
+    resp.headers["Vary"] = "Accept-Encoding"
     resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Mask-X"] = str(ox)
+    resp.headers["X-Mask-Y"] = str(oy)
+    resp.headers["X-Mask-Width"] = str(arr.shape[1])
+    resp.headers["X-Mask-Height"] = str(arr.shape[0])
+    resp.headers["X-Mask-Level"] = str(level)
+    resp.headers["Access-Control-Expose-Headers"] = "X-Mask-X, X-Mask-Y, X-Mask-Width, X-Mask-Height, X-Mask-Level"
+    return resp
+
+@api_bp.get("/mask_overlay_tile")
+def api_mask_overlay_tile():
+    """Colored overlay of a mask window as an 8-bit palette PNG (colours/alpha from CLASS_LIST).
+
+    Scene mask: ?x=&y=&w=&h=&level= as in /api/mask_raw. A user's tile
+    labels: ?scene_id=&r=&c=[&user_id=] (other users: admins only).
+    Rendered on demand; the ETag follows the store version and the palette.
+    """
+    a = request.args
+    scene_id = (a.get("scene_id") or "").strip()
+    try:
+        if scene_id:
+            r, c = int(a["r"]), int(a["c"])
+        else:
+            x, y = int(a.get("x", 0)), int(a.get("y", 0))
+            w = int(a["w"]) if "w" in a else None
+            h = int(a["h"]) if "h" in a else None
+            level = int(a.get("level", 0))
+    except (KeyError, ValueError):
+        return jsonify({"error": "bad tile parameters"}), 400
+
+    if scene_id:
+        uid = session.get("user_id")
+        if not guards.user_can_access_scene(uid, scene_id):
+            abort(403)
+        who = a.get("user_id") or uid
+        if str(who) != str(uid) and not session.get("is_admin"):
+            abort(403)
+        st = user_label_store(scene_id, who)
+        etag = f"o{palette_tag()}-L{who}-{r}-{c}-{tile_version(st, r, c)}"
+        load = lambda: read_tile_classes(scene_id, who, r, c)[0]
+    else:
+        ensure_backdrop()
+        W, H = backdrop_meta()
+        if (w is not None and w <= 0) or (h is not None and h <= 0) or level < 0:
+            return jsonify({"error": "bad window"}), 400
+        ver = (scene_mask_store().index() or {}).get("version", 0)
+        etag = f"o{palette_tag()}-m{ver}-{W}x{H}-{x}-{y}-{w}-{h}-{level}"
+        load = lambda: mask_window(W, H, x, y, w, h, level)
+
+    if request.if_none_match.contains(etag):
+        resp = make_response("", 304)
+    else:
+        try:
+            arr = load()
+        except LookupError as e:
+            return jsonify({"error": str(e)}), 404
+        resp = make_response(overlay_png_bytes(arr))
+        resp.headers["Content-Type"] = "image/png"
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.headers["Vary"] = "Cookie"
     return resp
 
 @api_bp.post("/save_mask")
@@ -132,23 +281,146 @@ def api_save_mask():
         return jsonify({"error": msg}), 400
     return jsonify({"ok": True})
 
+def _tile_save_target():
+    """(uid, scene_id, r, c) of a tile-save request, or an error response."""
+    uid = session.get("user_id")
+    scene_id = (request.args.get("scene_id") or "").strip()
+    if not uid:
+        return None, (jsonify({"ok": False, "error": "login required"}), 401)
+    if not scene_id:
+        return None, (jsonify({"ok": False, "error": "scene_id missing"}), 400)
+    if not guards.user_can_access_scene(uid, scene_id):
+        abort(403)
+    try:
+        r, c = int(request.args["r"]), int(request.args["c"])
+    except (KeyError, ValueError):
+        return None, (jsonify({"ok": False, "error": "r/c must be integers"}), 400)
+    return (uid, scene_id, r, c), None
+
+@api_bp.post("/save_mask_tile")
+def api_save_mask_tile():
+    """Raw class indices of one grid tile: ?scene_id=&r=&c=, body = uint8[h*w].
+
+    The body may be deflate/gzip/zstd compressed (Content-Encoding). Size is
+    checked against the tile rect in the grid manifest; the labels go into
+    the user's chunked label store without any PNG encoding.
+    """
+    target, err = _tile_save_target()
+    if err:
+        return err
+    uid, scene_id, r, c = target
+    try:
+        info = save_tile_classes(scene_id, uid, r, c, request.get_data(cache=False),
+                                 request.headers.get("Content-Encoding"))
+    except ShapeConflict as e:
+        return jsonify({"ok": False, "error": str(e)}), 409
+    except LookupError as e:
+        return jsonify({"ok": False, "error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"ok": True, "scene_id": scene_id, **info})
+
+@api_bp.post("/save_mask_tile_patch")
+def api_save_mask_tile_patch():
+    """Delta autosave: ?scene_id=&r=&c=&base=<tile_version>&format=rects|rle.
+
+    rects: repeated [x,y,w,h uint16 LE][w*h class bytes] in tile pixels;
+    rle:   repeated [start,length uint32 LE][class uint8] over the row-major tile.
+    Applied atomically; 409 with the current version if `base` is stale.
+    """
+    target, err = _tile_save_target()
+    if err:
+        return err
+    uid, scene_id, r, c = target
+    try:
+        base = int(request.args["base"])
+    except KeyError:
+        return jsonify({"ok": False, "error": "base (tile_version the patch was made on) required"}), 400
+    except ValueError:
+        return jsonify({"ok": False, "error": "base must be an integer"}), 400
+    try:
+        info = apply_tile_patch(scene_id, uid, r, c, base, request.get_data(cache=False),
+                                request.headers.get("Content-Encoding"),
+                                request.args.get("format", "rects"))
+    except PatchConflict as e:
+        return jsonify({"ok": False, "error": str(e), "tile_version": e.current}), 409
+    except ShapeConflict as e:
+        return jsonify({"ok": False, "error": str(e)}), 409
+    except LookupError as e:
+        return jsonify({"ok": False, "error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"ok": True, "scene_id": scene_id, **info})
+
 @api_bp.get("/mask_stats")
 def api_mask_stats():
-    w, h = backdrop_meta()
-    m = load_mask(w, h)
-    vals, cnts = np.unique(m, return_counts=True)
-    return jsonify({"width": int(w), "height": int(h), "counts": {int(v): int(c) for v, c in zip(vals, cnts)}})
+    """Per-class pixel counts from the stores' per-chunk histograms (no full-mask scan).
+
+    Without scene_id: the scene mask. With ?scene_id=: the user's labels
+    (&user_id= for admins, &user_id=all for the sum over annotators),
+    optionally limited to one tile with &r=&c=.
+    """
+    scene_id = (request.args.get("scene_id") or "").strip()
+    if not scene_id:
+        w, h = backdrop_meta()
+        cnt = mask_class_counts(w, h)
+        return jsonify({"width": int(w), "height": int(h),
+                        "counts": {int(v): int(n) for v, n in enumerate(cnt) if n}})
+
+    uid = session.get("user_id")
+    if not guards.user_can_access_scene(uid, scene_id):
+        abort(403)
+    who = request.args.get("user_id") or uid
+    if str(who) != str(uid) and not session.get("is_admin"):
+        abort(403)
+    try:
+        r = int(request.args["r"]) if "r" in request.args else None
+        c = int(request.args["c"]) if r is not None else None
+    except (KeyError, ValueError):
+        return jsonify({"error": "r/c must be integers"}), 400
+    users = scene_label_users(scene_id) if who == "all" else [str(who)]
+    per_user, total = {}, np.zeros(len(settings.CLASS_LIST) or 1, dtype=np.int64)
+    try:
+        for u in users:
+            cnt = class_counts(scene_id, u, r, c)
+            per_user[u] = {int(v): int(n) for v, n in enumerate(cnt) if n}
+            total = np.pad(total, (0, max(0, cnt.size - total.size)))
+            total[:cnt.size] += cnt
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    res = {"scene_id": scene_id, "r": r, "c": c, "user": who,
+           "counts": {int(v): int(n) for v, n in enumerate(total) if n}}
+    if who == "all":
+        res["per_user"] = per_user
+    return jsonify(res)
 
 @api_bp.get("/mask")
 def api_get_mask():
     p = settings.MASK_PNG
+    if mask_artifacts_pending():
+        wait_mask_artifacts(timeout=30)   # just saved: let the background render catch up
     if not p.exists():
         return ("", 204)
     return send_from_directory(p.parent, p.name, conditional=True)
 
+def _progress_job() -> str:
+    """Progress slot of this request: explicit ?job=… or one slot per logged-in user."""
+    job = (request.args.get("job") or "").strip()
+    if job:
+        return job
+    return f"user:{session.get('user_id') or 'anon'}"
+
 @api_bp.get("/progress")
 def api_progress():
-    return jsonify(get_progress())
+    return jsonify(get_progress(_progress_job()))
+
+@api_bp.get("/progress/stream")
+def api_progress_stream():
+    job = _progress_job()
+    resp = Response(stream_with_context(stream_progress(job)), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"   # nginx: don't buffer the event stream
+    return resp
 
 @api_bp.get("/scenes/list")
 def api_scenes_list():
@@ -181,9 +453,26 @@ def api_scenes_select():
     if not user_can_access_scene(scene_id):
         return abort(403)
     try:
-        meta = select_scene_by_id(scene_id)
+        with progress_job(_progress_job()):
+            meta = select_scene_by_id(scene_id)
         return jsonify({"ok": True, "meta": meta})
     except Exception as e:
+        set_progress("error", 0, str(e), job=_progress_job())
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+@api_bp.post("/run_model")
+def api_run_model():
+    """استنتاج مدل روی صحنه‌ی فعلی؛ پیشرفت روی job همین کاربر (/api/progress/stream)."""
+    if not session.get("user_id"):
+        return abort(401)
+    job = _progress_job()
+    try:
+        from services.model import run_model_inference   # onnxruntime فقط وقتی لازم است
+        with progress_job(job):
+            run_model_inference()
+        return jsonify({"ok": True})
+    except Exception as e:
+        set_progress("error", 100, str(e), job=job)
         return jsonify({"ok": False, "error": str(e)}), 500
 
 @api_bp.get("/scenes/current")
@@ -230,23 +519,22 @@ def api_grid_list():
     if not user_can_access_scene(scene_id):
         return abort(403)
 
-    d = tiles_root() / scene_id
-    if not d.exists():
+    man = load_grid_manifest(scene_id)
+    if not man:
         return jsonify({"ok": False, "error": "tiles not found"}), 404
 
-    items = []
-    for r in range(3):
-        for c in range(3):
-            fn = d / f"tile_{r}_{c}.png"
-            if fn.exists():
-                with Image.open(fn) as im:
-                    w, h = im.size
-                items.append({
-                    "r": r, "c": c, "w": w, "h": h,
-                    "url": f"/api/grid/tile?scene_id={scene_id}&r={r}&c={c}"
-                })
-
-    return jsonify({"ok": True, "rows": 3, "cols": 3, "items": items, "scene_id": scene_id})
+    items = [{
+        "r": t["r"], "c": t["c"], "x": t["x"], "y": t["y"], "w": t["w"], "h": t["h"],
+        "bytes": t.get("bytes"), "variants": t.get("variants"), "bounds_wgs84": t.get("bounds_wgs84"),
+        "url": f"/api/grid/tile?scene_id={scene_id}&r={t['r']}&c={t['c']}"
+    } for t in man.get("tiles", [])]
+
+    return jsonify({
+        "ok": True, "rows": man["rows"], "cols": man["cols"], "block": man.get("block") or 0,
+        "formats": man.get("formats") or ["png"],
+        "width": man["W"], "height": man["H"],
+        "items": items, "scene_id": scene_id
+    })
 
 
 def user_can_access_scene(scene_id: str) -> bool:
@@ -4,19 +4,25 @@ from pathlib import Path
 from datetime import datetime
 import time
 
-from flask import Blueprint, request, jsonify, current_app, abort, session
+from flask import Blueprint, request, jsonify, current_app, abort, session, send_file, make_response
 from werkzeug.utils import secure_filename
 
-from routes.guards import login_required, user_can_access_scene
+from config import settings
+from models import db, AssignedTile
+from routes.guards import admin_required, login_required, user_can_access_scene
+from services.consensus import build_consensus, load_consensus_scores
+from services.fsutil import safe_name
+from services.mask_history import add_version, blob_path, latest_version, list_versions
+from services.mask_index import get_latest
+from services.masks import encode_body, pick_encoding
+from services.progress import start_job
+from services.tile_masks import read_tile_classes
+from services.training_export import CONSENSUS, export_training_patches, load_training_index, training_dir
+from services.mosaic import build_label_mosaic, mosaic_path
+from services.vectorize import FORMATS, result_path, vectorize_labels
 
 bp_masks = Blueprint("bp_masks", __name__)
 
-def _safe(v: str, default="x") -> str:
-    if v is None:
-        v = default
-    v = str(v)
-    return "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in v)
-
 def _ensure_dir(p: Path) -> Path:
     p.mkdir(parents=True, exist_ok=True); return p
 
@@ -37,13 +43,13 @@ def save_tile_png():
         - c: int
         - x,y,w,h (اختیاری متادیتا)
         - file: Blob PNG (الزامی)
-    مسیر ذخیره: <OUTPUT_DIR>/masks/<scene_id>/r<r>_c<c>/scene-<scene_id>_r<r>_c<c>__x.._y.._w.._h.._<ts>.png
+    ذخیره در تاریخچه‌ی محتواآدرس (services.mask_history): ذخیره‌ی تکراری نسخه‌ی جدید نمی‌سازد
     """
     f = request.files.get("file")
     if not f:
         return jsonify(ok=False, error="no file"), 400
 
-    scene_id = _safe(request.form.get("scene_id", ""))
+    scene_id = safe_name(request.form.get("scene_id", ""))
     if not scene_id:
         return jsonify(ok=False, error="scene_id missing"), 400
 
@@ -52,23 +58,56 @@ def save_tile_png():
     if not user_can_access_scene(uid, scene_id):
         return abort(403)
 
-    r = _safe(request.form.get("r", "0"))
-    c = _safe(request.form.get("c", "0"))
-    x = request.form.get("x", "")
-    y = request.form.get("y", "")
-    w = request.form.get("w", "")
-    h = request.form.get("h", "")
+    r = safe_name(request.form.get("r", "0"))
+    c = safe_name(request.form.get("c", "0"))
+    rect = {}
+    for k in ("x", "y", "w", "h"):
+        try:
+            rect[k] = int(request.form.get(k, ""))
+        except ValueError:
+            rect = {}
+            break
 
+    res = add_version(scene_id, r, c, f.read(), user=uid, rect=rect)
     root = _output_root()
-    out_dir = _ensure_dir(root / "masks" / scene_id / f"r{r}_c{c}")
+    v = res["version"]
+    return jsonify(ok=True, path=str(res["path"]), rel=str(res["path"].relative_to(root)),
+                   version=v["hash"], ts=v["ts"], created=res["created"])
 
-    ts = time.strftime("%Y%m%d_%H%M%S")
-    meta = f"__x{x}_y{y}_w{w}_h{h}" if all([x != "", y != "", w != "", h != ""]) else ""
-    fname = secure_filename(f"scene-{scene_id}_r{r}_c{c}{meta}_{ts}.png")
-    abs_path = out_dir / fname
-    f.save(abs_path)
+# --------- Tile history: /api/masks/tile_versions , /api/masks/tile_version ----------
+@bp_masks.get("/tile_versions")
+@login_required
+def tile_versions():
+    scene_id = safe_name(request.args.get("scene_id", ""))
+    if not user_can_access_scene(session.get("user_id"), scene_id):
+        return abort(403)
+    r, c = safe_name(request.args.get("r", "0")), safe_name(request.args.get("c", "0"))
+    items = list_versions(scene_id, r, c)[::-1]   # newest first
+    return jsonify(ok=True, scene_id=scene_id, r=r, c=c, items=items)
 
-    return jsonify(ok=True, path=str(abs_path), rel=str(abs_path.relative_to(root)))
+@bp_masks.get("/tile_version")
+@login_required
+def tile_version_png():
+    """PNG of one tile version (?v=<hash>), or of the latest one without v."""
+    scene_id = safe_name(request.args.get("scene_id", ""))
+    if not user_can_access_scene(session.get("user_id"), scene_id):
+        return abort(403)
+    r, c = safe_name(request.args.get("r", "0")), safe_name(request.args.get("c", "0"))
+    v = request.args.get("v", "")
+    if v:
+        if not all(ch in "0123456789abcdef" for ch in v) or not any(e["hash"] == v for e in list_versions(scene_id, r, c)):
+            return abort(404)
+    else:
+        latest = latest_version(scene_id, r, c)
+        if not latest:
+            return abort(404)
+        v = latest["hash"]
+    p = blob_path(scene_id, v)
+    if not p.exists():
+        return abort(404)
+    resp = send_file(p, mimetype="image/png", conditional=True, etag=v, max_age=0)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 # --------- Legacy compatibility: /api/masks/save ----------
 @bp_masks.post("/save")
@@ -80,7 +119,7 @@ def save_polygon_mask_legacy():
     if not (tile_id and uid and f):
         return jsonify(ok=False, error="missing tile_id/uid/file"), 400
 
-    scene_id = _safe(request.args.get("scene_id", ""))
+    scene_id = safe_name(request.args.get("scene_id", ""))
     if not scene_id:
         return jsonify(ok=False, error="scene_id missing"), 400
 
@@ -89,18 +128,243 @@ def save_polygon_mask_legacy():
     if not user_can_access_scene(user_id, scene_id):
         return abort(403)
 
-    r = _safe(request.args.get("r", "0"))
-    c = _safe(request.args.get("c", "0"))
+    r = safe_name(request.args.get("r", "0"))
+    c = safe_name(request.args.get("c", "0"))
 
     root = _output_root()
     out_dir = _ensure_dir(root / "masks_poly" / scene_id / tile_id / f"r{r}_c{c}")
-    fname = secure_filename(f"poly-{_safe(uid)}_{time.strftime('%Y%m%d_%H%M%S')}.png")
+    fname = secure_filename(f"poly-{safe_name(uid)}_{time.strftime('%Y%m%d_%H%M%S')}.png")
     abs_path = out_dir / fname
     f.save(abs_path)
     return jsonify(ok=True, path=str(abs_path))
 
-# --------- Legacy get (می‌تونی بعداً کامل کنی) ----------
+# --------- Latest mask of (scene, r, c, user): /api/masks/get ----------
 @bp_masks.get("/get")
 @login_required
-def get_polygon_mask_legacy():
-    return abort(404)
\ No newline at end of file
+def get_latest_mask():
+    """
+    آخرین ماسک ذخیره‌شده‌ی کاربر برای یک تایل (یک lookup در masks/<scene>/latest.json):
+      ?scene_id=&r=&c=[&user_id=  فقط ادمین][&level=  برای نمای دور: 1 → 1/4 و 2 → 1/16 پیکسل‌ها]
+    - labels: بایت‌های خام کلاس (uint8, h*w) + X-Mask-Width/Height/X-Tile-Version/X-Mask-Level
+    - png:    همان PNG ذخیره‌شده از save_tile_png
+    ETag دارد؛ If-None-Match → 304 بدون خواندن ماسک.
+    """
+    uid = session.get("user_id")
+    scene_id = safe_name(request.args.get("scene_id", ""))
+    if not scene_id or "r" not in request.args or "c" not in request.args:
+        return jsonify(ok=False, error="scene_id/r/c missing"), 404
+    if not user_can_access_scene(uid, scene_id):
+        return abort(403)
+    who = request.args.get("user_id") or uid
+    if str(who) != str(uid) and not session.get("is_admin"):
+        return abort(403)
+    try:
+        r, c = int(request.args["r"]), int(request.args["c"])
+        level = min(max(0, int(request.args.get("level", 0))), settings.MASK_PYRAMID_LEVELS)
+    except ValueError:
+        return jsonify(ok=False, error="r/c/level must be integers"), 400
+
+    e = get_latest(scene_id, r, c, who)
+    if not e:
+        return jsonify(ok=False, error="no saved mask"), 404
+
+    if e.get("kind") == "png":
+        p = blob_path(scene_id, e["hash"])
+        if not p.exists():
+            return jsonify(ok=False, error="no saved mask"), 404
+        resp = send_file(p, mimetype="image/png", conditional=True, etag=e["hash"], max_age=0)
+    else:
+        etag = f"L{safe_name(who)}-{r}-{c}-{e['tile_version']}" + (f"-l{level}" if level else "")
+        if etag in request.if_none_match:
+            resp = current_app.response_class(status=304)
+        else:
+            try:
+                arr, rect = read_tile_classes(scene_id, who, r, c, level)
+            except LookupError as ex:
+                return jsonify(ok=False, error=str(ex)), 404
+            enc = pick_encoding(request.headers.get("Accept-Encoding", ""))
+            resp = make_response(encode_body(arr.tobytes(), enc))
+            resp.headers["Content-Type"] = "application/octet-stream"
+            if enc:
+                resp.headers["Content-Encoding"] = enc
+            resp.headers["X-Mask-Width"] = str(arr.shape[1])
+            resp.headers["X-Mask-Height"] = str(arr.shape[0])
+        resp.set_etag(etag)
+        resp.headers["X-Tile-Version"] = str(e["tile_version"])
+        resp.headers["X-Mask-Level"] = str(level)
+        resp.headers["Access-Control-Expose-Headers"] = \
+            "X-Mask-Width, X-Mask-Height, X-Tile-Version, X-Mask-Kind, X-Mask-Level"
+    resp.headers["X-Mask-Kind"] = e.get("kind", "labels")
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.headers["Vary"] = "Accept-Encoding, Cookie"
+    return resp
+
+# --------- Raster → vector export: /api/masks/vectorize ----------
+def _export_target(args, whole: str = "scene", whole_admin: bool = False):
+    """(scene_id, user_id) from request args with access checks; user_id=`whole` → (scene_id, None)."""
+    uid = session.get("user_id")
+    scene_id = safe_name(args.get("scene_id", ""))
+    if not scene_id:
+        abort(400)
+    if not user_can_access_scene(uid, scene_id):
+        abort(403)
+    who = args.get("user_id") or uid
+    if who == whole:
+        if whole_admin and not session.get("is_admin"):
+            abort(403)
+        return scene_id, None
+    if str(who) != str(uid) and not session.get("is_admin"):
+        abort(403)
+    return scene_id, who
+
+def _start_export(job: str, phase: str, fn):
+    """Run an export in a background thread under progress job `job`; 202 + job name.
+
+    One run per job at a time (in any worker): a second POST while it runs
+    only reports the running job.
+    """
+    if start_job(job, fn, exclusive=True, phase=phase) is None:
+        return jsonify(ok=True, job=job, running=True), 202
+    return jsonify(ok=True, job=job), 202
+
+@bp_masks.post("/vectorize")
+@login_required
+def vectorize_start():
+    """
+    برداری‌سازی برچسب‌ها در پس‌زمینه:
+      JSON: scene_id, user_id (پیش‌فرض: خود کاربر؛ "scene" = ماسک صحنه),
+            format: geojson|fgb, simplify (پیکسل), publish (جایگزینی POLYGONS_GEOJSON، فقط ادمین)
+    پاسخ 202 با نام job برای /api/progress?job=… ؛ خروجی از GET /api/masks/vectorize
+    """
+    j = request.get_json(silent=True) or {}
+    scene_id, who = _export_target(j)
+    fmt = (j.get("format") or "geojson").lower()
+    if fmt not in FORMATS:
+        return jsonify(ok=False, error=f"format must be one of {sorted(FORMATS)}"), 400
+    publish = bool(j.get("publish"))
+    if publish and not session.get("is_admin"):
+        return abort(403)
+    try:
+        simplify = float(j["simplify"]) if j.get("simplify") is not None else None
+    except (TypeError, ValueError):
+        return jsonify(ok=False, error="simplify must be a number"), 400
+
+    job = f"vectorize:{scene_id}:{who if who is not None else 'scene'}"
+    return _start_export(job, "vectorize", lambda: vectorize_labels(scene_id, who, fmt, simplify, publish))
+
+@bp_masks.get("/vectorize")
+@login_required
+def vectorize_result():
+    """Last export: ?scene_id=&user_id=&format=geojson|fgb"""
+    scene_id, who = _export_target(request.args)
+    fmt = (request.args.get("format") or "geojson").lower()
+    if fmt not in FORMATS:
+        return jsonify(ok=False, error=f"format must be one of {sorted(FORMATS)}"), 400
+    p = result_path(scene_id, who, fmt)
+    if not p.exists():
+        return jsonify(ok=False, error="not exported yet"), 404
+    mime = "application/geo+json" if fmt == "geojson" else "application/octet-stream"
+    resp = send_file(p, mimetype=mime, conditional=True, max_age=0,
+                     as_attachment=True, download_name=p.name)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# --------- Scene label mosaic (COG): /api/masks/mosaic ----------
+@bp_masks.post("/mosaic")
+@login_required
+def mosaic_start():
+    """
+    موزاییک برچسب‌های صحنه از آخرین ماسک هر تایل → COG پالت‌دار با overview (mode):
+      JSON: scene_id, user_id (پیش‌فرض: خود کاربر؛ "all" = جدیدترین ماسک هر تایل از همه، فقط ادمین)
+    پاسخ 202 با نام job ؛ خروجی از GET /api/masks/mosaic
+    """
+    j = request.get_json(silent=True) or {}
+    scene_id, who = _export_target(j, whole="all", whole_admin=True)
+    job = f"mosaic:{scene_id}:{who if who is not None else 'all'}"
+    return _start_export(job, "mosaic", lambda: build_label_mosaic(scene_id, who))
+
+@bp_masks.get("/mosaic")
+@login_required
+def mosaic_result():
+    """Last mosaic: ?scene_id=&user_id= (GeoTIFF/COG)"""
+    scene_id, who = _export_target(request.args, whole="all", whole_admin=True)
+    p = mosaic_path(scene_id, who)
+    if not p.exists():
+        return jsonify(ok=False, error="not exported yet"), 404
+    resp = send_file(p, mimetype="image/tiff; application=geotiff; profile=cloud-optimized",
+                     conditional=True, max_age=0, as_attachment=True, download_name=p.name)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# --------- Multi-annotator consensus: /api/masks/consensus ----------
+@bp_masks.post("/consensus")
+@admin_required
+def consensus_start():
+    """
+    اجماع برچسب‌های کاربرانی که صحنه به آن‌ها assign شده (رأی اکثریت + نقشه‌ی توافق/آنتروپی):
+      JSON: scene_id, users (اختیاری؛ پیش‌فرض: کاربران AssignedTile این صحنه)
+    پاسخ 202 با نام job ؛ امتیاز تایل‌ها از GET /api/masks/consensus
+    """
+    j = request.get_json(silent=True) or {}
+    scene_id = safe_name(j.get("scene_id", ""))
+    if not scene_id:
+        return jsonify(ok=False, error="scene_id missing"), 400
+    users = j.get("users")
+    if users is not None and not (isinstance(users, list) and all(
+            isinstance(u, (str, int)) and not isinstance(u, bool) and str(u).strip() for u in users)):
+        return jsonify(ok=False, error="users must be a list of user ids"), 400
+    if not users:
+        rows = db.session.query(AssignedTile.user_id).filter_by(scene_id=scene_id).distinct().all()
+        users = [str(row.user_id) for row in rows]
+    users = [str(u).strip() for u in users]
+    if not users:
+        return jsonify(ok=False, error="scene is not assigned to anyone"), 404
+    return _start_export(f"consensus:{scene_id}", "consensus", lambda: build_consensus(scene_id, users))
+
+@bp_masks.get("/consensus")
+@admin_required
+def consensus_scores():
+    """Per-tile agreement scores of the last consensus run: ?scene_id="""
+    res = load_consensus_scores(safe_name(request.args.get("scene_id", "")))
+    if not res:
+        return jsonify(ok=False, error="no consensus yet"), 404
+    return jsonify(ok=True, **res)
+
+# --------- Training patches (bands + labels, sharded .npz): /api/masks/training_export ----------
+@bp_masks.post("/training_export")
+@login_required
+def training_export_start():
+    """
+    خروجی پچ‌های آموزشی (باندهای MODEL_BANDS + ماسک برچسب) در shardهای فشرده‌ی .npz:
+      JSON: scene_id, user_id (پیش‌فرض: خود کاربر؛ "consensus" = برچسب‌های اجماع، فقط ادمین),
+            bands (اختیاری؛ پیش‌فرض MODEL_BANDS)
+    پاسخ 202 با نام job ؛ فهرست shardها از GET /api/masks/training_export
+    """
+    j = request.get_json(silent=True) or {}
+    scene_id, who = _export_target(j, whole=CONSENSUS, whole_admin=True)
+    bands = j.get("bands") or settings.MODEL_BANDS
+    if not isinstance(bands, list) or not bands or not all(isinstance(b, str) and b for b in bands):
+        return jsonify(ok=False, error="bands must be a non-empty list of band names"), 400
+    source = CONSENSUS if who is None else who
+    job = f"training_export:{scene_id}:{source}"
+    return _start_export(job, "training_export", lambda: export_training_patches(scene_id, source, bands))
+
+@bp_masks.get("/training_export")
+@login_required
+def training_export_result():
+    """Index of the last export: ?scene_id=&user_id= ; &shard=shard_00000.npz downloads one shard."""
+    scene_id, who = _export_target(request.args, whole=CONSENSUS, whole_admin=True)
+    source = CONSENSUS if who is None else who
+    res = load_training_index(scene_id, source)
+    if not res:
+        return jsonify(ok=False, error="not exported yet"), 404
+    shard = request.args.get("shard")
+    if not shard:
+        return jsonify(ok=True, **res)
+    if shard not in {s["file"] for s in res.get("shards", [])}:
+        return jsonify(ok=False, error="unknown shard"), 404
+    p = training_dir(scene_id, source) / shard
+    resp = send_file(p, mimetype="application/octet-stream", conditional=True, max_age=0,
+                     as_attachment=True, download_name=f"{scene_id}_{p.name}")
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
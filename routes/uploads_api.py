@@ -0,0 +1,77 @@
+# routes/uploads_api.py
+from __future__ import annotations
+
+from flask import Blueprint, request, jsonify, session
+
+from routes.guards import login_required
+from services.uploads import (
+    UploadError, init_upload, write_chunk, status, finalize, abort_upload,
+)
+
+bp_uploads = Blueprint("bp_uploads", __name__)
+
+def _err(e: UploadError):
+    return jsonify(ok=False, error=str(e)), e.status
+
+# POST /api/uploads/init  {filename, size, sha256?}
+@bp_uploads.post("/init")
+@login_required
+def uploads_init():
+    j = request.get_json(silent=True) or {}
+    try:
+        st = init_upload(j.get("filename", ""), int(j.get("size") or 0),
+                         user_id=session.get("user_id"), sha256=j.get("sha256"))
+    except UploadError as e:
+        return _err(e)
+    except (TypeError, ValueError):
+        return jsonify(ok=False, error="bad size"), 400
+    return jsonify(ok=True, **st)
+
+# GET /api/uploads/<id>  → current offset (resume point)
+@bp_uploads.get("/<upload_id>")
+@login_required
+def uploads_status(upload_id: str):
+    try:
+        return jsonify(ok=True, **status(upload_id, session.get("user_id")))
+    except UploadError as e:
+        return _err(e)
+
+# PUT /api/uploads/<id>?offset=N   body = raw chunk bytes (streamed, not form-encoded)
+@bp_uploads.put("/<upload_id>")
+@login_required
+def uploads_chunk(upload_id: str):
+    length = request.content_length
+    if length is None:
+        return jsonify(ok=False, error="Content-Length required"), 411
+    try:
+        offset = int(request.args.get("offset", "-1"))
+        out = write_chunk(upload_id, offset, request.stream, length,
+                          chunk_sha256=request.headers.get("X-Chunk-SHA256"),
+                          user_id=session.get("user_id"))
+    except UploadError as e:
+        return _err(e)
+    except ValueError:
+        return jsonify(ok=False, error="bad offset"), 400
+    return jsonify(ok=True, **out)
+
+# POST /api/uploads/<id>/finalize
+@bp_uploads.post("/<upload_id>/finalize")
+@login_required
+def uploads_finalize(upload_id: str):
+    try:
+        out = finalize(upload_id, session.get("user_id"))
+    except UploadError as e:
+        return _err(e)
+    from services.s2 import list_s2_scenes
+    scene = next((s.__dict__ for s in list_s2_scenes() if s.path == out["path"]), None)
+    return jsonify(ok=True, scene=scene, **out)
+
+# DELETE /api/uploads/<id>
+@bp_uploads.delete("/<upload_id>")
+@login_required
+def uploads_abort(upload_id: str):
+    try:
+        abort_upload(upload_id, session.get("user_id"))
+    except UploadError as e:
+        return _err(e)
+    return jsonify(ok=True)
@@ -0,0 +1,152 @@
+# services/consensus.py
+"""
+Multi-annotator consensus of the per-user label stores of a scene.
+
+Tile by tile, the annotators who saved that tile vote on it; users who never
+touched a tile do not vote on it. Inside a tile the work goes one store
+chunk (MASK_CHUNK²) at a time: the co-located windows of the voters are
+stacked (n, h, w) and counted into a small (class, pixel) table with one
+vectorised pass per annotator — no Python loop over pixels — so the cost is
+linear in annotators × pixels and memory is bounded by one chunk window,
+whatever the tile size.
+
+Results under ``masks/<scene>/consensus/``:
+
+    labels/      majority class per pixel (ties → lower class id)
+    agreement/   share of voters agreeing with the majority, 0..255
+    entropy/     normalised vote entropy, 0 (unanimous) .. 255
+    tiles.json   per-tile voters and mean scores
+"""
+from __future__ import annotations
+
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import settings
+from services.fsutil import write_atomic
+from services.mask_store import ChunkedMaskStore
+from services.progress import set_progress
+from services.s2 import load_grid_manifest
+from services.tile_masks import labels_root, scene_label_users, tile_version, user_label_store
+
+SCORES_NAME = "tiles.json"
+
+
+def consensus_root(scene_id: str) -> Path:
+    return labels_root(scene_id).parent / "consensus"
+
+
+def vote(stack: np.ndarray, ncls: int):
+    """Majority class, agreement and normalised entropy of an (n, h, w) uint8 vote stack."""
+    n, h, w = stack.shape
+    hw = h * w
+    flat = stack.reshape(n, hw)
+    px = np.arange(hw)
+    counts = np.zeros((ncls, hw), dtype=np.uint16)
+    for votes in flat:                      # one voter → one vote per pixel, no index clashes
+        counts[votes, px] += 1
+    top = counts.argmax(axis=0)
+    best = counts[top, px]
+    agree = best.astype(np.float32) / n
+    ent = np.zeros(hw, dtype=np.float32)
+    if n > 1:
+        # H = log2(n) - Σ c·log2(c) / n over the class counts c, via a lookup table of c·log2(c)
+        c = np.arange(n + 1, dtype=np.float64)
+        clog = np.zeros(n + 1, dtype=np.float32)
+        clog[1:] = c[1:] * np.log2(c[1:])
+        for row in counts:
+            if row.any():
+                ent += clog[row]
+        ent = (np.float32(np.log2(n)) - ent / n) / np.float32(np.log2(min(n, ncls)))
+        ent[best == n] = 0.0
+        np.clip(ent, 0.0, 1.0, out=ent)
+    return top.astype(np.uint8).reshape(h, w), agree.reshape(h, w), ent.reshape(h, w)
+
+
+def _to_u8(x: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(x * 255), 0, 255).astype(np.uint8)
+
+
+def _chunk_windows(st: ChunkedMaskStore, x: int, y: int, w: int, h: int):
+    """(x, y, w, h) of the parts of a tile window that fall in each chunk of `st`."""
+    for cy, cx in st.chunks_in(x, y, w, h):
+        ox, oy, cw, ch = st.chunk_rect(cy, cx)
+        ax0, ay0 = max(x, ox), max(y, oy)
+        ax1, ay1 = min(x + w, ox + cw), min(y + h, oy + ch)
+        yield ax0, ay0, ax1 - ax0, ay1 - ay0
+
+
+def build_consensus(scene_id: str, users: Optional[List[str]] = None) -> dict:
+    """Merge the annotators' labels of a scene; returns the per-tile scores."""
+    man = load_grid_manifest(scene_id)
+    if not man:
+        raise LookupError("tiles not found")
+    W, H = int(man["W"]), int(man["H"])
+    users = [str(u) for u in (users or scene_label_users(scene_id))]
+    stores = {u: user_label_store(scene_id, u) for u in users}
+    stores = {u: st for u, st in stores.items() if st.exists() and st.shape == (H, W)}
+    if not stores:
+        raise LookupError("no annotator labels")
+    ncls = max(len(settings.CLASS_LIST), 1)
+
+    root = consensus_root(scene_id)
+    # score maps get no mode pyramid (the mode of an agreement value means nothing)
+    out = {k: ChunkedMaskStore(root / k, levels=None if k == "labels" else 0)
+           for k in ("labels", "agreement", "entropy")}
+    for st in out.values():
+        st.ensure(W, H)
+
+    t0 = time.perf_counter()
+    scores: Dict[str, dict] = {}
+    tiles = man.get("tiles", [])
+    for i, t in enumerate(tiles):
+        r, c = int(t["r"]), int(t["c"])
+        x, y, w, h = (int(t[k]) for k in ("x", "y", "w", "h"))
+        voters = [u for u, st in stores.items() if tile_version(st, r, c) > 0]
+        if not voters:
+            for st in out.values():   # nobody labelled this tile (any more)
+                st.write_window(x, y, np.zeros((h, w), dtype=np.uint8))
+        else:
+            agree_sum = ent_sum = 0.0
+            unanimous = labelled_n = 0
+            labelled_sum = 0.0
+            for wx, wy, ww, wh in _chunk_windows(out["labels"], x, y, w, h):
+                stack = np.stack([stores[u].read_window(wx, wy, ww, wh) for u in voters])
+                top, agree, ent = vote(stack, max(ncls, int(stack.max()) + 1))
+                labelled = (stack > 0).any(axis=0)
+                out["labels"].write_window(wx, wy, top)
+                out["agreement"].write_window(wx, wy, _to_u8(agree))
+                out["entropy"].write_window(wx, wy, _to_u8(ent))
+                agree_sum += float(agree.sum(dtype=np.float64))
+                ent_sum += float(ent.sum(dtype=np.float64))
+                unanimous += int(np.count_nonzero(agree == 1))
+                labelled_n += int(np.count_nonzero(labelled))
+                labelled_sum += float(agree[labelled].sum(dtype=np.float64))
+            npx = max(1, w * h)
+            scores[f"{r}_{c}"] = {
+                "r": r, "c": c, "users": voters,
+                "agreement": round(agree_sum / npx, 4),
+                "entropy": round(ent_sum / npx, 4),
+                "unanimous": round(unanimous / npx, 4),
+                # background-only pixels inflate agreement; this one looks at labelled pixels only
+                "labelled_agreement": round(labelled_sum / labelled_n, 4) if labelled_n else None,
+            }
+        set_progress("consensus", 95.0 * (i + 1) / max(1, len(tiles)), f"tiles {i + 1}/{len(tiles)}")
+
+    res = {"scene_id": scene_id, "users": sorted(stores), "created": time.time(),
+           "seconds": round(time.perf_counter() - t0, 3), "tiles": scores}
+    write_atomic(root / SCORES_NAME, json.dumps(res, ensure_ascii=False, separators=(",", ":")))
+    print(f"[consensus] {scene_id}: {len(stores)} annotators, {len(scores)} tiles in {res['seconds']:.2f}s")
+    set_progress("done", 100, f"{len(scores)} tiles")
+    return res
+
+
+def load_consensus_scores(scene_id: str) -> Optional[dict]:
+    try:
+        return json.loads((consensus_root(scene_id) / SCORES_NAME).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,45 @@
+# services/fsutil.py
+"""
+File-system helpers shared by the services and routes.
+
+safe_name() turns ids from requests (scene, user, r/c) into one path
+component. write_atomic() writes next to the target under a per-writer temp
+name (pid + thread) and renames it into place, so readers never see a
+half-written file and two workers writing the same path never share a temp
+file.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from pathlib import Path
+from typing import Union
+
+
+def safe_name(v, default: str = "x") -> str:
+    """`v` as a single path component: anything but letters, digits and -_. becomes _."""
+    if v is None:
+        v = default
+    return "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in str(v))
+
+
+def tmp_path(path: Path) -> Path:
+    """Per-writer temp name next to `path` (hidden, pid + thread id)."""
+    path = Path(path)
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def write_atomic(path: Path, data: Union[bytes, str]) -> Path:
+    """Write bytes (or UTF-8 text) to `path` via a temp file + rename; returns `path`."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(path)
+    try:
+        if isinstance(data, str):
+            tmp.write_text(data, encoding="utf-8")
+        else:
+            tmp.write_bytes(data)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return path
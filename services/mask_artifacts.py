@@ -0,0 +1,141 @@
+# services/mask_artifacts.py
+"""
+Background rendering of the scene mask's derived PNGs.
+
+The chunk store (services.mask_store) is the durable copy of the scene mask:
+a save returns once its chunks and index are on disk. mask.png (/api/mask),
+mask_vis_debug.png and mask_overlay.png are rebuilt afterwards by one worker
+thread with fast encoders — zlib level 1, a 1-bit debug image and an 8-bit
+palette overlay instead of full RGBA. The same palette renders the on-demand
+overlay tiles of /api/mask_overlay_tile. Saves that arrive while the worker
+is busy are coalesced; it always renders the newest store version.
+"""
+from __future__ import annotations
+
+import io
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from config import settings
+from services.fsutil import tmp_path
+from services.mask_store import scene_mask_store
+from services.metrics import stage_timer
+
+OVERLAY_ALPHA = 170
+
+_COND = threading.Condition()
+_WANTED = 0   # render requests so far
+_DONE = 0     # requests covered by the last finished render
+_WORKER: Optional[threading.Thread] = None
+
+
+def class_palette(alpha: int = OVERLAY_ALPHA) -> Tuple[list, bytes]:
+    """(768-entry RGB palette, per-index alpha) from settings.CLASS_LIST; class 0 is transparent."""
+    pal = [0] * 768
+    trns = bytearray(256)
+    for i, cls in enumerate(settings.CLASS_LIST):
+        idx = int(cls.get("id", i))
+        if not 0 <= idx < 256:
+            continue
+        col = str(cls.get("color") or "#000000").lstrip("#")
+        pal[idx * 3:idx * 3 + 3] = [int(col[k:k + 2], 16) for k in (0, 2, 4)]
+        trns[idx] = 0 if idx == 0 else alpha
+    return pal, bytes(trns)
+
+
+def overlay_image(mask: np.ndarray) -> Image.Image:
+    """Class mask as a palette image: one byte per pixel, colours and alpha from CLASS_LIST."""
+    im = Image.fromarray(np.ascontiguousarray(mask, dtype=np.uint8), mode="P")
+    pal, trns = class_palette()
+    im.putpalette(pal)
+    im.info["transparency"] = trns
+    return im
+
+
+def overlay_png_bytes(mask: np.ndarray) -> bytes:
+    """Palette overlay PNG in memory (on-demand tiles)."""
+    im = overlay_image(mask)
+    buf = io.BytesIO()
+    im.save(buf, format="PNG", compress_level=1, transparency=im.info["transparency"])
+    return buf.getvalue()
+
+
+def palette_tag() -> str:
+    """Short hash of the current palette, for ETags of rendered overlays."""
+    pal, trns = class_palette()
+    return f"{zlib.crc32(bytes(pal) + trns):08x}"
+
+
+def _save_png(im: Image.Image, path: Path, **kw) -> None:
+    """Write next to the target and rename, so readers never see a half-written PNG."""
+    tmp = tmp_path(path)
+    im.save(tmp, format="PNG", compress_level=1, **kw)
+    os.replace(tmp, path)
+
+
+def write_overlay_png(mask: np.ndarray, path: Path) -> None:
+    im = overlay_image(mask)
+    _save_png(im, path, transparency=im.info["transparency"])
+
+
+def render_mask_artifacts(mask: Optional[np.ndarray] = None) -> bool:
+    """Rebuild the derived PNGs from `mask` (default: the scene mask store)."""
+    if mask is None:
+        st = scene_mask_store()
+        if not st.exists():
+            return False
+        mask = st.read_full()
+    out = settings.OUTPUT_DIR
+    with stage_timer("mask_artifacts", "render"):
+        _save_png(Image.fromarray(mask, mode="L"), settings.MASK_PNG)
+        _save_png(Image.fromarray(mask > 0), out / "mask_vis_debug.png")
+        write_overlay_png(mask, out / "mask_overlay.png")
+    return True
+
+
+def _worker() -> None:
+    global _DONE
+    while True:
+        with _COND:
+            while _DONE >= _WANTED:
+                _COND.wait()
+            gen = _WANTED
+        t0 = time.perf_counter()
+        try:
+            render_mask_artifacts()
+            print(f"[mask_artifacts] rendered in {time.perf_counter() - t0:.2f}s")
+        except Exception as e:
+            print("[WARN] mask artifacts failed:", e)
+        with _COND:
+            _DONE = gen
+            _COND.notify_all()
+
+
+def schedule_mask_artifacts() -> None:
+    """Ask the worker to re-render the derived PNGs from the current store."""
+    global _WANTED, _WORKER
+    with _COND:
+        _WANTED += 1
+        if _WORKER is None or not _WORKER.is_alive():
+            _WORKER = threading.Thread(target=_worker, name="mask-artifacts", daemon=True)
+            _WORKER.start()
+        _COND.notify_all()
+
+
+def mask_artifacts_pending() -> bool:
+    with _COND:
+        return _DONE < _WANTED
+
+
+def wait_mask_artifacts(timeout: Optional[float] = None) -> bool:
+    """Block until every render requested so far is written; False on timeout."""
+    with _COND:
+        target = _WANTED
+        return _COND.wait_for(lambda: _DONE >= target, timeout=timeout)
@@ -0,0 +1,158 @@
+# services/mask_history.py
+"""
+Content-addressed version history for tile mask PNGs (/api/masks/save_tile_png).
+
+    masks/<scene>/_blobs/<hash[:2]>/<hash>.png   one file per distinct mask
+    masks/<scene>/r<r>_c<c>/versions.json         [{hash, ts, user, x, y, w, h, bytes}, …] oldest first
+
+A save whose bytes equal the tile's latest version adds nothing. After each
+save the list is compacted: the last MASK_HISTORY_KEEP_LAST versions stay,
+plus the newest version of every hour within MASK_HISTORY_HOURLY_HOURS and
+every user's latest version (services.mask_index); blobs nothing references
+any more are deleted. Timestamped PNGs from before the history existed are
+imported on first touch.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from config import settings
+from services.fsutil import safe_name, write_atomic
+from services.mask_index import png_hashes, record_latest
+
+VERSIONS_NAME = "versions.json"
+_LEGACY_TS = re.compile(r"_(\d{8}_\d{6})\.png$")
+
+_LOCKS: Dict[str, threading.Lock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+def _scene_lock(scene_dir: Path) -> threading.Lock:
+    with _LOCKS_GUARD:
+        return _LOCKS.setdefault(str(scene_dir), threading.Lock())
+
+
+def scene_dir(scene_id: str) -> Path:
+    return settings.OUTPUT_DIR / "masks" / safe_name(scene_id)
+
+
+def tile_dir(scene_id: str, r, c) -> Path:
+    return scene_dir(scene_id) / f"r{safe_name(r)}_c{safe_name(c)}"
+
+
+def blob_path(scene_id: str, h: str) -> Path:
+    return scene_dir(scene_id) / "_blobs" / h[:2] / f"{h}.png"
+
+
+def _read_versions(tdir: Path) -> List[dict]:
+    try:
+        return json.loads((tdir / VERSIONS_NAME).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return []
+
+
+def _write_versions(tdir: Path, versions: List[dict]) -> None:
+    write_atomic(tdir / VERSIONS_NAME, json.dumps(versions, separators=(",", ":")))
+
+
+def _put_blob(scene_id: str, data: bytes) -> str:
+    h = hashlib.sha256(data).hexdigest()
+    p = blob_path(scene_id, h)
+    if not p.exists():
+        write_atomic(p, data)
+    return h
+
+
+def compact(versions: List[dict], now: Optional[float] = None, pinned: frozenset = frozenset()) -> List[dict]:
+    """Retention: last N versions + newest per hour inside the hourly window + pinned hashes."""
+    if not versions:
+        return versions
+    now = time.time() if now is None else now
+    n = max(1, int(settings.MASK_HISTORY_KEEP_LAST))
+    keep = set(range(max(0, len(versions) - n), len(versions)))
+    horizon = now - int(settings.MASK_HISTORY_HOURLY_HOURS) * 3600
+    newest_in_hour: Dict[int, int] = {}
+    for i, v in enumerate(versions):
+        if v["ts"] >= horizon:
+            newest_in_hour[int(v["ts"] // 3600)] = i   # list is oldest first → last wins
+    keep.update(newest_in_hour.values())
+    return [v for i, v in enumerate(versions) if i in keep or v["hash"] in pinned]
+
+
+def _gc_blobs(scene_id: str, dropped: set) -> None:
+    """Delete dropped blobs unless another tile of the scene still uses them (caller holds the scene lock)."""
+    dropped -= png_hashes(scene_id)
+    if not dropped:
+        return
+    for vf in scene_dir(scene_id).glob(f"r*_c*/{VERSIONS_NAME}"):
+        dropped -= {v["hash"] for v in _read_versions(vf.parent)}
+        if not dropped:
+            return
+    for h in dropped:
+        try:
+            blob_path(scene_id, h).unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _import_legacy(scene_id: str, tdir: Path) -> List[dict]:
+    """Fold old timestamped PNGs of one tile into the blob store (oldest first)."""
+    versions: List[dict] = []
+    for p in sorted(tdir.glob("*.png"), key=lambda q: (q.stat().st_mtime, q.name)):
+        m = _LEGACY_TS.search(p.name)
+        try:
+            ts = time.mktime(time.strptime(m.group(1), "%Y%m%d_%H%M%S")) if m else p.stat().st_mtime
+        except ValueError:
+            ts = p.stat().st_mtime
+        data = p.read_bytes()
+        h = _put_blob(scene_id, data)
+        if not versions or versions[-1]["hash"] != h:
+            versions.append({"hash": h, "ts": ts, "user": None, "bytes": len(data), "name": p.name})
+    if versions:
+        _write_versions(tdir, versions)
+        print(f"[masks] {tdir.relative_to(settings.OUTPUT_DIR)}: imported {len(versions)} legacy PNG versions")
+    for p in tdir.glob("*.png"):
+        p.unlink()
+    return versions
+
+
+def add_version(scene_id: str, r, c, data: bytes, user=None, rect: Optional[dict] = None) -> dict:
+    """Record a tile mask PNG; returns {"version": entry, "created": bool, "path": blob}."""
+    tdir = tile_dir(scene_id, r, c)
+    with _scene_lock(scene_dir(scene_id)):
+        versions = _read_versions(tdir)
+        if not versions and tdir.is_dir():
+            versions = _import_legacy(scene_id, tdir)
+        h = _put_blob(scene_id, data)
+        if versions and versions[-1]["hash"] == h:
+            entry, created = versions[-1], False
+        else:
+            entry, created = {"hash": h, "ts": time.time(), "user": user, "bytes": len(data), **(rect or {})}, True
+            # every user's latest PNG stays, even when others saved N times since
+            kept = compact(versions + [entry], pinned=frozenset(png_hashes(scene_id, r, c)))
+            _write_versions(tdir, kept)
+            _gc_blobs(scene_id, {v["hash"] for v in versions} - {v["hash"] for v in kept})
+        if user is not None:
+            record_latest(scene_id, r, c, user, {"kind": "png", "hash": h})
+    return {"version": entry, "created": created, "path": blob_path(scene_id, h)}
+
+
+def list_versions(scene_id: str, r, c) -> List[dict]:
+    tdir = tile_dir(scene_id, r, c)
+    versions = _read_versions(tdir)
+    if not versions and tdir.is_dir() and any(tdir.glob("*.png")):
+        with _scene_lock(scene_dir(scene_id)):
+            versions = _read_versions(tdir) or _import_legacy(scene_id, tdir)
+    return versions
+
+
+def latest_version(scene_id: str, r, c) -> Optional[dict]:
+    """Newest version entry of a tile (one small JSON read), or None."""
+    versions = list_versions(scene_id, r, c)
+    return versions[-1] if versions else None
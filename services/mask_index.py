@@ -0,0 +1,77 @@
+# services/mask_index.py
+"""
+Per-scene index of the latest saved mask of every (tile, user).
+
+    masks/<scene>/latest.json = {"<r>_<c>_<user>": {"kind": "labels"|"png", "ts": …, …}}
+
+"labels" entries point at the user's chunked label store (tile_version);
+"png" entries at a blob of the tile PNG history (hash). Savers call
+record_latest(); readers get the entry with one dict lookup on a cached
+JSON (re-read only when the file changed).
+"""
+from __future__ import annotations
+
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from config import settings
+from services.fsutil import safe_name, write_atomic
+
+LATEST_NAME = "latest.json"
+
+_LOCK = threading.Lock()
+_CACHE: Dict[str, Tuple[tuple, dict]] = {}   # path → (stat stamp, parsed index)
+
+
+def _index_path(scene_id: str) -> Path:
+    return settings.OUTPUT_DIR / "masks" / safe_name(scene_id) / LATEST_NAME
+
+
+def _key(r, c, user) -> str:
+    return f"{safe_name(r)}_{safe_name(c)}_{safe_name(user)}"
+
+
+def _load(p: Path) -> dict:
+    try:
+        st = p.stat()
+    except FileNotFoundError:
+        return {}
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    hit = _CACHE.get(str(p))
+    if hit and hit[0] == stamp:
+        return hit[1]
+    ix = json.loads(p.read_text(encoding="utf-8"))
+    _CACHE[str(p)] = (stamp, ix)
+    return ix
+
+
+def record_latest(scene_id: str, r, c, user, entry: dict) -> None:
+    """Point (scene, r, c, user) at a new latest mask."""
+    p = _index_path(scene_id)
+    with _LOCK:
+        ix = dict(_load(p))
+        ix[_key(r, c, user)] = {"ts": time.time(), **entry}
+        write_atomic(p, json.dumps(ix, separators=(",", ":")))
+
+
+def get_latest(scene_id: str, r, c, user) -> Optional[dict]:
+    return _load(_index_path(scene_id)).get(_key(r, c, user))
+
+
+def scene_latest(scene_id: str) -> Dict[Tuple[str, str, str], dict]:
+    """Every latest entry of the scene keyed by (r, c, user)."""
+    out = {}
+    for k, e in _load(_index_path(scene_id)).items():
+        r, c, user = k.split("_", 2)   # r and c are integers; the user may contain "_"
+        out[(r, c, user)] = e
+    return out
+
+
+def png_hashes(scene_id: str, r=None, c=None) -> set:
+    """Blob hashes some user's latest entry points at (optionally only for one tile)."""
+    pre = None if r is None else f"{safe_name(r)}_{safe_name(c)}_"
+    return {e["hash"] for k, e in _load(_index_path(scene_id)).items()
+            if e.get("kind") == "png" and (pre is None or k.startswith(pre))}
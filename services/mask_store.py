@@ -0,0 +1,535 @@
+# services/mask_store.py
+"""
+Chunked on-disk label store.
+
+A W×H uint8 class mask is cut into fixed CHUNK×CHUNK chunks (edge chunks
+are smaller). Each non-empty chunk is one compressed file; ``index.json``
+holds the geometry and, per chunk, the codec and a content hash::
+
+    <root>/index.json
+    <root>/<cy>_<cx>_<hash>.z
+    <root>/.lock          flock'ed by writers (all worker processes)
+
+Each entry also carries the chunk's class histogram, so counts over the
+whole mask or any chunk-aligned window are sums of small vectors. All-zero
+chunks have no entry and no file. Chunk files are named by
+content hash, so a write stores the new files first and then swaps the
+index in one rename — a reader sees either the old or the new mask, never
+a mix, and a save that changes nothing writes nothing.
+
+Zoomed-out views read pyramid levels: ``<root>/levels/L<k>`` are stores of
+the mask downsampled by 2**k with the 2×2 mode (ties go to a non-zero class,
+so thin labels survive). A write refreshes only the part of each level under
+the chunks it changed; levels that lag behind (older stores, a resize) are
+rebuilt on first read.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from config import settings
+from services.fsutil import write_atomic
+
+# zstd اختیاری است؛ اگر نصب نباشد zlib
+try:
+    import zstandard as zstd
+except Exception:
+    zstd = None
+
+try:
+    import fcntl
+except Exception:  # pragma: no cover - not on POSIX
+    fcntl = None
+
+INDEX_NAME = "index.json"
+LOCK_NAME = ".lock"
+_DECODED_MAX = 256            # decoded chunks kept in memory (×256 KiB at 512²)
+
+
+class _StoreLock:
+    """Re-entrant store lock: an RLock for the threads of this process plus a
+    flock on ``<root>/.lock`` (held by the outermost acquire) for other worker
+    processes, so index.json read-modify-writes never interleave."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._rlock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self) -> bool:
+        self._rlock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            f = None
+            try:
+                self.root.mkdir(parents=True, exist_ok=True)
+                f = open(self.root / LOCK_NAME, "a+")
+                fcntl.flock(f, fcntl.LOCK_EX)
+            except BaseException:
+                if f is not None:
+                    f.close()
+                self._rlock.release()
+                raise
+            self._file = f
+        self._depth += 1
+        return True
+
+    def release(self) -> None:
+        self._depth -= 1
+        if self._depth == 0 and self._file is not None:
+            f, self._file = self._file, None
+            f.close()   # drops the flock
+        self._rlock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+_LOCKS: Dict[str, _StoreLock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+def _store_lock(root: Path) -> _StoreLock:
+    key = str(Path(root).resolve())
+    with _LOCKS_GUARD:
+        lock = _LOCKS.get(key)
+        if lock is None:
+            lock = _LOCKS[key] = _StoreLock(Path(key))
+        return lock
+
+
+def _compress(raw: bytes) -> Tuple[str, bytes]:
+    if zstd is not None:
+        return "zstd", zstd.ZstdCompressor(level=3).compress(raw)
+    return "deflate", zlib.compress(raw, 1)
+
+
+def _decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstd is None:
+            raise RuntimeError("chunk is zstd-compressed but zstandard is not installed")
+        return zstd.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _digest(raw: bytes) -> str:
+    return hashlib.blake2b(raw, digest_size=10).hexdigest()
+
+
+def _hist(arr: np.ndarray) -> np.ndarray:
+    """Pixel count per class (at least len(CLASS_LIST) bins)."""
+    return np.bincount(arr.ravel(), minlength=len(settings.CLASS_LIST))
+
+
+def _add(a: np.ndarray, b) -> np.ndarray:
+    b = np.asarray(b, dtype=np.int64)
+    if b.size > a.size:
+        a = np.pad(a, (0, b.size - a.size))
+    a[:b.size] += b
+    return a
+
+
+def mode2x2(a: np.ndarray) -> np.ndarray:
+    """Mode of every 2×2 block (odd edges repeat the last row/column); ties → non-zero class."""
+    h, w = a.shape
+    a = np.pad(a, ((0, h & 1), (0, w & 1)), mode="edge")
+    q = (a[0::2, 0::2], a[0::2, 1::2], a[1::2, 0::2], a[1::2, 1::2])
+    eq = {(i, j): q[i] == q[j] for i in range(4) for j in range(i + 1, 4)}
+    best, score = None, None
+    for i in range(4):
+        # 2 × (how many of the 4 share this value) − (value is background)
+        s = sum(eq[min(i, j), max(i, j)] for j in range(4) if j != i).astype(np.int8) * 2 - (q[i] == 0)
+        if best is None:
+            best, score = q[i].copy(), s
+        else:
+            better = s > score
+            best[better] = q[i][better]
+            score = np.maximum(score, s)
+    return best
+
+
+class ChunkedMaskStore:
+    """uint8 label raster stored as compressed chunks under `root`."""
+
+    def __init__(self, root: Path, chunk: Optional[int] = None, levels: Optional[int] = None):
+        self.root = Path(root)
+        self.chunk = int(chunk or settings.MASK_CHUNK)
+        self.levels = int(settings.MASK_PYRAMID_LEVELS if levels is None else levels)
+        self._level_stores: Dict[int, "ChunkedMaskStore"] = {}
+        self.lock = _store_lock(self.root)
+        self._index: Optional[dict] = None
+        self._index_stamp = None
+        self._decoded: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._decoded_lock = threading.Lock()
+        self._hist_full: Optional[Tuple[int, np.ndarray]] = None   # (index version, whole-mask counts)
+
+    # ---------- index ----------
+    @property
+    def index_path(self) -> Path:
+        return self.root / INDEX_NAME
+
+    def index(self) -> Optional[dict]:
+        """Current index (re-read only when index.json changed on disk)."""
+        try:
+            st = self.index_path.stat()
+        except FileNotFoundError:
+            self._index, self._index_stamp = None, None
+            return None
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stamp != self._index_stamp:
+            self._index = json.loads(self.index_path.read_text(encoding="utf-8"))
+            self._index_stamp = stamp
+        return self._index
+
+    def exists(self) -> bool:
+        return self.index() is not None
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        ix = self.index()
+        return (int(ix["height"]), int(ix["width"])) if ix else (0, 0)
+
+    def _commit(self, ix: dict, drop: List[str]) -> None:
+        ix["version"] = int(ix.get("version", 0)) + 1
+        ix["updated"] = time.time()
+        write_atomic(self.index_path, json.dumps(ix, separators=(",", ":")).encode("utf-8"))
+        self._index, self._index_stamp = None, None
+        for name in drop:
+            try:
+                (self.root / name).unlink()
+            except FileNotFoundError:
+                pass
+
+    def create(self, width: int, height: int) -> None:
+        """Empty (all-zero) store of the given size; replaces any existing one."""
+        with self.lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            old = self.index() or {}
+            drop = [e["file"] for e in (old.get("chunks") or {}).values()]
+            ix = {"width": int(width), "height": int(height), "chunk": self.chunk,
+                  "dtype": "uint8", "version": int(old.get("version", 0)),
+                  "pixels": int(old.get("pixels", 0)) + 1, "chunks": {}, "meta": {}}
+            self._commit(ix, drop)
+
+    def ensure(self, width: int, height: int) -> None:
+        """create() unless the store already has this size."""
+        with self.lock:
+            if self.shape != (int(height), int(width)):
+                self.create(width, height)
+
+    # ---------- chunk geometry ----------
+    def chunk_grid(self) -> Tuple[int, int]:
+        h, w = self.shape
+        c = self.chunk
+        return (h + c - 1) // c, (w + c - 1) // c
+
+    def chunk_rect(self, cy: int, cx: int) -> Tuple[int, int, int, int]:
+        """(x, y, w, h) of chunk (cy, cx) in mask pixels."""
+        H, W = self.shape
+        c = self.chunk
+        x, y = cx * c, cy * c
+        return x, y, min(c, W - x), min(c, H - y)
+
+    def chunks_in(self, x: int, y: int, w: int, h: int):
+        c = self.chunk
+        for cy in range(y // c, (y + h - 1) // c + 1):
+            for cx in range(x // c, (x + w - 1) // c + 1):
+                yield cy, cx
+
+    # ---------- read ----------
+    def read_chunk(self, cy: int, cx: int, ix: Optional[dict] = None) -> np.ndarray:
+        """Decoded chunk (read-only view; copy before modifying)."""
+        ix = ix if ix is not None else self.index()
+        _, _, cw, ch = self.chunk_rect(cy, cx)
+        e = (ix.get("chunks") or {}).get(f"{cy}_{cx}") if ix else None
+        if not e:
+            return np.zeros((ch, cw), dtype=np.uint8)
+        key = (f"{cy}_{cx}", e["hash"])
+        with self._decoded_lock:
+            arr = self._decoded.get(key)
+            if arr is not None:
+                self._decoded.move_to_end(key)
+                return arr
+        raw = _decompress((self.root / e["file"]).read_bytes(), e["codec"])
+        arr = np.frombuffer(raw, dtype=np.uint8).reshape(ch, cw)
+        with self._decoded_lock:
+            self._decoded[key] = arr
+            if len(self._decoded) > _DECODED_MAX:
+                self._decoded.popitem(last=False)
+        return arr
+
+    def read_window(self, x: int, y: int, w: int, h: int) -> np.ndarray:
+        """(h, w) window; only the chunks it overlaps are read. Clipped to the mask."""
+        H, W = self.shape
+        x0, y0 = max(0, int(x)), max(0, int(y))
+        x1, y1 = min(W, int(x) + int(w)), min(H, int(y) + int(h))
+        if x1 <= x0 or y1 <= y0:
+            return np.zeros((0, 0), dtype=np.uint8)
+        out = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+        for attempt in range(2):
+            ix = self.index()   # one snapshot for the whole window
+            try:
+                for cy, cx in self.chunks_in(x0, y0, x1 - x0, y1 - y0):
+                    ox, oy, cw, ch = self.chunk_rect(cy, cx)
+                    ax0, ay0 = max(x0, ox), max(y0, oy)
+                    ax1, ay1 = min(x1, ox + cw), min(y1, oy + ch)
+                    out[ay0 - y0:ay1 - y0, ax0 - x0:ax1 - x0] = \
+                        self.read_chunk(cy, cx, ix)[ay0 - oy:ay1 - oy, ax0 - ox:ax1 - ox]
+                return out
+            except FileNotFoundError:
+                # a concurrent write swapped the index and removed an old chunk: re-read once
+                self._index_stamp = None
+                if attempt:
+                    raise
+        return out
+
+    @contextmanager
+    def snapshot(self) -> Iterator["ChunkedMaskStore"]:
+        """Read-only store frozen at the current version, for long reads without holding the lock.
+
+        Under the lock only index.json is copied and the chunk files are
+        hard-linked (no data is copied); the links keep superseded chunks alive
+        after a later save unlinks them. Removed on exit.
+        """
+        snap = self.root.parent / f".{self.root.name}.snap.{os.getpid()}.{threading.get_ident()}"
+        shutil.rmtree(snap, ignore_errors=True)
+        snap.mkdir(parents=True)
+        try:
+            with self.lock:
+                ix = self.index()
+                if ix is None:
+                    raise FileNotFoundError(str(self.index_path))
+                for e in (ix.get("chunks") or {}).values():
+                    try:
+                        os.link(self.root / e["file"], snap / e["file"])
+                    except OSError:
+                        shutil.copyfile(self.root / e["file"], snap / e["file"])
+                write_atomic(snap / INDEX_NAME, json.dumps(ix, separators=(",", ":")).encode("utf-8"))
+            yield ChunkedMaskStore(snap, chunk=int(ix.get("chunk") or self.chunk), levels=0)
+        finally:
+            shutil.rmtree(snap, ignore_errors=True)
+
+    def read_full(self) -> np.ndarray:
+        H, W = self.shape
+        return self.read_window(0, 0, W, H)
+
+    # ---------- write ----------
+    def meta(self) -> dict:
+        """Free-form metadata kept in the index (committed together with chunk writes)."""
+        return dict((self.index() or {}).get("meta") or {})
+
+    def update_meta(self, meta: dict) -> None:
+        """Merge keys into the index metadata without touching chunks."""
+        with self.lock:
+            ix = self.index()
+            if ix is None:
+                raise FileNotFoundError(f"mask store not initialised: {self.root}")
+            self._commit(dict(ix, meta={**(ix.get("meta") or {}), **meta}), [])
+
+    def write_window(self, x: int, y: int, arr: np.ndarray,
+                     meta: Optional[dict] = None) -> List[Tuple[int, int]]:
+        """Paste `arr` (uint8, h×w) at (x, y); rewrite only chunks whose content changed.
+
+        `meta` keys are merged into the index metadata in the same commit,
+        but only if some chunk changed. Returns the (cy, cx) of the chunks
+        that changed.
+        """
+        arr = np.asarray(arr, dtype=np.uint8)
+        h, w = arr.shape
+        with self.lock:
+            ix = self.index()
+            if ix is None:
+                raise FileNotFoundError(f"mask store not initialised: {self.root}")
+            H, W = self.shape
+            x, y = int(x), int(y)
+            if x < 0 or y < 0 or x + w > W or y + h > H:
+                raise ValueError(f"window {x},{y},{w}x{h} outside mask {W}x{H}")
+            chunks = dict(ix.get("chunks") or {})
+            changed, drop = [], []
+            for cy, cx in self.chunks_in(x, y, w, h):
+                ox, oy, cw, ch = self.chunk_rect(cy, cx)
+                ax0, ay0 = max(x, ox), max(y, oy)
+                ax1, ay1 = min(x + w, ox + cw), min(y + h, oy + ch)
+                src = arr[ay0 - y:ay1 - y, ax0 - x:ax1 - x]
+                if (ax1 - ax0, ay1 - ay0) == (cw, ch):
+                    new = np.ascontiguousarray(src)
+                else:
+                    new = self.read_chunk(cy, cx).copy()
+                    new[ay0 - oy:ay1 - oy, ax0 - ox:ax1 - ox] = src
+                key = f"{cy}_{cx}"
+                old = chunks.get(key)
+                if not new.any():
+                    if old:
+                        drop.append(old["file"])
+                        del chunks[key]
+                        changed.append((cy, cx))
+                    continue
+                raw = new.tobytes()
+                hsh = _digest(raw)
+                if old and old["hash"] == hsh:
+                    continue
+                codec, data = _compress(raw)
+                name = f"{key}_{hsh}.z"
+                write_atomic(self.root / name, data)
+                if old and old["file"] != name:
+                    drop.append(old["file"])
+                chunks[key] = {"hash": hsh, "codec": codec, "file": name, "bytes": len(data),
+                               "hist": _hist(new).tolist()}
+                changed.append((cy, cx))
+            if changed:
+                base = int(ix.get("pixels", 0))
+                ix = dict(ix, chunks=chunks, pixels=base + 1)   # pixel edits only; levels track this
+                if meta:
+                    ix["meta"] = {**(ix.get("meta") or {}), **meta}
+                self._commit(ix, drop)
+                if self.levels:
+                    c = self.chunk
+                    x0 = min(cx for _, cx in changed) * c; y0 = min(cy for cy, _ in changed) * c
+                    x1 = min(W, (max(cx for _, cx in changed) + 1) * c)
+                    y1 = min(H, (max(cy for cy, _ in changed) + 1) * c)
+                    self._sync_levels(base, (x0, y0, x1, y1))
+            return changed
+
+    def write_full(self, arr: np.ndarray) -> List[Tuple[int, int]]:
+        """Replace the whole mask; the store is (re)created if the size differs."""
+        arr = np.asarray(arr, dtype=np.uint8)
+        with self.lock:
+            if self.shape != arr.shape:
+                self.create(arr.shape[1], arr.shape[0])
+            return self.write_window(0, 0, arr)
+
+    # ---------- pyramid ----------
+    def level(self, k: int) -> "ChunkedMaskStore":
+        """Store of pyramid level k (1..levels); not synced — use read_level()."""
+        st = self._level_stores.get(k)
+        if st is None:
+            st = self._level_stores[k] = ChunkedMaskStore(self.root / "levels" / f"L{k}", self.chunk, levels=0)
+        return st
+
+    def _sync_levels(self, base: int, rect: Optional[Tuple[int, int, int, int]] = None) -> None:
+        """Bring levels to the current pixels (caller holds self.lock).
+
+        Levels recorded at `base` only get `rect` (x0, y0, x1, y1 in level-0
+        pixels) recomputed; any other level is rebuilt whole.
+        """
+        H, W = self.shape
+        cur = int((self.index() or {}).get("pixels", 0))
+        prev: "ChunkedMaskStore" = self
+        for k in range(1, self.levels + 1):
+            lv = self.level(k)
+            hk, wk = -(-H // (1 << k)), -(-W // (1 << k))
+            with lv.lock:
+                if not (rect is not None and lv.shape == (hk, wk) and lv.meta().get("base") == base):
+                    lv.ensure(wk, hk)
+                    ph, pw = prev.shape
+                    rect = (0, 0, pw, ph)   # rebuild the whole level (and the ones below it)
+                x0, y0, x1, y1 = rect
+                x0, y0 = x0 & ~1, y0 & ~1   # whole 2×2 blocks of the level above
+                changed = False
+                step = 2 * self.chunk       # row strips keep memory at a few chunk rows
+                for sy in range(y0, y1, step):
+                    src = prev.read_window(x0, sy, x1 - x0, min(step, y1 - sy))
+                    changed |= bool(lv.write_window(x0 // 2, sy // 2, mode2x2(src), meta={"base": cur}))
+                if not changed:
+                    lv.update_meta({"base": cur})
+                rect = (x0 // 2, y0 // 2, -(-x1 // 2), -(-y1 // 2))
+            prev = lv
+
+    def read_level(self, k: int, x: int = 0, y: int = 0,
+                   w: Optional[int] = None, h: Optional[int] = None) -> np.ndarray:
+        """Window of pyramid level k in level-k pixels (k = 0 is the mask itself)."""
+        if k <= 0:
+            H, W = self.shape
+            return self.read_window(x, y, W if w is None else w, H if h is None else h)
+        if k > self.levels:
+            raise ValueError(f"store keeps {self.levels} pyramid levels")
+        lv = self.level(k)
+        ix = self.index()
+        if ix is None:
+            return np.zeros((0, 0), dtype=np.uint8)
+        if lv.meta().get("base") != int(ix.get("pixels", 0)):
+            with self.lock:
+                if lv.meta().get("base") != int((self.index() or {}).get("pixels", 0)):
+                    self._sync_levels(-1)
+        lh, lw = lv.shape
+        return lv.read_window(x, y, lw if w is None else w, lh if h is None else h)
+
+    # ---------- class histograms ----------
+    def chunk_hist(self, cy: int, cx: int, ix: Optional[dict] = None) -> np.ndarray:
+        """Class counts of one chunk from the index (decoded only for entries written before histograms)."""
+        ix = ix if ix is not None else self.index()
+        e = (ix.get("chunks") or {}).get(f"{cy}_{cx}") if ix else None
+        if e and "hist" in e:
+            return np.asarray(e["hist"], dtype=np.int64)
+        if e:
+            return _hist(self.read_chunk(cy, cx, ix)).astype(np.int64)
+        _, _, cw, ch = self.chunk_rect(cy, cx)
+        h = np.zeros(len(settings.CLASS_LIST) or 1, dtype=np.int64)
+        h[0] = cw * ch
+        return h
+
+    def histogram(self, x: int = 0, y: int = 0, w: Optional[int] = None, h: Optional[int] = None) -> np.ndarray:
+        """Class counts inside a window (whole mask by default).
+
+        Chunks fully inside the window are summed from their stored
+        histograms; only chunks cut by the window edge are decoded.
+        """
+        ix = self.index()
+        out = np.zeros(len(settings.CLASS_LIST) or 1, dtype=np.int64)
+        if ix is None:
+            return out
+        full = (x, y, w, h) == (0, 0, None, None)
+        if full and self._hist_full is not None and self._hist_full[0] == ix.get("version"):
+            return self._hist_full[1].copy()
+        H, W = self.shape
+        x0, y0 = max(0, int(x)), max(0, int(y))
+        x1 = W if w is None else min(W, int(x) + int(w))
+        y1 = H if h is None else min(H, int(y) + int(h))
+        if x1 <= x0 or y1 <= y0:
+            return out
+        for cy, cx in self.chunks_in(x0, y0, x1 - x0, y1 - y0):
+            ox, oy, cw, ch = self.chunk_rect(cy, cx)
+            if ox >= x0 and oy >= y0 and ox + cw <= x1 and oy + ch <= y1:
+                out = _add(out, self.chunk_hist(cy, cx, ix))
+            else:
+                ax0, ay0 = max(x0, ox), max(y0, oy)
+                ax1, ay1 = min(x1, ox + cw), min(y1, oy + ch)
+                part = self.read_chunk(cy, cx, ix)[ay0 - oy:ay1 - oy, ax0 - ox:ax1 - ox]
+                out = _add(out, _hist(part))
+        if full:
+            self._hist_full = (ix.get("version"), out.copy())
+        return out
+
+    def stats(self) -> dict:
+        ix = self.index() or {}
+        ch = ix.get("chunks") or {}
+        gy, gx = self.chunk_grid() if ix else (0, 0)
+        return {"width": ix.get("width", 0), "height": ix.get("height", 0), "chunk": ix.get("chunk", self.chunk),
+                "version": ix.get("version", 0), "chunks_total": gy * gx, "chunks_stored": len(ch),
+                "bytes": sum(int(e.get("bytes", 0)) for e in ch.values())}
+
+
+_SCENE_STORE: Optional[ChunkedMaskStore] = None
+
+
+def scene_mask_store() -> ChunkedMaskStore:
+    """Store behind the whole-scene mask (settings.MASK_STORE_DIR), shared per process."""
+    global _SCENE_STORE
+    if _SCENE_STORE is None or _SCENE_STORE.root != settings.MASK_STORE_DIR:
+        _SCENE_STORE = ChunkedMaskStore(settings.MASK_STORE_DIR)
+    return _SCENE_STORE
@@ -1,17 +1,155 @@
 from __future__ import annotations
+import threading
+import zlib
+from typing import Optional
+
 import numpy as np
 from PIL import Image
 from config import settings
+from services.mask_artifacts import schedule_mask_artifacts, write_overlay_png
+from services.mask_store import ChunkedMaskStore, scene_mask_store
+
+# zstd اختیاری است؛ اگر نصب نباشد فقط deflate
+try:
+    import zstandard as zstd
+except Exception:
+    zstd = None
+
+_FULL_LOCK = threading.Lock()
+_FULL_CACHE: dict = {}   # (store version, w, h) → resized full-frame mask
+
+
+def _scene_store() -> ChunkedMaskStore:
+    """Chunked store of the scene mask; an existing mask.png is imported once."""
+    st = scene_mask_store()
+    if not st.exists() and settings.MASK_PNG.exists():
+        with _FULL_LOCK:
+            if not st.exists():
+                m = np.array(Image.open(settings.MASK_PNG).convert('L'), dtype=np.uint8)
+                st.write_full(m)
+                print(f"[masks] imported {settings.MASK_PNG.name} into {st.root.name} ({m.shape[1]}x{m.shape[0]})")
+    return st
 
 
 def load_mask(w: int, h: int) -> np.ndarray:
-    """Load mask.png (uint8), resize to (w,h) with NEAREST; return array (h,w)."""
-    if settings.MASK_PNG.exists():
-        m = Image.open(settings.MASK_PNG).convert('L')
-        if m.size != (w, h):
-            m = m.resize((w, h), Image.NEAREST)
-        return np.array(m, dtype=np.uint8)
-    return np.zeros((h, w), dtype=np.uint8)
+    """Scene mask (uint8) resized to (w,h) with NEAREST; return array (h,w)."""
+    st = _scene_store()
+    if not st.exists():
+        return np.zeros((h, w), dtype=np.uint8)
+    H, W = st.shape
+    # smallest pyramid level still at least (w, h) → resize from there instead of the full mask
+    k = 0
+    while k < st.levels and (W >> (k + 1)) >= w and (H >> (k + 1)) >= h:
+        k += 1
+    m = st.read_level(k)
+    if m.shape != (h, w):
+        m = np.array(Image.fromarray(m, mode='L').resize((w, h), Image.NEAREST), dtype=np.uint8)
+    return m
+
+
+def _full_mask_cached(w: int, h: int) -> np.ndarray:
+    """load_mask(w, h) for a store of another size, resized once per store version."""
+    key = ((_scene_store().index() or {}).get("version"), w, h)
+    with _FULL_LOCK:
+        if key not in _FULL_CACHE:
+            _FULL_CACHE.clear()
+            _FULL_CACHE[key] = load_mask(w, h)
+        return _FULL_CACHE[key]
+
+
+def mask_window(W: int, H: int, x: int = 0, y: int = 0,
+                w: Optional[int] = None, h: Optional[int] = None, level: int = 0) -> np.ndarray:
+    """Window of the W×H scene mask in level-0 pixels, clipped to the scene.
+
+    Only the store chunks overlapping the window are decoded. level > 0
+    returns the window downsampled by 2**level: read from the store's mode
+    pyramid (window snapped to the level grid) where it has that level,
+    otherwise subsampled (nearest). Returns a contiguous uint8 (h', w') array.
+    """
+    return mask_window_at(W, H, x, y, w, h, level)[0]
+
+
+def mask_window_at(W: int, H: int, x: int = 0, y: int = 0,
+                   w: Optional[int] = None, h: Optional[int] = None, level: int = 0):
+    """mask_window() plus the level-0 (x, y) its first pixel really starts at (after snapping)."""
+    x0, y0 = max(0, int(x)), max(0, int(y))
+    x1 = min(W, x0 + (W if w is None else int(w)))
+    y1 = min(H, y0 + (H if h is None else int(h)))
+    if x1 <= x0 or y1 <= y0:
+        return np.zeros((0, 0), dtype=np.uint8), (x0, y0)
+    s = 1 << max(0, min(int(level), 8))
+    st = _scene_store()
+    if not st.exists():
+        return np.zeros(((y1 - y0 + s - 1) // s, (x1 - x0 + s - 1) // s), dtype=np.uint8), (x0, y0)
+    if st.shape == (H, W):
+        k = min(max(0, int(level)), st.levels, 8)
+        if k:
+            lx0, ly0 = x0 >> k, y0 >> k
+            win = st.read_level(k, lx0, ly0, -(-x1 >> k) - lx0, -(-y1 >> k) - ly0)
+            s >>= k
+            x0, y0 = lx0 << k, ly0 << k
+        else:
+            win = st.read_window(x0, y0, x1 - x0, y1 - y0)
+    else:
+        win = _full_mask_cached(W, H)[y0:y1, x0:x1]
+    return np.ascontiguousarray(win[::s, ::s]), (x0, y0)
+
+
+def mask_class_counts(W: int, H: int) -> np.ndarray:
+    """Per-class pixel counts of the W×H scene mask (store histograms; resized mask only on size mismatch)."""
+    st = _scene_store()
+    ncls = len(settings.CLASS_LIST) or 1
+    if not st.exists():
+        out = np.zeros(ncls, dtype=np.int64)
+        out[0] = W * H
+        return out
+    if st.shape == (H, W):
+        return st.histogram()
+    return np.bincount(_full_mask_cached(W, H).ravel(), minlength=ncls)
+
+
+def pick_encoding(accept_encoding: str) -> Optional[str]:
+    """Best content-coding we can produce for raw label bytes: zstd > deflate > identity."""
+    acc = {p.split(";")[0].strip().lower(): ("q=0" not in p.replace(" ", "")) for p in (accept_encoding or "").split(",")}
+    if zstd is not None and acc.get("zstd"):
+        return "zstd"
+    if acc.get("deflate"):
+        return "deflate"
+    return None
+
+
+def encode_body(raw: bytes, encoding: Optional[str]) -> bytes:
+    """Compress raw label bytes (class indices compress very well at low levels)."""
+    if encoding == "zstd":
+        return zstd.ZstdCompressor(level=3).compress(raw)
+    if encoding == "deflate":
+        return zlib.compress(raw, 1)
+    return raw
+
+
+def decode_body(data: bytes, encoding: Optional[str], max_size: Optional[int] = None) -> bytes:
+    """Undo a request Content-Encoding; with max_size, output beyond it raises ValueError."""
+    enc = (encoding or "").strip().lower()
+    if enc in ("", "identity"):
+        return data
+    limit = int(max_size) + 1 if max_size else 0
+    if enc in ("deflate", "gzip"):
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS if enc == "gzip" else zlib.MAX_WBITS)
+        try:
+            out = d.decompress(data, limit)
+        except zlib.error as e:
+            raise ValueError(f"bad {enc} body: {e}")
+        if max_size and len(out) > max_size:
+            raise ValueError(f"decoded body larger than {max_size} bytes")
+        return out
+    if enc == "zstd":
+        if zstd is None:
+            raise ValueError("zstd not available on server")
+        try:
+            return zstd.ZstdDecompressor().decompress(data, max_output_size=max_size or (1 << 31))
+        except zstd.ZstdError as e:
+            raise ValueError(f"bad zstd body: {e}")
+    raise ValueError(f"unsupported encoding: {encoding}")
 
 
 def mask_bytes(w:int, h:int) -> bytes:
@@ -19,26 +157,32 @@ def mask_bytes(w:int, h:int) -> bytes:
     return load_mask(w, h).tobytes()
 
 
+def save_mask_array(mask: np.ndarray) -> int:
+    """Store the full scene mask; only changed chunks are rewritten.
+
+    Returns once the chunks are durable. mask.png, mask_vis_debug.png and
+    mask_overlay.png are derived files, re-rendered in the background
+    (services.mask_artifacts) when something changed.
+    Returns the number of changed chunks.
+    """
+    mask = np.ascontiguousarray(mask, dtype=np.uint8)
+    changed = _scene_store().write_full(mask)
+    if changed or not settings.MASK_PNG.exists():
+        schedule_mask_artifacts()
+    return len(changed)
+
+
 def save_mask_bytes(raw: bytes, w:int, h:int):
-    """Save raw bytes (h*w) to mask.png as L (uint8)."""
+    """Save raw bytes (h*w, uint8) into the chunked mask store."""
     if not raw:
         return False, 'no data'
     arr = np.frombuffer(raw, dtype=np.uint8)
     if arr.size != w*h:
         return False, f'size mismatch: got {arr.size}, expected {w*h}'
-    mask = arr.reshape((h, w))
-    Image.fromarray(mask, mode='L').save(settings.MASK_PNG, optimize=False)
-    Image.fromarray((mask>0).astype(np.uint8)*255, mode='L')\
-     .save(settings.OUTPUT_DIR / 'mask_vis_debug.png', optimize=False)
+    save_mask_array(arr.reshape((h, w)))
     return True, 'ok'
 
 
 def write_mask_overlay(mask: np.ndarray):
-    """Create colored RGBA preview: 0=transparent, 1=green, 2=brown."""
-    h, w = mask.shape
-    rgba = np.zeros((h, w, 4), dtype=np.uint8)
-    g = (mask == 1)
-    rgba[g, 1] = 255; rgba[g, 3] = 170
-    b = (mask == 2)
-    rgba[b, 0] = 139; rgba[b, 1] = 69; rgba[b, 2] = 19; rgba[b, 3] = 170
-    Image.fromarray(rgba, mode='RGBA').save(settings.OUTPUT_DIR / "mask_overlay.png")
\ No newline at end of file
+    """Colored preview of the mask: 8-bit palette PNG, colours/alpha from CLASS_LIST, 0=transparent."""
+    write_overlay_png(mask, settings.OUTPUT_DIR / "mask_overlay.png")
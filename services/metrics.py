@@ -0,0 +1,211 @@
+# services/metrics.py
+"""
+In-process request/job metrics with a Prometheus text exposition.
+
+install_metrics(app) adds:
+  - per-endpoint latency histogram, request counter (by status), response
+    bytes and in-flight gauge; endpoint = Flask endpoint ("api.api_grid_tile"),
+    blueprint = its blueprint name ("api", "masks", "project2_bp", …)
+  - GET /metrics in text format 0.0.4 (no prometheus_client dependency)
+  - optional sampled cProfile: METRICS_PROFILE_SAMPLE of requests are
+    profiled and dumped to output/profiles/ when slower than
+    METRICS_PROFILE_SLOW_MS
+
+Job stages are timed by services.progress (every phase change closes the
+previous stage) or explicitly with ``with stage_timer("kind", "stage"):``.
+Counters are per process; with several workers scrape each one or sum.
+"""
+from __future__ import annotations
+
+import cProfile
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Tuple
+
+from config import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STAGE_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+_LOCK = threading.Lock()
+_T_START = time.time()
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float) -> None:
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+
+_REQ_TOTAL: Dict[Tuple[str, str, str, str], int] = defaultdict(int)     # (bp, endpoint, method, status)
+_REQ_LATENCY: Dict[Tuple[str, str, str], _Histogram] = {}               # (bp, endpoint, method)
+_RESP_BYTES: Dict[Tuple[str, str], int] = defaultdict(int)              # (bp, endpoint)
+_IN_FLIGHT: Dict[Tuple[str, str], int] = defaultdict(int)
+_STAGES: Dict[Tuple[str, str], _Histogram] = {}                         # (kind, stage)
+
+
+# -------------- recording --------------
+
+def observe_request(bp: str, endpoint: str, method: str, status: int, seconds: float, nbytes: int) -> None:
+    with _LOCK:
+        _REQ_TOTAL[(bp, endpoint, method, str(status))] += 1
+        h = _REQ_LATENCY.get((bp, endpoint, method))
+        if h is None:
+            h = _REQ_LATENCY[(bp, endpoint, method)] = _Histogram(LATENCY_BUCKETS)
+        h.observe(seconds)
+        _RESP_BYTES[(bp, endpoint)] += max(0, int(nbytes or 0))
+
+
+def observe_stage(kind: str, stage: str, seconds: float) -> None:
+    with _LOCK:
+        h = _STAGES.get((kind, stage))
+        if h is None:
+            h = _STAGES[(kind, stage)] = _Histogram(STAGE_BUCKETS)
+        h.observe(seconds)
+
+
+@contextmanager
+def stage_timer(kind: str, stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(kind, stage, time.perf_counter() - t0)
+
+
+def _in_flight(key: Tuple[str, str], d: int) -> None:
+    with _LOCK:
+        _IN_FLIGHT[key] += d
+
+
+# -------------- exposition --------------
+
+def _esc(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**kw) -> str:
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in kw.items()) + "}"
+
+
+def _hist_lines(name: str, h: _Histogram, **lab) -> list:
+    out, acc = [], 0
+    for le, n in zip(list(h.buckets) + ["+Inf"], h.counts):
+        acc += n
+        out.append(f"{name}_bucket{_labels(**lab, le=le)} {acc}")
+    out.append(f"{name}_sum{_labels(**lab)} {h.sum:.6f}")
+    out.append(f"{name}_count{_labels(**lab)} {h.count}")
+    return out
+
+
+def render_prometheus() -> str:
+    with _LOCK:
+        lines = [
+            "# HELP app_uptime_seconds Seconds since the metrics module was loaded.",
+            "# TYPE app_uptime_seconds gauge",
+            f"app_uptime_seconds {time.time() - _T_START:.1f}",
+            "# HELP http_requests_total Requests by blueprint, endpoint, method and status.",
+            "# TYPE http_requests_total counter",
+        ]
+        for (bp, ep, m, st), n in sorted(_REQ_TOTAL.items()):
+            lines.append(f"http_requests_total{_labels(blueprint=bp, endpoint=ep, method=m, status=st)} {n}")
+        lines += ["# HELP http_request_duration_seconds Time until the view returned a response.",
+                  "# TYPE http_request_duration_seconds histogram"]
+        for (bp, ep, m), h in sorted(_REQ_LATENCY.items()):
+            lines += _hist_lines("http_request_duration_seconds", h, blueprint=bp, endpoint=ep, method=m)
+        lines += ["# HELP http_response_bytes_total Response body bytes (Content-Length when known).",
+                  "# TYPE http_response_bytes_total counter"]
+        for (bp, ep), n in sorted(_RESP_BYTES.items()):
+            lines.append(f"http_response_bytes_total{_labels(blueprint=bp, endpoint=ep)} {n}")
+        lines += ["# HELP http_requests_in_flight Requests currently being handled.",
+                  "# TYPE http_requests_in_flight gauge"]
+        for (bp, ep), n in sorted(_IN_FLIGHT.items()):
+            lines.append(f"http_requests_in_flight{_labels(blueprint=bp, endpoint=ep)} {n}")
+        lines += ["# HELP job_stage_duration_seconds Duration of background/job stages (progress phases).",
+                  "# TYPE job_stage_duration_seconds histogram"]
+        for (kind, stage), h in sorted(_STAGES.items()):
+            lines += _hist_lines("job_stage_duration_seconds", h, kind=kind, stage=stage)
+    return "\n".join(lines) + "\n"
+
+
+# -------------- Flask integration --------------
+
+def _keys(request) -> Tuple[str, str]:
+    ep = request.endpoint or "unmatched"   # 404s share one series instead of one per URL
+    return (request.blueprint or "app"), ep
+
+
+def _dump_profile(prof: cProfile.Profile, endpoint: str, seconds: float) -> None:
+    out = Path(settings.OUTPUT_DIR) / "profiles"
+    out.mkdir(parents=True, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}_{re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint)}_{int(seconds * 1000)}ms.prof"
+    prof.dump_stats(str(out / name))
+    print(f"[metrics] slow request {endpoint} {seconds * 1000:.0f} ms → profiles/{name}")
+
+
+def install_metrics(app) -> None:
+    from flask import Response, g, request, abort
+
+    @app.before_request
+    def _metrics_start():
+        g._m_t0 = time.perf_counter()
+        g._m_key = _keys(request)
+        _in_flight(g._m_key, +1)
+        rate = float(settings.METRICS_PROFILE_SAMPLE or 0.0)
+        if rate > 0 and random.random() < rate:
+            try:
+                g._m_prof = cProfile.Profile()
+                g._m_prof.enable()
+            except Exception:
+                g._m_prof = None
+
+    @app.after_request
+    def _metrics_record(resp):
+        t0 = g.pop("_m_t0", None)
+        if t0 is None:
+            return resp
+        secs = time.perf_counter() - t0
+        bp, ep = g.get("_m_key") or _keys(request)
+        nbytes = resp.content_length if resp.content_length is not None else 0
+        observe_request(bp, ep, request.method, resp.status_code, secs, nbytes)
+        prof = g.pop("_m_prof", None)
+        if prof is not None:
+            prof.disable()
+            if secs * 1000 >= float(settings.METRICS_PROFILE_SLOW_MS):
+                try:
+                    _dump_profile(prof, ep, secs)
+                except Exception as e:
+                    print("[metrics] profile dump failed:", e)
+        return resp
+
+    @app.teardown_request
+    def _metrics_done(exc=None):
+        key = g.pop("_m_key", None)
+        if key is not None:
+            _in_flight(key, -1)
+        prof = g.pop("_m_prof", None)
+        if prof is not None:
+            prof.disable()
+
+    def metrics_view():
+        token = settings.METRICS_TOKEN
+        if token and request.headers.get("Authorization", "") != f"Bearer {token}":
+            abort(403)
+        return Response(render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    app.add_url_rule("/metrics", "metrics", metrics_view, methods=["GET"])
@@ -6,7 +6,7 @@ import numpy as np
 from PIL import Image
 from config import settings
 from services.progress import set_progress
-from services.s2 import _jp2, _read_band_l2a  # از کد خودت استفاده می‌کنیم
+from services.s2 import _jp2, _read_band_l2a, backdrop_meta  # از کد خودت استفاده می‌کنیم
 
 # تلاش برای ONNX؛ اگر نصب نیست، بعداً پلن B: torch
 try:
@@ -189,19 +189,14 @@ def run_model_inference():
 
     # resize به اندازه‌ی backdrop (در صورت نیاز)
     set_progress("model_save", 92, "ذخیره ماسک")
-    if settings.BACKDROP_IMAGE.exists():
-        Wb, Hb = Image.open(settings.BACKDROP_IMAGE).size
+    if settings.S2_RGB_TIF.exists() or settings.BACKDROP_IMAGE.exists():
+        Wb, Hb = backdrop_meta()
         if (W, H) != (Wb, Hb):
             pred = np.array(Image.fromarray(pred, mode='L').resize((Wb, Hb), Image.NEAREST))
 
-    Image.fromarray(pred, mode='L').save(settings.MASK_PNG, optimize=False)
-
-    # اوورلی
-    try:
-        from services.masks import write_mask_overlay
-        write_mask_overlay(pred)
-    except Exception as e:
-        print("[WARN] overlay failed:", e)
+    # mask.png و اوورلی در پس‌زمینه ساخته می‌شوند (services.mask_artifacts)
+    from services.masks import save_mask_array
+    save_mask_array(pred)
 
     nz = int((pred>0).sum())
     set_progress("done", 100, f"پایان (پیکسل غیرصفر: {nz:,})")
@@ -0,0 +1,160 @@
+# services/mosaic.py
+"""
+Scene label mosaic → palette-coloured Cloud Optimized GeoTIFF.
+
+For every grid tile the latest saved mask (services.mask_index) is taken —
+of one annotator, or the newest over all annotators — and written at the
+tile's pixel rect into a tiled GeoTIFF on the scene grid, one tile at a
+time, so the full mosaic is never in memory. "labels" entries are read from
+the annotator's chunked label store; "png" entries are RGBA canvases from
+/api/masks/save_tile_png and are mapped back to class ids by colour
+(CLASS_LIST). Overviews are built with mode resampling (no invented
+classes), and GDAL's COG driver copies the result with its overviews and
+colour table block by block.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from affine import Affine
+from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from config import settings
+from services.mask_artifacts import class_palette
+from services.fsutil import safe_name, tmp_path
+from services.mask_history import blob_path
+from services.mask_index import scene_latest
+from services.progress import set_progress
+from services.s2 import load_grid_manifest
+from services.tile_masks import read_tile_classes
+from services.vectorize import export_dir
+
+BLOCK = 512
+
+_LOCKS: Dict[str, threading.Lock] = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+def _export_lock(key: str) -> threading.Lock:
+    with _LOCKS_GUARD:
+        return _LOCKS.setdefault(key, threading.Lock())
+
+
+def mosaic_path(scene_id: str, user_id=None) -> Path:
+    who = "latest" if user_id is None else f"u{safe_name(user_id)}"
+    return export_dir(scene_id) / f"labels_{who}.tif"
+
+
+def latest_per_tile(scene_id: str, user_id=None) -> Dict[Tuple[int, int], Tuple[str, dict]]:
+    """(r, c) → (user, latest entry): the given user's, or the newest of any user."""
+    out: Dict[Tuple[int, int], Tuple[str, dict]] = {}
+    for (r, c, user), e in scene_latest(scene_id).items():
+        if user_id is not None and user != safe_name(user_id):
+            continue
+        key = (int(r), int(c))
+        if key not in out or e.get("ts", 0) > out[key][1].get("ts", 0):
+            out[key] = (user, e)
+    return out
+
+
+def rgba_to_classes(rgba: np.ndarray) -> np.ndarray:
+    """Class ids of a brush canvas: transparent → 0, otherwise the nearest CLASS_LIST colour."""
+    pal, _ = class_palette()
+    ids = [int(c.get("id", i)) for i, c in enumerate(settings.CLASS_LIST)]
+    cols = np.array([pal[i * 3:i * 3 + 3] for i in ids], dtype=np.int32)
+    rgb = rgba[..., :3].astype(np.uint32)
+    packed = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+    # distances only for the distinct colours of the tile (a handful, plus anti-aliased edges)
+    uniq, inv = np.unique(packed, return_inverse=True)
+    u = np.stack([(uniq >> 16) & 255, (uniq >> 8) & 255, uniq & 255], axis=1).astype(np.int32)
+    nearest = np.asarray(ids, dtype=np.uint8)[((u[:, None, :] - cols[None]) ** 2).sum(-1).argmin(1)]
+    out = nearest[inv.reshape(packed.shape)]
+    out[rgba[..., 3] == 0] = 0
+    return out
+
+
+def _tile_classes(scene_id: str, user: str, e: dict, r: int, c: int, w: int, h: int) -> Optional[np.ndarray]:
+    if e.get("kind") == "png":
+        p = blob_path(scene_id, e["hash"])
+        if not p.exists():
+            return None
+        with Image.open(p) as im:
+            arr = rgba_to_classes(np.asarray(im.convert("RGBA")))
+        out = np.zeros((h, w), dtype=np.uint8)
+        hh, ww = min(h, arr.shape[0]), min(w, arr.shape[1])
+        out[:hh, :ww] = arr[:hh, :ww]
+        return out
+    try:
+        return read_tile_classes(scene_id, user, r, c)[0]
+    except LookupError:
+        return None
+
+
+def _overview_factors(W: int, H: int) -> list:
+    f, out = 2, []
+    while max(W, H) / f >= BLOCK // 2:
+        out.append(f)
+        f *= 2
+    return out
+
+
+def build_label_mosaic(scene_id: str, user_id=None) -> dict:
+    """Write EXPORTS_DIR/<scene>/labels_<user|latest>.tif (COG, palette, mode overviews)."""
+    man = load_grid_manifest(scene_id)
+    if not man:
+        raise LookupError("tiles not found")
+    W, H = int(man["W"]), int(man["H"])
+    picks = latest_per_tile(scene_id, user_id)
+    if not picks:
+        raise LookupError("no saved masks")
+    out = mosaic_path(scene_id, user_id)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_name(f".{out.stem}.{threading.get_ident()}.work.tif")
+    pal, trns = class_palette(alpha=255)
+    cmap = {i: (pal[i * 3], pal[i * 3 + 1], pal[i * 3 + 2], trns[i]) for i in range(256)}
+    profile = {
+        "driver": "GTiff", "width": W, "height": H, "count": 1, "dtype": "uint8",
+        "crs": man.get("crs"), "transform": Affine(*man["transform"][:6]) if man.get("transform") else None,
+        "tiled": True, "blockxsize": BLOCK, "blockysize": BLOCK, "compress": "deflate",
+        "photometric": "palette",
+    }
+    t0 = time.perf_counter()
+    written = 0
+    with _export_lock(str(out)):
+        try:
+            with rasterio.open(tmp, "w", **profile) as dst:
+                dst.write_colormap(1, cmap)
+                tiles = man.get("tiles", [])
+                for i, t in enumerate(tiles):
+                    r, c = int(t["r"]), int(t["c"])
+                    if (r, c) in picks:
+                        user, e = picks[(r, c)]
+                        arr = _tile_classes(scene_id, user, e, r, c, int(t["w"]), int(t["h"]))
+                        if arr is not None:
+                            dst.write(arr, 1, window=Window(int(t["x"]), int(t["y"]), arr.shape[1], arr.shape[0]))
+                            written += 1
+                    set_progress("mosaic", 80.0 * (i + 1) / max(1, len(tiles)), f"tiles {i + 1}/{len(tiles)}")
+            with rasterio.open(tmp, "r+") as dst:
+                set_progress("mosaic", 85, "overviews")
+                dst.build_overviews(_overview_factors(W, H), Resampling.mode)
+                dst.update_tags(ns="rio_overview", resampling="mode")
+            set_progress("mosaic", 92, "cog")
+            cog = tmp_path(out)
+            rasterio.shutil.copy(tmp, cog, driver="COG", compress="DEFLATE", blocksize=BLOCK,
+                                 overviews="FORCE_USE_EXISTING")
+            os.replace(cog, out)
+        finally:
+            tmp.unlink(missing_ok=True)
+    dt = time.perf_counter() - t0
+    print(f"[mosaic] {scene_id}/{'latest' if user_id is None else user_id}: {written} tiles in {dt:.2f}s → {out.name}")
+    set_progress("done", 100, f"{written} tiles")
+    return {"path": str(out), "tiles": written, "width": W, "height": H, "seconds": round(dt, 3)}
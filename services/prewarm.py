@@ -0,0 +1,163 @@
+# services/prewarm.py
+"""
+Background scene pre-warming.
+
+Assigning a scene (admin) or the sweep of all assigned scenes enqueues it
+here; a single low-priority worker thread builds the per-scene cache
+(services.s2.prepare_scene_artifacts) so the annotator's first select only
+has to link the cached files into place.
+
+The sweep runs in one process of its own, not in every web worker:
+
+    flask --app app prewarm sweep      # once (e.g. from cron)
+    flask --app app prewarm nightly    # foreground loop at PREWARM_NIGHTLY_HOUR
+
+Builds of the same scene take turns across processes (services.s2._scene_lock).
+"""
+from __future__ import annotations
+
+import itertools
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Set
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from config import settings
+from services.progress import progress_job, set_progress
+from services.s2 import (
+    _scene_lock, get_scene_by_id, prepare_scene_artifacts, warm_artifacts,
+)
+
+PRIORITY_ASSIGN = 10
+PRIORITY_SWEEP = 20
+
+_Q: "queue.PriorityQueue[tuple[int, int, str]]" = queue.PriorityQueue()
+_SEQ = itertools.count()
+_PENDING: Set[str] = set()
+_LOCK = threading.Lock()
+_WORKER: Optional[threading.Thread] = None
+_CURRENT: Optional[str] = None
+
+def _lower_thread_priority() -> None:
+    """nice() only this thread (Linux: setpriority on the thread id)."""
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), int(settings.PREWARM_NICE))
+    except Exception:
+        pass
+
+def _prewarm_one(scene_id: str) -> None:
+    item = get_scene_by_id(scene_id)
+    if not item:
+        print(f"[prewarm] unknown scene {scene_id}, skipped")
+        return
+    if item.kind != "zip":
+        return  # SAFE folders are prepared on select only
+    with progress_job(f"prewarm:{scene_id}"):
+        with _scene_lock(item.id):
+            if warm_artifacts(item):
+                set_progress("done", 100, "Already warm")
+                return
+            t0 = time.perf_counter()
+            try:
+                prepare_scene_artifacts(item)
+            except Exception as e:
+                set_progress("error", 100, str(e))
+                print(f"[prewarm] {item.name} failed:", e)
+                return
+        set_progress("done", 100, "Warm")
+        print(f"[prewarm] {item.name} ready in {time.perf_counter() - t0:.1f}s")
+
+def _worker() -> None:
+    global _CURRENT
+    _lower_thread_priority()
+    while True:
+        _, _, scene_id = _Q.get()
+        with _LOCK:
+            _PENDING.discard(scene_id)
+            _CURRENT = scene_id
+        try:
+            _prewarm_one(scene_id)
+        finally:
+            with _LOCK:
+                _CURRENT = None
+            _Q.task_done()
+
+def _ensure_worker() -> None:
+    global _WORKER
+    with _LOCK:
+        if _WORKER is None or not _WORKER.is_alive():
+            _WORKER = threading.Thread(target=_worker, name="scene-prewarm", daemon=True)
+            _WORKER.start()
+
+def enqueue_prewarm(scene_id: str, priority: int = PRIORITY_ASSIGN) -> bool:
+    """Queue a scene for background preparation; False if disabled or already queued."""
+    if not settings.PREWARM_ENABLED or not scene_id:
+        return False
+    with _LOCK:
+        if scene_id in _PENDING or scene_id == _CURRENT:
+            return False
+        _PENDING.add(scene_id)
+    _Q.put((int(priority), next(_SEQ), scene_id))
+    _ensure_worker()
+    return True
+
+def prewarm_status() -> dict:
+    with _LOCK:
+        return {"current": _CURRENT, "pending": sorted(_PENDING)}
+
+# -------------- nightly sweep --------------
+
+def sweep_assigned(app) -> int:
+    """Enqueue every assigned scene that is not warm yet. Returns how many were queued."""
+    from models import db, AssignedTile
+    with app.app_context():
+        ids = [sid for (sid,) in db.session.query(AssignedTile.scene_id).distinct()]
+    n = 0
+    for sid in ids:
+        item = get_scene_by_id(sid)
+        if item and item.kind == "zip" and not warm_artifacts(item):
+            n += enqueue_prewarm(sid, PRIORITY_SWEEP)
+    print(f"[prewarm] sweep: {n}/{len(ids)} assigned scenes queued")
+    return n
+
+def _seconds_until(hour: int) -> float:
+    now = datetime.now()
+    nxt = now.replace(hour=hour % 24, minute=0, second=0, microsecond=0)
+    if nxt <= now:
+        nxt += timedelta(days=1)
+    return (nxt - now).total_seconds()
+
+def run_nightly_sweep(app, hour: int) -> None:
+    """Blocking loop: sweep_assigned every day at `hour` (local time), then wait for the builds."""
+    while True:
+        time.sleep(_seconds_until(int(hour)))
+        try:
+            sweep_assigned(app)
+            _Q.join()
+        except Exception as e:
+            print("[prewarm] sweep failed:", e)
+
+prewarm_cli = AppGroup("prewarm", help="Background preparation of assigned scenes.")
+
+@prewarm_cli.command("sweep")
+def sweep_command() -> None:
+    """Build the cache of every assigned scene that is not warm yet, then exit."""
+    if not settings.PREWARM_ENABLED:
+        raise click.ClickException("PREWARM_ENABLED is off")
+    sweep_assigned(current_app._get_current_object())
+    _Q.join()
+
+@prewarm_cli.command("nightly")
+def nightly_command() -> None:
+    """Sweep every day at PREWARM_NIGHTLY_HOUR (run exactly one of these)."""
+    hour = settings.PREWARM_NIGHTLY_HOUR
+    if hour is None or not settings.PREWARM_ENABLED:
+        raise click.ClickException("PREWARM_NIGHTLY_HOUR is not set or PREWARM_ENABLED is off")
+    print(f"[prewarm] nightly sweep at {int(hour):02d}:00")
+    run_nightly_sweep(current_app._get_current_object(), int(hour))
@@ -1,15 +1,39 @@
 # services/progress.py
 from __future__ import annotations
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass, asdict
 from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Set
+import hashlib
 import json
 import threading
 import time
 
+try:
+    import fcntl
+except Exception:  # pragma: no cover - not on POSIX
+    fcntl = None
+
 from config import settings
+from services.fsutil import write_atomic
+from services.metrics import observe_stage
 
 _PROGRESS_FILE: Path = settings.OUTPUT_DIR / "progress.json"
-_LOCK = threading.Lock()
+DEFAULT_JOB = "global"
+_TERMINAL_PHASES = ("done", "error")
+
+# per-job state lives in memory; every update bumps _VERSION and wakes SSE streams
+_COND = threading.Condition()
+_JOBS: Dict[str, "_State"] = {}
+_VERSION = 0
+_LAST_PERSIST = 0.0
+_LAST_PRUNE = 0.0
+_STAGE_START: Dict[str, tuple] = {}   # job → (phase, perf_counter at phase start)
+_RUNNING: Set[str] = set()            # exclusive jobs running in this process
+
+# job of the current request/thread (set by routes via progress_job(...))
+_CURRENT_JOB: ContextVar[str] = ContextVar("progress_job", default=DEFAULT_JOB)
 
 @dataclass
 class _State:
@@ -17,49 +41,205 @@ class _State:
     percent: float = 0.0
     note: str = ""
     ts: float = 0.0  # unix time
+    version: int = 0
 
-def _atomic_write(path: Path, data: dict) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    tmp = path.with_suffix(".tmp")
-    tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
-    tmp.replace(path)
+def _persist_locked(force: bool = False) -> None:
+    """Optional snapshot of all jobs to progress.json (throttled, caller holds _COND)."""
+    global _LAST_PERSIST
+    if not getattr(settings, "PROGRESS_PERSIST", False):
+        return
+    now = time.time()
+    if not force and now - _LAST_PERSIST < float(getattr(settings, "PROGRESS_PERSIST_INTERVAL", 2.0)):
+        return
+    _LAST_PERSIST = now
+    try:
+        write_atomic(_PROGRESS_FILE, json.dumps({k: asdict(v) for k, v in _JOBS.items()}, ensure_ascii=False))
+    except Exception as e:
+        print("[progress] persist failed:", e)
 
-def _read_state() -> _State:
+def _load_persisted() -> None:
+    if not getattr(settings, "PROGRESS_PERSIST", False):
+        return
     try:
         j = json.loads(_PROGRESS_FILE.read_text(encoding="utf-8"))
-        return _State(
-            phase=str(j.get("phase", "idle")),
-            percent=float(j.get("percent", 0.0)),
-            note=str(j.get("note", "")),
-            ts=float(j.get("ts", 0.0)),
-        )
+        for k, v in j.items():
+            _JOBS[str(k)] = _State(
+                phase=str(v.get("phase", "idle")),
+                percent=float(v.get("percent", 0.0)),
+                note=str(v.get("note", "")),
+                ts=float(v.get("ts", 0.0)),
+            )
+    except Exception:
+        pass
+
+_load_persisted()
+
+def _job_key(job: Optional[str]) -> str:
+    return str(job) if job else _CURRENT_JOB.get()
+
+@contextmanager
+def progress_job(job: str):
+    """Route all set_progress/reset calls made in this context to `job`."""
+    token = _CURRENT_JOB.set(str(job) or DEFAULT_JOB)
+    try:
+        yield
+    finally:
+        _CURRENT_JOB.reset(token)
+
+def _prune_locked(now: float) -> None:
+    """Forget finished/idle jobs older than PROGRESS_TTL (checked at most once a minute)."""
+    global _LAST_PRUNE
+    ttl = float(getattr(settings, "PROGRESS_TTL", 3600.0))
+    if ttl <= 0 or now - _LAST_PRUNE < 60.0:
+        return
+    _LAST_PRUNE = now
+    for k in [k for k, v in _JOBS.items()
+              if v.phase in ("idle",) + _TERMINAL_PHASES and now - v.ts > ttl]:
+        del _JOBS[k]
+        _STAGE_START.pop(k, None)
+
+def _claim_job(job: str):
+    """Mark an exclusive job as running; None if it already runs here or in another process.
+
+    Returns the open lock file (or True without fcntl). The flock is on
+    OUTPUT_DIR/jobs/<sha1 of job>.lock and lasts until the file is closed,
+    so a crashed worker never leaves a stale "running" mark behind.
+    """
+    with _COND:
+        if job in _RUNNING:
+            return None
+        _RUNNING.add(job)
+    if fcntl is None:
+        return True
+    f = None
+    try:
+        d = settings.OUTPUT_DIR / "jobs"
+        d.mkdir(parents=True, exist_ok=True)
+        f = open(d / f"{hashlib.sha1(job.encode('utf-8')).hexdigest()}.lock", "a+")
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f
+    except BaseException as e:
+        _release_job(job, f)
+        if isinstance(e, BlockingIOError):
+            return None
+        raise
+
+def _release_job(job: str, claim) -> None:
+    if claim is not None and claim is not True:
+        claim.close()   # drops the flock
+    with _COND:
+        _RUNNING.discard(job)
+
+def start_job(job: str, fn: Callable[[], object], name: Optional[str] = None,
+              exclusive: bool = False, phase: Optional[str] = None) -> Optional[threading.Thread]:
+    """Run `fn` in a daemon thread that reports to `job`.
+
+    The job key is bound here, where the work starts: a bare thread would
+    report to the "global" slot, which no per-user stream reads. A failure
+    ends the job in phase "error". `phase` is reported (0 %) before the
+    thread starts.
+
+    exclusive=True runs at most one `job` at a time across all worker
+    processes, whatever phases it goes through: the job stays claimed until
+    the thread exits, and None is returned while a previous run is active.
+    """
+    job = str(job) or DEFAULT_JOB
+    claim = _claim_job(job) if exclusive else None
+    if exclusive and claim is None:
+        return None
+
+    def _run():
+        with progress_job(job):
+            try:
+                fn()
+            except Exception as e:
+                set_progress("error", 100, str(e))
+                print(f"[progress] {job} failed:", e)
+            finally:
+                if exclusive:
+                    _release_job(job, claim)
+
+    try:
+        if phase:
+            set_progress(phase, 0, "start", job=job)
+        th = threading.Thread(target=_run, name=name or job, daemon=True)
+        th.start()
+    except BaseException:
+        if exclusive:
+            _release_job(job, claim)
+        raise
+    return th
+
+def _bump_locked(key: str, st: _State) -> None:
+    global _VERSION
+    _VERSION += 1
+    st.version = _VERSION
+    _JOBS[key] = st
+    _prune_locked(st.ts or time.time())
+    _persist_locked(force=st.phase in _TERMINAL_PHASES)
+    _COND.notify_all()
+
+def _stage_locked(key: str, phase: str) -> None:
+    """Close the job's previous phase as a metrics stage when the phase changes."""
+    now = time.perf_counter()
+    cur = _STAGE_START.get(key)
+    if cur is not None and cur[0] == phase:
+        return
+    if cur is not None and cur[0] not in ("idle",) + _TERMINAL_PHASES:
+        observe_stage(key.split(":", 1)[0][:32], cur[0], now - cur[1])
+    _STAGE_START[key] = (phase, now)
+
+def reset(job: Optional[str] = None) -> None:
+    with _COND:
+        _STAGE_START.pop(_job_key(job), None)
+        _bump_locked(_job_key(job), _State(phase="idle", percent=0.0, note="", ts=time.time()))
+
+def set_progress(phase: str, percent: float, note: str | None = None, job: Optional[str] = None) -> None:
+    key = _job_key(job)
+    try:
+        p = float(percent)
     except Exception:
-        return _State()
-
-def reset() -> None:
-    with _LOCK:
-        st = _State(phase="idle", percent=0.0, note="", ts=time.time())
-        _atomic_write(_PROGRESS_FILE, asdict(st))
-
-def set_progress(phase: str, percent: float, note: str | None = None) -> None:
-    with _LOCK:
-        st = _read_state()
-        st.phase = str(phase)
-        try:
-            p = float(percent)
-        except Exception:
-            p = 0.0
-        st.percent = max(0.0, min(100.0, p))
-        if note is not None:
-            st.note = str(note)
-        st.ts = time.time()
-        _atomic_write(_PROGRESS_FILE, asdict(st))
-
-def get_progress() -> dict:
-    st = _read_state()
-    return {
-        "phase": st.phase,
-        "percent": st.percent,
-        "note": st.note,
-        "ts": st.ts,
-    }
\ No newline at end of file
+        p = 0.0
+    with _COND:
+        prev = _JOBS.get(key) or _State()
+        st = _State(
+            phase=str(phase),
+            percent=max(0.0, min(100.0, p)),
+            note=str(note) if note is not None else prev.note,
+            ts=time.time(),
+        )
+        _stage_locked(key, st.phase)
+        _bump_locked(key, st)
+
+def get_progress(job: Optional[str] = None) -> dict:
+    with _COND:
+        st = _JOBS.get(_job_key(job)) or _State()
+        return asdict(st)
+
+def stream_progress(job: Optional[str] = None, heartbeat: float = 15.0,
+                    max_seconds: float = 600.0) -> Iterator[str]:
+    """Server-Sent Events generator for one job.
+
+    Emits the current state immediately, then one event per update. A comment
+    line is sent every `heartbeat` seconds to keep proxies from closing the
+    connection. The stream ends after a terminal phase or `max_seconds`, and
+    EventSource reconnects on its own if the client still wants updates.
+    """
+    key = _job_key(job)
+    seen = -1
+    first = True
+    t_end = time.time() + max_seconds
+    while time.time() < t_end:
+        with _COND:
+            _COND.wait_for(lambda: key in _JOBS and _JOBS[key].version != seen, timeout=heartbeat)
+            st = _JOBS.get(key)
+            data = asdict(st) if (st is not None and st.version != seen) else None
+        if data is None:
+            yield ": keep-alive\n\n"
+            continue
+        seen = data["version"]
+        yield f"id: {seen}\nevent: progress\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        # a terminal state in the very first snapshot is a leftover from an earlier run
+        if data["phase"] in _TERMINAL_PHASES and not first:
+            return
+        first = False
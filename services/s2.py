@@ -7,7 +7,13 @@ import re
 import time
 import zipfile
 import hashlib
+import shutil
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, asdict
+from io import BytesIO
 from pathlib import Path
 from typing import Tuple, Optional, List, Dict
 
@@ -16,11 +22,18 @@ from PIL import Image
 import rasterio
 from rasterio.warp import transform_bounds
 from rasterio.crs import CRS
+from rasterio.enums import Resampling
 
 from config import settings
+from services.fsutil import tmp_path, write_atomic
 from services.progress import reset as progress_reset, set_progress
 from Library.S2reader import SentinelProductReader  # ← use the shared reader
 
+try:
+    import fcntl
+except Exception:  # pragma: no cover - not on POSIX
+    fcntl = None
+
 # ---------------------------------------------------------------------
 # Paths
 # ---------------------------------------------------------------------
@@ -144,69 +157,448 @@ def s2_bounds_wgs84_from_tif(tif_path: Path) -> Dict[str, float]:
     dlat = dy_m / lat_m
     return {"lon_min": l + dlon, "lat_min": b + dlat, "lon_max": r + dlon, "lat_max": t + dlat}
 
-def _linear_stretch01(arr: np.ndarray) -> np.ndarray:
-    arr = arr.astype(np.float32)
-    amin = float(np.nanmin(arr))
-    amax = float(np.nanmax(arr))
-    if not np.isfinite(amin) or not np.isfinite(amax) or (amax - amin) < 1e-6:
-        return np.zeros_like(arr, dtype=np.float32)
-    return (arr - amin) / (amax - amin)
-
-def save_quicklook_png_from_tif_native(tif_path: Path) -> Path:
-    """Save an 8-bit PNG quicklook from the first 3 bands of the (RGB) GeoTIFF at native size."""
-    out_png = settings.BACKDROP_IMAGE
-    out_png.parent.mkdir(parents=True, exist_ok=True)
+# ---------------------------------------------------------------------
+# Quicklook encoders (fast-PNG in parallel strips, WebP, JPEG)
+# ---------------------------------------------------------------------
+
+QUICKLOOK_EXT = {"png": ".png", "webp": ".webp", "jpeg": ".jpg", "jpg": ".jpg"}
+QUICKLOOK_MIME = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg", "jpg": "image/jpeg"}
+TILE_EXT = {"png": ".png", "webp": ".webp"}
+
+def _encode_workers() -> int:
+    n = int(getattr(settings, "ENCODE_WORKERS", 0) or 0)
+    return n if n > 0 else (os.cpu_count() or 2)
+
+def _strip_ranges(H: int, rows: int) -> List[Tuple[int, int]]:
+    rows = max(1, int(rows))
+    return [(y, min(H, y + rows)) for y in range(0, H, rows)]
+
+def _adler32_combine(a1: int, a2: int, len2: int) -> int:
+    """Combine two adler32 checksums (same as zlib's adler32_combine)."""
+    base = 65521
+    rem = len2 % base
+    s1 = ((a1 & 0xFFFF) + (a2 & 0xFFFF) + base - 1) % base
+    s2 = (rem * (a1 & 0xFFFF) + (a1 >> 16) + (a2 >> 16) + base - rem) % base
+    return s1 | (s2 << 16)
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return (struct.pack(">I", len(data)) + tag + data
+            + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF))
+
+def _png_strip_deflate(block: np.ndarray, level: int, last: bool) -> Tuple[bytes, int, int]:
+    """Filter rows with PNG 'Sub' and raw-deflate one strip; returns (data, adler32, raw_len)."""
+    h, w, ch = block.shape
+    flat = block.reshape(h, w * ch)
+    raw = np.empty((h, w * ch + 1), dtype=np.uint8)
+    raw[:, 0] = 1                                   # filter type 1 = Sub
+    raw[:, 1:1 + ch] = flat[:, :ch]
+    np.subtract(flat[:, ch:], flat[:, :-ch], out=raw[:, 1 + ch:])
+    buf = raw.tobytes()
+    co = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = co.compress(buf) + co.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return data, zlib.adler32(buf), len(buf)
+
+def encode_png_parallel(arr: np.ndarray, level: int | None = None,
+                        strip_rows: int | None = None, workers: int | None = None) -> bytes:
+    """Encode an (H,W) / (H,W,C) uint8 array to PNG, deflating row strips in parallel.
+
+    Each strip is compressed independently (sync-flushed raw deflate) and the
+    pieces are concatenated into one zlib stream, so the result is a regular
+    single-image PNG that any decoder reads.
+    """
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    H, W, C = arr.shape
+    color_type = {1: 0, 3: 2, 4: 6}[C]
+    level = int(settings.QUICKLOOK_PNG_LEVEL if level is None else level)
+    ranges = _strip_ranges(H, strip_rows or settings.QUICKLOOK_STRIP_ROWS)
+    with ThreadPoolExecutor(max_workers=workers or _encode_workers()) as ex:
+        parts = list(ex.map(
+            lambda i: _png_strip_deflate(arr[ranges[i][0]:ranges[i][1]], level, i == len(ranges) - 1),
+            range(len(ranges)),
+        ))
+    adler = 1
+    for _, a, n in parts:
+        adler = _adler32_combine(adler, a, n)
+
+    out = [b"\x89PNG\r\n\x1a\n",
+           _png_chunk(b"IHDR", struct.pack(">IIBBBBB", W, H, 8, color_type, 0, 0, 0))]
+    out.append(_png_chunk(b"IDAT", b"\x78\x01" + parts[0][0]))
+    for data, _, _ in parts[1:]:
+        out.append(_png_chunk(b"IDAT", data))
+    out.append(_png_chunk(b"IDAT", struct.pack(">I", adler)))
+    out.append(_png_chunk(b"IEND", b""))
+    return b"".join(out)
+
+def encode_image(arr: np.ndarray, fmt: str, quality: int | None = None, **kw) -> bytes:
+    """Encode a uint8 image array with the selected quicklook encoder.
+
+    WebP accepts ``lossless=True`` and ``method=`` (0..6); for lossless WebP
+    ``quality`` is the compression effort, not fidelity.
+    """
+    fmt = fmt.lower()
+    if fmt == "png":
+        return encode_png_parallel(arr, **kw)
+    quality = int(settings.QUICKLOOK_QUALITY if quality is None else quality)
+    bio = BytesIO()
+    if fmt == "webp":
+        Image.fromarray(arr).save(bio, format="WEBP", quality=quality,
+                                  lossless=bool(kw.get("lossless", False)), method=int(kw.get("method", 0)))
+    elif fmt in ("jpeg", "jpg"):
+        im = Image.fromarray(arr)
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        im.save(bio, format="JPEG", quality=quality, optimize=False)
+    else:
+        raise ValueError(f"Unsupported quicklook format '{fmt}'. Supported: png, webp, jpeg")
+    return bio.getvalue()
+
+def _stretch_rgb8(rgb: np.ndarray) -> np.ndarray:
+    """(3,H,W) → (H,W,3) uint8 with a per-band min/max stretch, converted in parallel strips."""
+    C, H, W = rgb.shape
+    lims = []
+    for i in range(C):
+        amin = float(np.nanmin(rgb[i]))
+        amax = float(np.nanmax(rgb[i]))
+        ok = np.isfinite(amin) and np.isfinite(amax) and (amax - amin) >= 1e-6
+        lims.append((amin, 255.0 / (amax - amin)) if ok else None)
+    out = np.empty((H, W, C), dtype=np.uint8)
+
+    def _work(rng):
+        y0, y1 = rng
+        for i, lim in enumerate(lims):
+            if lim is None:
+                out[y0:y1, :, i] = 0
+                continue
+            v = (rgb[i, y0:y1].astype(np.float32) - lim[0]) * lim[1]
+            out[y0:y1, :, i] = np.clip(np.rint(v), 0, 255).astype(np.uint8)
+
+    with ThreadPoolExecutor(max_workers=_encode_workers()) as ex:
+        list(ex.map(_work, _strip_ranges(H, settings.QUICKLOOK_STRIP_ROWS)))
+    return out
+
+def quicklook_path(fmt: str | None = None) -> Path:
+    fmt = (fmt or settings.QUICKLOOK_FORMAT).lower()
+    return settings.BACKDROP_IMAGE.with_suffix(QUICKLOOK_EXT[fmt])
+
+def save_quicklook_from_tif(tif_path: Path, fmt: str | None = None, max_w: int | None = None,
+                            out_path: Path | None = None) -> Path:
+    """Save a size-capped quicklook (width ≤ QUICKLOOK_MAX_W) in the selected format.
+
+    The GeoTIFF is read decimated (``out_shape``), so the full-resolution raster
+    is never materialised just to be thrown away by a resize.
+    """
+    fmt = (fmt or settings.QUICKLOOK_FORMAT).lower()
+    max_w = int(settings.QUICKLOOK_MAX_W if max_w is None else max_w)
     with rasterio.open(tif_path) as src:
-        r = src.read(1)
-        g = src.read(2)
-        b = src.read(3)
-    r8 = (_linear_stretch01(r) * 255).round().astype(np.uint8)
-    g8 = (_linear_stretch01(g) * 255).round().astype(np.uint8)
-    b8 = (_linear_stretch01(b) * 255).round().astype(np.uint8)
-    im = Image.fromarray(np.dstack([r8, g8, b8]), mode="RGB")
-    tmp_png = out_png.with_suffix(".tmp.png")
-    im.save(str(tmp_png), format="PNG")
-    # ensure written
-    for _ in range(5):
-        if tmp_png.exists() and tmp_png.stat().st_size > 0:
-            break
-        time.sleep(0.2)
-    os.replace(str(tmp_png), str(out_png))
-    return out_png
+        W, H = src.width, src.height
+        if max_w > 0 and W > max_w:
+            ow, oh = max_w, max(1, round(H * max_w / W))
+        else:
+            ow, oh = W, H
+        rgb = src.read([1, 2, 3], out_shape=(3, oh, ow), resampling=Resampling.average)
+    data = encode_image(_stretch_rgb8(rgb), fmt)
+    return write_atomic(Path(out_path) if out_path else quicklook_path(fmt), data)
 
 # ---------------------------------------------------------------------
 # Tile slicing (for front-end grid overlay)
 # ---------------------------------------------------------------------
 
-def slice_png_to_grid(png_path: Path, scene_id: str, rows: int = 3, cols: int = 3) -> dict:
+GRID_MANIFEST = "manifest.json"
+
+def grid_geometry(W: int, H: int) -> Tuple[int, int, int]:
+    """(rows, cols, block) for a W×H scene.
+
+    At least TILE_GRID_N tiles per side; when TILE_BLOCK_SIZE > 0 large scenes
+    are cut into more tiles so no tile edge exceeds the block size (the browser
+    allocates one full-resolution canvas per visited tile).
+    """
+    n = max(1, int(settings.TILE_GRID_N))
+    block = max(0, int(settings.TILE_BLOCK_SIZE or 0))
+    if not block:
+        return n, n, 0
+    by, bx = -(-int(H) // block), -(-int(W) // block)
+    if by < n or bx < n:
+        # smaller than n blocks: grid_edges splits evenly, so the tiles are not block-sized
+        return n, n, 0
+    return by, bx, block
+
+def _legacy_grid(out_dir: Path) -> Optional[Tuple[int, int]]:
+    """(rows, cols) of a tiles dir cut before manifests existed (evenly split N×N)."""
+    rc = [tuple(map(int, m.groups())) for m in
+          (re.match(r"tile_(\d+)_(\d+)\.png$", p.name) for p in out_dir.glob("tile_*.png")) if m]
+    if not rc:
+        return None
+    return max(r for r, _ in rc) + 1, max(c for _, c in rc) + 1
+
+def _grid_edges(n: int, size: int, block: int = 0) -> List[Tuple[int, int]]:
+    e = SentinelProductReader.grid_edges(size, n, block)
+    return list(zip(e[:-1], e[1:]))
+
+def _band_scales(src) -> Optional[List[Tuple[float, float]]]:
+    """Per-band (offset, scale) to uint8; None when the raster is already 8-bit.
+
+    The exported RGB GeoTIFF is uint8 with a 2–98% stretch baked in, so it is
+    passed through. Other dtypes get a min/max stretch measured on a decimated
+    read (never the full-resolution array).
+    """
+    if src.dtypes[0] == "uint8":
+        return None
+    W, H = src.width, src.height
+    f = max(1, max(W, H) // 2048)
+    small = src.read([1, 2, 3], out_shape=(3, max(1, H // f), max(1, W // f)),
+                     resampling=Resampling.nearest, masked=True)
+    out = []
+    for i in range(3):
+        amin, amax = float(small[i].min()), float(small[i].max())
+        out.append((amin, 255.0 / (amax - amin)) if amax - amin >= 1e-6 else (amin, 0.0))
+    return out
+
+def tile_formats() -> List[str]:
+    fmts = [f.lower() for f in settings.TILE_FORMATS if f.lower() in TILE_EXT]
+    return ["png"] + [f for f in dict.fromkeys(fmts) if f != "png"]
+
+def _render_grid_tile(tif_path: Path, out_dir: Path, r: int, c: int,
+                      x0: int, y0: int, x1: int, y1: int, scales) -> dict:
+    """Read one raster window (RGB + dataset mask as alpha) and write tile_<r>_<c>.<ext>.
+
+    One file per TILE_FORMATS entry (PNG always, WebP lossless so the alpha
+    edge and pixel values are identical); per-variant size and encode time
+    go into the manifest.
+    """
+    from rasterio.windows import Window, bounds as win_bounds
+
+    win = Window(x0, y0, x1 - x0, y1 - y0)
+    h, w = y1 - y0, x1 - x0
+    rgba = np.empty((h, w, 4), dtype=np.uint8)
+    with rasterio.open(tif_path) as src:
+        bands = src.read([1, 2, 3], window=win)
+        if scales is None:
+            for i in range(3):
+                rgba[:, :, i] = bands[i]
+        else:
+            for i, (off, k) in enumerate(scales):
+                rgba[:, :, i] = np.clip(np.rint((bands[i].astype(np.float32) - off) * k), 0, 255)
+        rgba[:, :, 3] = src.dataset_mask(window=win)
+        left, bottom, right, top = win_bounds(win, src.transform)
+        crs = src.crs
+
+    variants = {}
+    for fmt in tile_formats():
+        t0 = time.perf_counter()
+        if fmt == "png":
+            data = encode_png_parallel(rgba, workers=1)
+        else:
+            data = encode_image(rgba, "webp", quality=50, lossless=True,
+                                method=settings.TILE_WEBP_METHOD)
+        ms = (time.perf_counter() - t0) * 1000.0
+        vname = f"tile_{r}_{c}{TILE_EXT[fmt]}"
+        write_atomic(out_dir / vname, data)
+        variants[fmt] = {"name": vname, "bytes": len(data), "encode_ms": round(ms, 2)}
+
+    bounds_wgs84 = (left, bottom, right, top)
+    if crs is not None and crs.to_epsg() != 4326:
+        bounds_wgs84 = transform_bounds(crs, CRS.from_epsg(4326), left, bottom, right, top, densify_pts=21)
+    return {
+        "r": r, "c": c, "x": x0, "y": y0, "w": w, "h": h,
+        "name": variants["png"]["name"], "bytes": variants["png"]["bytes"],
+        "variants": variants,
+        "bounds": [left, bottom, right, top],
+        "bounds_wgs84": {"lon_min": bounds_wgs84[0], "lat_min": bounds_wgs84[1],
+                         "lon_max": bounds_wgs84[2], "lat_max": bounds_wgs84[3]},
+    }
+
+def slice_tif_to_grid(tif_path: Path, scene_id: str,
+                      rows: Optional[int] = None, cols: Optional[int] = None) -> dict:
+    """Cut the editing grid straight from raster windows of the RGB GeoTIFF.
+
+    The geometry is a per-scene property: explicit rows/cols win, otherwise an
+    existing manifest of the same W×H keeps its geometry (saved masks are keyed
+    by r/c), otherwise grid_geometry(W, H). It is recorded in the manifest and
+    every grid endpoint reads it back from there.
+
+    Tiles are read and encoded in a thread pool (GDAL reads and zlib both
+    release the GIL); each worker opens its own dataset handle. A JSON
+    manifest with per-tile pixel rect, byte size and bounds is written last,
+    so its presence means the grid is complete.
+    """
     out_dir = tiles_root() / scene_id
     out_dir.mkdir(parents=True, exist_ok=True)
-    im = Image.open(png_path).convert("RGBA")
-    W, H = im.size
-    w = W // cols
-    h = H // rows
-    tiles = []
-    for r in range(rows):
-        for c in range(cols):
-            x0 = c * w
-            y0 = r * h
-            x1 = W if c == cols - 1 else (c + 1) * w
-            y1 = H if r == rows - 1 else (r + 1) * h
-            crop = im.crop((x0, y0, x1, y1))
-            name = f"tile_{r}_{c}.png"
-            crop.save(out_dir / name, optimize=False)
-            tiles.append({
-                "r": r, "c": c, "w": x1 - x0, "h": y1 - y0,
-                "name": name, "path": str((out_dir / name).resolve())
-            })
-    return {"W": W, "H": H, "rows": rows, "cols": cols, "tiles": tiles, "dir": str(out_dir.resolve())}
-
-def get_tile_path(scene_id: str, r: int, c: int) -> Path:
-    p = tiles_root() / scene_id / f"tile_{r}_{c}.png"
+    with rasterio.open(tif_path) as src:
+        W, H = src.width, src.height
+        crs = src.crs.to_string() if src.crs else None
+        transform = list(src.transform)[:6]
+        scales = _band_scales(src)
+    g_rows, g_cols, block = grid_geometry(W, H)
+    prev = load_grid_manifest(scene_id)
+    if rows or cols:
+        rows, cols, block = int(rows or g_rows), int(cols or g_cols), 0
+    elif prev and (prev.get("W"), prev.get("H")) == (W, H):
+        rows, cols, block = int(prev["rows"]), int(prev["cols"]), int(prev.get("block") or 0)
+    elif not prev and _legacy_grid(out_dir):
+        # masks of pre-manifest scenes are keyed by r/c of the old even grid
+        (rows, cols), block = _legacy_grid(out_dir), 0
+    else:
+        rows, cols = g_rows, g_cols
+
+    jobs = [(r, c, x0, y0, x1, y1)
+            for r, (y0, y1) in enumerate(_grid_edges(rows, H, block))
+            for c, (x0, x1) in enumerate(_grid_edges(cols, W, block))]
+    with ThreadPoolExecutor(max_workers=min(len(jobs), _encode_workers())) as ex:
+        tiles = list(ex.map(lambda j: _render_grid_tile(Path(tif_path), out_dir, *j, scales), jobs))
+    keep = {v["name"] for t in tiles for v in t["variants"].values()}
+    for old in out_dir.glob("tile_*"):
+        if old.name not in keep:
+            old.unlink(missing_ok=True)
+
+    manifest = {
+        "scene_id": scene_id, "W": W, "H": H, "rows": rows, "cols": cols, "block": block,
+        "formats": tile_formats(),
+        "crs": crs, "transform": transform, "source": str(Path(tif_path).resolve()),
+        "created": time.time(), "tiles": tiles,
+    }
+    write_atomic(out_dir / GRID_MANIFEST,
+                 json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8"))
+    return {**manifest, "dir": str(out_dir.resolve())}
+
+def load_grid_manifest(scene_id: str) -> Optional[dict]:
+    p = tiles_root() / scene_id / GRID_MANIFEST
+    try:
+        return json.loads(p.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+
+def get_tile_path(scene_id: str, r: int, c: int, fmt: str = "png") -> Path:
+    p = tiles_root() / scene_id / f"tile_{r}_{c}{TILE_EXT[fmt]}"
     if not p.exists():
         raise FileNotFoundError(str(p))
     return p
 
+# ---------------------------------------------------------------------
+# Per-scene artifact cache (filled by prewarm or the first select, reused later)
+# ---------------------------------------------------------------------
+
+SCENE_CACHE_META = "cache.json"
+
+def scene_cache_dir(scene_id: str) -> Path:
+    return settings.OUTPUT_DIR / "scene_cache" / scene_id
+
+class _SceneLock:
+    """Per-scene build lock: a thread lock plus a flock on scene_cache/.<id>.lock,
+    so builds of one scene also take turns across worker and CLI processes."""
+
+    def __init__(self, scene_id: str):
+        self.scene_id = scene_id
+        self._thread = threading.Lock()
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread.acquire(blocking):
+            return False
+        if fcntl is None:
+            return True
+        f = None
+        try:
+            p = scene_cache_dir(self.scene_id).with_name(f".{self.scene_id}.lock")
+            p.parent.mkdir(parents=True, exist_ok=True)
+            f = open(p, "a+")
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BaseException as e:
+            if f is not None:
+                f.close()
+            self._thread.release()
+            if isinstance(e, BlockingIOError):
+                return False
+            raise
+        self._file = f
+        return True
+
+    def release(self) -> None:
+        f, self._file = self._file, None
+        if f is not None:
+            f.close()   # drops the flock
+        self._thread.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+_SCENE_LOCKS: Dict[str, _SceneLock] = {}
+_SCENE_LOCKS_GUARD = threading.Lock()
+
+def _scene_lock(scene_id: str) -> _SceneLock:
+    with _SCENE_LOCKS_GUARD:
+        return _SCENE_LOCKS.setdefault(scene_id, _SceneLock(scene_id))
+
+def _source_stamp(item: SceneItem) -> dict:
+    st = Path(item.path).stat()
+    return {"source": str(Path(item.path).resolve()), "size": st.st_size, "mtime": st.st_mtime}
+
+def warm_artifacts(item: SceneItem) -> Optional[dict]:
+    """Cached RGB GeoTIFF / quicklook / grid for `item`, or None if missing or stale."""
+    d = scene_cache_dir(item.id)
+    try:
+        meta = json.loads((d / SCENE_CACHE_META).read_text(encoding="utf-8"))
+        if {k: meta.get(k) for k in ("source", "size", "mtime")} != _source_stamp(item):
+            return None
+    except Exception:
+        return None
+    ql = d / f"quicklook{QUICKLOOK_EXT[settings.QUICKLOOK_FORMAT.lower()]}"
+    grid = load_grid_manifest(item.id)
+    if not ((d / "rgb.tif").exists() and ql.exists() and grid):
+        return None
+    return {"rgb_tif": d / "rgb.tif", "quicklook": ql, "grid": grid}
+
+def is_scene_warm(scene_id: str) -> bool:
+    item = get_scene_by_id(scene_id)
+    return bool(item and item.kind == "zip" and warm_artifacts(item))
+
+def prepare_scene_artifacts(item: SceneItem) -> dict:
+    """Build the per-scene cache (caller holds _scene_lock(item.id)).
+
+    Does not touch the globally selected scene, so it is safe to run in the
+    background while someone is annotating another scene. cache.json is
+    written last and records the source ZIP size/mtime.
+    """
+    warm = warm_artifacts(item)
+    if warm:
+        return warm
+    d = scene_cache_dir(item.id)
+    d.mkdir(parents=True, exist_ok=True)
+
+    set_progress("build_rgb", 25, "Building aligned RGB GeoTIFF")
+    tif = d / "rgb.tif"
+    tmp = tmp_path(tif)
+    try:
+        SentinelProductReader(item.path).export_esri_aligned_rgb_tif(str(tmp), resolution=10)
+        os.replace(tmp, tif)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+    set_progress("quicklook", 50, "Saving quicklook")
+    ql = save_quicklook_from_tif(
+        tif, out_path=d / f"quicklook{QUICKLOOK_EXT[settings.QUICKLOOK_FORMAT.lower()]}")
+
+    set_progress("grid", 65, "Slicing grid tiles")
+    grid = slice_tif_to_grid(tif, scene_id=item.id)
+
+    write_atomic(d / SCENE_CACHE_META,
+                 json.dumps({**_source_stamp(item), "created": time.time()}).encode("utf-8"))
+    return {"rgb_tif": tif, "quicklook": ql, "grid": grid}
+
+def _link_or_copy(src: Path, dst: Path) -> None:
+    """Atomically make `dst` a hard link to `src` (copy across filesystems)."""
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(dst)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
 # ---------------------------------------------------------------------
 # Scene selection workflow (ZIP → ESRI-aligned RGB GeoTIFF → quicklook + tiles)
 # ---------------------------------------------------------------------
@@ -222,30 +614,38 @@ def select_scene_by_id(scene_id: str) -> dict:
     p = Path(item.path)
 
     if item.kind == "zip":
-        # Build ESRI-aligned RGB GeoTIFF using the shared reader
-        set_progress("build_rgb", 25, "Building aligned RGB GeoTIFF")
-        out_tif = settings.S2_RGB_TIF
-        out_tif.parent.mkdir(parents=True, exist_ok=True)
-        rdr = SentinelProductReader(str(p))
-        # You can switch to export_esri_aligned_rgba_tif if you want alpha edges later.
-        rdr.export_esri_aligned_rgb_tif(str(out_tif), resolution=10)
-        tif_path = out_tif
+        lock = _scene_lock(item.id)
+        if not lock.acquire(blocking=False):
+            set_progress("prewarm", 15, "Waiting for background preparation")
+            lock.acquire()
+        try:
+            art = prepare_scene_artifacts(item)
+        finally:
+            lock.release()
+        # the shared paths below are what the rest of the app reads
+        set_progress("activate", 80, "Activating scene")
+        tif_path = settings.S2_RGB_TIF
+        _link_or_copy(art["rgb_tif"], tif_path)
+        ql_path = quicklook_path()
+        _link_or_copy(art["quicklook"], ql_path)
+        grid_meta = {**art["grid"], "dir": str((tiles_root() / item.id).resolve())}
     else:
         # SAFE directory preparation is application-specific (handled by settings hooks)
         set_progress("prepare_safe", 25, "Preparing SAFE")
         settings.set_r10m_dir(p)          # ensures settings.S2_RGB_TIF points to a valid RGB
         tif_path = settings.S2_RGB_TIF
 
-    set_progress("quicklook", 55, "Saving native quicklook")
-    png_path = save_quicklook_png_from_tif_native(tif_path)
+        set_progress("quicklook", 50, "Saving quicklook")
+        ql_path = save_quicklook_from_tif(tif_path)
 
-    set_progress("grid", 70, "Slicing 3×3 tiles")
-    grid_meta = slice_png_to_grid(png_path, scene_id=item.id, rows=3, cols=3)
+        set_progress("grid", 65, "Slicing grid tiles")
+        grid_meta = slice_tif_to_grid(tif_path, scene_id=item.id)
 
     set_progress("bounds", 85, "Computing bounds")
     bounds = s2_bounds_wgs84_from_tif(tif_path)
 
-    W, H = Image.open(png_path).size
+    with rasterio.open(tif_path) as src:
+        W, H = src.width, src.height
     _persist_selected_scene(item)
 
     set_progress("done", 100, "Ready")
@@ -254,7 +654,8 @@ def select_scene_by_id(scene_id: str) -> dict:
         "scene": asdict(item),
         "backdrop_size": [W, H],
         "bounds_wgs84": bounds,
-        "quicklook_png": str(png_path),
+        "quicklook_png": str(ql_path),
+        "quicklook_url": f"/api/output/{ql_path.name}",
         "grid": grid_meta
     }
 
@@ -276,14 +677,14 @@ def s2_bounds_wgs84() -> Optional[dict]:
         return None
 
 def ensure_backdrop() -> None:
-    p = settings.BACKDROP_IMAGE
+    p = quicklook_path()
     p.parent.mkdir(parents=True, exist_ok=True)
     if p.exists():
         return
     try:
         tif = Path(settings.S2_RGB_TIF)
         if tif.exists():
-            save_quicklook_png_from_tif_native(tif)  # builds native-size quicklook (no downscale)
+            save_quicklook_from_tif(tif)  # size-capped quicklook (QUICKLOOK_MAX_W)
             if p.exists():
                 return
     except Exception:
@@ -291,7 +692,15 @@ def ensure_backdrop() -> None:
     Image.new("RGB", (2048, 2048), (30, 30, 30)).save(p)
 
 def backdrop_meta() -> tuple[int, int]:
-    p = settings.BACKDROP_IMAGE
+    """Native pixel size of the scene (the quicklook itself may be downscaled)."""
+    tif = Path(settings.S2_RGB_TIF)
+    if tif.exists():
+        try:
+            with rasterio.open(tif) as src:
+                return int(src.width), int(src.height)
+        except Exception:
+            pass
+    p = quicklook_path()
     p.parent.mkdir(parents=True, exist_ok=True)
     if not p.exists():
         ensure_backdrop()
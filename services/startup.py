@@ -0,0 +1,51 @@
+# services/startup.py
+"""
+Startup-time accounting for create_app.
+
+    timer = StartupTimer()
+    with timer.step("blueprint routes.api"):
+        from routes.api import api_bp
+    timer.report()
+
+Each step records wall time and how many modules it pulled into sys.modules,
+so a heavy import that sneaks into boot shows up by name. For a per-module
+breakdown use ``python -m bench.startup``.
+"""
+from __future__ import annotations
+
+import sys
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+_T0 = time.perf_counter()   # first import of this module ≈ process boot for app.py
+
+class StartupTimer:
+    def __init__(self) -> None:
+        self.t0 = time.perf_counter()
+        self.steps: List[Tuple[str, float, int]] = []
+
+    @contextmanager
+    def step(self, name: str):
+        n0 = len(sys.modules)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - t, len(sys.modules) - n0))
+
+    def as_dict(self) -> dict:
+        return {
+            "since_boot_ms": round((time.perf_counter() - _T0) * 1000, 1),
+            "create_app_ms": round((time.perf_counter() - self.t0) * 1000, 1),
+            "modules": len(sys.modules),
+            "steps": [{"name": n, "ms": round(s * 1000, 1), "new_modules": m} for n, s, m in self.steps],
+        }
+
+    def report(self) -> dict:
+        d = self.as_dict()
+        print(f"[startup] create_app {d['create_app_ms']:.0f} ms "
+              f"(since boot {d['since_boot_ms']:.0f} ms, {d['modules']} modules)")
+        for st in sorted(d["steps"], key=lambda x: -x["ms"]):
+            print(f"[startup]   {st['ms']:7.1f} ms  +{st['new_modules']:<4d} {st['name']}")
+        return d
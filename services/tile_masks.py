@@ -0,0 +1,291 @@
+# services/tile_masks.py
+"""
+Per-annotator label rasters for grid tiles.
+
+Every (scene, user) pair has one scene-sized ChunkedMaskStore under
+``<OUTPUT_DIR>/masks/<scene_id>/labels/u<user_id>/``. A tile save writes the
+tile's class indices at the tile's pixel rect from the grid manifest, so only
+the chunks under that tile are rewritten and neighbouring tiles never
+interfere. No PNG encoding is involved.
+"""
+from __future__ import annotations
+
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import settings
+from services.fsutil import safe_name
+from services.mask_index import record_latest
+from services.mask_store import ChunkedMaskStore
+from services.masks import decode_body
+from services.s2 import load_grid_manifest
+
+
+def labels_root(scene_id: str) -> Path:
+    return settings.OUTPUT_DIR / "masks" / safe_name(scene_id) / "labels"
+
+
+_STORES: Dict[str, ChunkedMaskStore] = {}   # one instance per store keeps its index/chunk/histogram caches warm
+_STORES_LOCK = threading.Lock()
+
+
+def user_label_store(scene_id: str, user_id) -> ChunkedMaskStore:
+    root = labels_root(scene_id) / f"u{safe_name(user_id)}"
+    with _STORES_LOCK:
+        st = _STORES.get(str(root))
+        if st is None:
+            st = _STORES[str(root)] = ChunkedMaskStore(root)
+        return st
+
+
+def manifest_tile(man: dict, r: int, c: int) -> Optional[dict]:
+    """Tile entry (x, y, w, h, …) for r/c in a grid manifest, or None outside the grid."""
+    if not (0 <= r < int(man["rows"]) and 0 <= c < int(man["cols"])):
+        return None
+    for t in man.get("tiles", []):
+        if int(t["r"]) == r and int(t["c"]) == c:
+            return t
+    return None
+
+
+def read_tile_classes(scene_id: str, user_id, r: int, c: int, level: int = 0):
+    """(uint8 h×w array, tile rect) of the user's stored labels for one tile.
+
+    level > 0 reads the store's mode pyramid: the tile at 1/2**level per side.
+    """
+    man = load_grid_manifest(scene_id)
+    t = manifest_tile(man, r, c) if man else None
+    if t is None:
+        raise LookupError("r/c outside grid")
+    st = user_label_store(scene_id, user_id)
+    if not st.exists():
+        raise LookupError("no saved labels")
+    rect = {k: int(t[k]) for k in ("x", "y", "w", "h")}
+    k = min(max(0, int(level)), st.levels)
+    if k:
+        x0, y0 = rect["x"] >> k, rect["y"] >> k
+        x1, y1 = -(-(rect["x"] + rect["w"]) >> k), -(-(rect["y"] + rect["h"]) >> k)
+        return st.read_level(k, x0, y0, x1 - x0, y1 - y0), rect
+    return st.read_window(rect["x"], rect["y"], rect["w"], rect["h"]), rect
+
+
+def scene_label_users(scene_id: str) -> List[str]:
+    """Users with a label store for the scene."""
+    root = labels_root(scene_id)
+    if not root.is_dir():
+        return []
+    return sorted(p.name[1:] for p in root.iterdir() if p.name.startswith("u") and (p / "index.json").exists())
+
+
+def class_counts(scene_id: str, user_id, r: Optional[int] = None, c: Optional[int] = None) -> np.ndarray:
+    """Per-class pixel counts of a user's labels: whole scene, or one tile when r/c are given."""
+    st = user_label_store(scene_id, user_id)
+    if r is None:
+        return st.histogram()
+    man = load_grid_manifest(scene_id)
+    t = manifest_tile(man, r, c) if man else None
+    if t is None:
+        raise LookupError("r/c outside grid")
+    return st.histogram(int(t["x"]), int(t["y"]), int(t["w"]), int(t["h"]))
+
+
+class PatchConflict(Exception):
+    """The client's base version is not the tile's current version."""
+
+    def __init__(self, current: int):
+        super().__init__(f"base version is stale (current {current})")
+        self.current = current
+
+
+class ShapeConflict(Exception):
+    """The user's label store was made for another scene size (e.g. the scene was re-sliced)."""
+
+    def __init__(self, shape: Tuple[int, int], expected: Tuple[int, int]):
+        super().__init__(f"label store is {shape[1]}x{shape[0]} but the scene grid is "
+                         f"{expected[1]}x{expected[0]}; not overwriting saved labels")
+        self.shape, self.expected = shape, expected
+
+
+def _check_classes(arr: np.ndarray) -> None:
+    ncls = len(settings.CLASS_LIST)
+    if ncls and arr.size and int(arr.max()) >= ncls:
+        raise ValueError(f"class index {int(arr.max())} out of range (0..{ncls - 1})")
+
+
+def _tile_ctx(scene_id: str, user_id, r: int, c: int):
+    """(store, tile entry) for r/c; the store is created at the scene size on first use.
+
+    An existing store of another size raises ShapeConflict: a write path
+    never recreates (and so wipes) a user's labels.
+    """
+    man = load_grid_manifest(scene_id)
+    if not man:
+        raise LookupError("tiles not found")
+    t = manifest_tile(man, r, c)
+    if t is None:
+        raise LookupError("r/c outside grid")
+    st = user_label_store(scene_id, user_id)
+    W, H = int(man["W"]), int(man["H"])
+    with st.lock:
+        if not st.exists():
+            st.create(W, H)
+        elif st.shape != (H, W):
+            raise ShapeConflict(st.shape, (H, W))
+    return st, t
+
+
+def tile_version(st: ChunkedMaskStore, r: int, c: int) -> int:
+    """Per-tile edit counter (0 = never saved); bumped by every save that changes pixels."""
+    return int((st.meta().get("tiles") or {}).get(f"{r}_{c}", 0))
+
+
+def _write_tile(st: ChunkedMaskStore, t: dict, r: int, c: int, arr: np.ndarray) -> dict:
+    """Write the full tile array and bump its version in the same index commit (caller holds st.lock)."""
+    tiles = dict(st.meta().get("tiles") or {})
+    cur = int(tiles.get(f"{r}_{c}", 0))
+    tiles[f"{r}_{c}"] = cur + 1
+    changed = st.write_window(int(t["x"]), int(t["y"]), arr, meta={"tiles": tiles})
+    if not changed and cur == 0:
+        st.update_meta({"tiles": tiles})   # first save of an empty tile still counts as saved
+        changed_or_first = True
+    else:
+        changed_or_first = bool(changed)
+    return {"r": r, "c": c, "x": int(t["x"]), "y": int(t["y"]), "w": int(t["w"]), "h": int(t["h"]),
+            "changed_chunks": len(changed), "tile_version": cur + 1 if changed_or_first else cur,
+            "saved": changed_or_first}
+
+
+def save_tile_classes(scene_id: str, user_id, r: int, c: int, body: bytes,
+                      encoding: Optional[str] = None) -> dict:
+    """Write one tile's uint8 class indices (row-major, tile w×h).
+
+    `body` may be compressed (`encoding` = Content-Encoding); decoding is
+    capped at the tile size.
+
+    Raises LookupError when the scene has no grid or r/c is outside it,
+    ShapeConflict when the stored labels have another size than the grid and
+    ValueError when the payload does not match the tile or holds unknown classes.
+    """
+    st, t = _tile_ctx(scene_id, user_id, r, c)
+    w, h = int(t["w"]), int(t["h"])
+    raw = decode_body(body, encoding, max_size=w * h)
+    if len(raw) != w * h:
+        raise ValueError(f"size mismatch: got {len(raw)} bytes, expected {w}x{h}={w * h}")
+    arr = np.frombuffer(raw, dtype=np.uint8).reshape(h, w)
+    _check_classes(arr)
+    with st.lock:
+        info = _write_tile(st, t, r, c, arr)
+    if info.pop("saved"):
+        record_latest(scene_id, r, c, user_id, {"kind": "labels", "tile_version": info["tile_version"]})
+    return info
+
+
+# ---------------------------------------------------------------------
+# Delta patches (autosave): only the pixels a stroke touched
+# ---------------------------------------------------------------------
+_RECT_HDR = np.dtype([("x", "<u2"), ("y", "<u2"), ("w", "<u2"), ("h", "<u2")])
+_RLE_REC = np.dtype([("start", "<u4"), ("length", "<u4"), ("value", "u1")])
+
+
+def _parse_rects(raw: bytes, tw: int, th: int) -> List[Tuple[int, int, int, int, np.ndarray]]:
+    """Body = repeated [x, y, w, h: uint16 LE][w*h class bytes]; tile-local coordinates."""
+    out, pos = [], 0
+    while pos < len(raw):
+        if pos + _RECT_HDR.itemsize > len(raw):
+            raise ValueError("truncated rect header")
+        hd = np.frombuffer(raw, dtype=_RECT_HDR, count=1, offset=pos)[0]
+        x, y, w, h = int(hd["x"]), int(hd["y"]), int(hd["w"]), int(hd["h"])
+        pos += _RECT_HDR.itemsize
+        if w == 0 or h == 0 or x + w > tw or y + h > th:
+            raise ValueError(f"rect {x},{y},{w}x{h} outside tile {tw}x{th}")
+        if pos + w * h > len(raw):
+            raise ValueError("truncated rect data")
+        out.append((x, y, w, h, np.frombuffer(raw, dtype=np.uint8, count=w * h, offset=pos).reshape(h, w)))
+        pos += w * h
+    return out
+
+
+def _parse_rle(raw: bytes, tw: int, th: int) -> np.ndarray:
+    """Body = repeated [start, length: uint32 LE][value: uint8] runs over the row-major tile."""
+    if len(raw) % _RLE_REC.itemsize:
+        raise ValueError("rle body is not a whole number of runs")
+    runs = np.frombuffer(raw, dtype=_RLE_REC)
+    if runs.size and int((runs["start"].astype(np.int64) + runs["length"]).max()) > tw * th:
+        raise ValueError("rle run outside tile")
+    return runs
+
+
+def _patch_rect(fmt: str, ops, tw: int) -> Optional[Tuple[int, int, int, int]]:
+    """Tile-local (x, y, w, h) covering every patched pixel, or None for an empty patch."""
+    if fmt == "rle":
+        if not ops.size:
+            return None
+        lo = int(ops["start"].min())
+        hi = int((ops["start"].astype(np.int64) + ops["length"]).max())
+        y0, y1 = lo // tw, (hi - 1) // tw + 1
+        return 0, y0, tw, y1 - y0
+    if not ops:
+        return None
+    x0 = min(o[0] for o in ops); y0 = min(o[1] for o in ops)
+    x1 = max(o[0] + o[2] for o in ops); y1 = max(o[1] + o[3] for o in ops)
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def _apply_ops(win: np.ndarray, fmt: str, ops, ox: int, oy: int, tw: int) -> None:
+    """Apply parsed ops to `win`, the tile region starting at tile-local (ox, oy)."""
+    if fmt == "rle":
+        starts = ops["start"].astype(np.int64) - oy * tw   # ox is 0: rle windows span whole rows
+        lens = ops["length"].astype(np.int64)
+        # all run indices at once: arange(total) shifted per run by (start − run offset)
+        offs = np.cumsum(lens) - lens
+        idx = np.arange(int(lens.sum()), dtype=np.int64) + np.repeat(starts - offs, lens)
+        win.reshape(-1)[idx] = np.repeat(ops["value"], lens)
+        return
+    for x, y, w, h, data in ops:
+        win[y - oy:y - oy + h, x - ox:x - ox + w] = data
+
+
+def apply_tile_patch(scene_id: str, user_id, r: int, c: int, base: int, body: bytes,
+                     encoding: Optional[str] = None, fmt: str = "rects") -> dict:
+    """Apply a delta patch to a stored tile, all or nothing.
+
+    `base` is the tile_version the client edited from; when it is not the
+    current version PatchConflict is raised and nothing is written (the
+    client then sends the full tile instead). Only the bounding box of the
+    patch is read and written back, so only the chunks under it are touched.
+    """
+    st, t = _tile_ctx(scene_id, user_id, r, c)
+    tw, th = int(t["w"]), int(t["h"])
+    # worst case is one RLE run per pixel
+    raw = decode_body(body, encoding, max_size=tw * th * _RLE_REC.itemsize)
+    if fmt == "rle":
+        ops = _parse_rle(raw, tw, th)
+    elif fmt == "rects":
+        ops = _parse_rects(raw, tw, th)
+    else:
+        raise ValueError(f"unknown patch format: {fmt}")
+    rect = _patch_rect(fmt, ops, tw)
+
+    with st.lock:
+        cur = tile_version(st, r, c)
+        if int(base) != cur:
+            raise PatchConflict(cur)
+        info = {"r": r, "c": c, "x": int(t["x"]), "y": int(t["y"]), "w": tw, "h": th,
+                "changed_chunks": 0, "tile_version": cur, "parts": len(ops)}
+        if rect is None:
+            return info
+        px, py, pw, ph = rect
+        win = st.read_window(int(t["x"]) + px, int(t["y"]) + py, pw, ph)   # fresh array
+        _apply_ops(win, fmt, ops, px, py, tw)
+        _check_classes(win)
+        tiles = dict(st.meta().get("tiles") or {})
+        tiles[f"{r}_{c}"] = cur + 1
+        changed = st.write_window(int(t["x"]) + px, int(t["y"]) + py, win, meta={"tiles": tiles})
+        if changed:
+            info.update(changed_chunks=len(changed), tile_version=cur + 1)
+    if changed:
+        record_latest(scene_id, r, c, user_id, {"kind": "labels", "tile_version": info["tile_version"]})
+    return info
@@ -0,0 +1,259 @@
+# services/training_export.py
+"""
+Training-patch export: band stacks + label masks → sharded .npz for retraining.
+
+The scene is cut into non-overlapping MODEL_INPUT_SIZE patches on the label
+grid (the grid manifest of the aligned RGB GeoTIFF). Labels come from one
+annotator's chunk store or from the consensus labels. The main process reads
+the labels one patch row at a time and decides which patches to keep with a
+single reshape over the strip — a patch must lie inside tiles that were
+actually saved (an unsaved tile is unlabelled, not background) and have at
+least TRAIN_MIN_LABELLED of its pixels labelled.
+
+Kept patches are grouped into shards of TRAIN_SHARD_PATCHES. Each shard is
+one task for a process pool: the worker reads the MODEL_BANDS windows itself
+(per-band GeoTIFFs exported from the scene ZIP, warped onto the label grid)
+and writes ``shard_NNNNN.npz`` with
+
+    x   (N, C, S, S)  raw band values (source dtype)
+    y   (N, S, S)     uint8 class ids
+    xy  (N, 2)        patch origin (x, y) in scene pixels
+
+Only a bounded number of shards is in flight, so memory stays at about
+workers × one shard. index.json lists shards, patch counts and class pixel
+counts; the new export replaces the previous one when it is complete.
+"""
+from __future__ import annotations
+
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from config import settings
+from services.consensus import SCORES_NAME, consensus_root
+from services.fsutil import safe_name, tmp_path
+from services.mask_store import ChunkedMaskStore
+from services.progress import set_progress
+from services.s2 import _encode_workers, _scene_lock, get_scene_by_id, load_grid_manifest, scene_cache_dir
+from services.tile_masks import user_label_store
+from services.vectorize import export_dir
+
+INDEX_NAME = "index.json"
+CONSENSUS = "consensus"
+# progress ranges of the phases: band export, label pre-check + submit, last shards
+_P_BANDS, _P_PATCHES, _P_SHARDS = (0.0, 20.0), (20.0, 80.0), (80.0, 99.0)
+
+
+def training_dir(scene_id: str, source) -> Path:
+    who = CONSENSUS if str(source) == CONSENSUS else f"u{safe_name(source)}"
+    return export_dir(scene_id) / "training" / who
+
+
+def _span(rng, frac: float) -> float:
+    return rng[0] + (rng[1] - rng[0]) * max(0.0, min(1.0, frac))
+
+
+def _check_bands(bands) -> List[str]:
+    if not isinstance(bands, (list, tuple)) or not bands or not all(isinstance(b, str) and b for b in bands):
+        raise ValueError("bands must be a non-empty list of band names")
+    return list(bands)
+
+
+def scene_band_paths(scene_id: str, bands: List[str]) -> Dict[str, Path]:
+    """Per-band aligned GeoTIFFs of a scene, exported from its ZIP once and cached."""
+    d = scene_cache_dir(scene_id) / "bands"
+    paths = {b: d / f"{b}.tif" for b in bands}
+    missing = [b for b, p in paths.items() if not p.exists()]
+    if not missing:
+        return paths
+    item = get_scene_by_id(scene_id)
+    if not item or item.kind != "zip":
+        raise LookupError(f"bands {missing} not cached and the scene ZIP is not available")
+    from Library.S2reader import SentinelProductReader
+    rdr = SentinelProductReader(item.path)
+    d.mkdir(parents=True, exist_ok=True)
+    with _scene_lock(scene_id):
+        for i, b in enumerate(missing):
+            set_progress("bands", _span(_P_BANDS, i / len(missing)), f"exporting {b}")
+            if paths[b].exists():
+                continue
+            tmp = tmp_path(paths[b])
+            # 10 m where the band has it; 20/60 m bands are upsampled by the warp onto the label grid
+            try:
+                try:
+                    rdr.export_esri_aligned_tif(b, str(tmp), resolution=10)
+                except ValueError:
+                    rdr.export_esri_aligned_tif(b, str(tmp))
+                os.replace(tmp, paths[b])
+            finally:
+                tmp.unlink(missing_ok=True)
+    set_progress("bands", _P_BANDS[1], f"{len(missing)} bands exported")
+    return paths
+
+
+def _label_store(scene_id: str, source):
+    """(store, saved tile keys "r_c") of an annotator or of the consensus labels."""
+    if str(source) == CONSENSUS:
+        root = consensus_root(scene_id)
+        try:
+            tiles = json.loads((root / SCORES_NAME).read_text(encoding="utf-8")).get("tiles") or {}
+        except FileNotFoundError:
+            raise LookupError("no consensus yet")
+        return ChunkedMaskStore(root / "labels"), set(tiles)
+    st = user_label_store(scene_id, source)
+    if not st.exists():
+        raise LookupError("no saved labels")
+    return st, {k for k, v in (st.meta().get("tiles") or {}).items() if int(v) > 0}
+
+
+def select_patches(labels: np.ndarray, saved: np.ndarray, size: int, min_labelled: float) -> np.ndarray:
+    """Keep-flags of the patches of one (size, W) label strip, in one pass over the strip."""
+    nx = labels.shape[1] // size
+    w = nx * size
+    lab = (labels[:, :w] > 0).reshape(size, nx, size).sum(axis=(0, 2))
+    cov = saved[:, :w].reshape(size, nx, size).all(axis=(0, 2))
+    return cov & (lab >= max(1, min_labelled * size * size))
+
+
+def _write_shard(task: dict) -> dict:
+    """Pool worker: read the band windows of one shard's patches and write its .npz."""
+    S, xy, bands = task["size"], task["xy"], task["bands"]
+    W, H = task["width"], task["height"]
+    crs, transform = task["crs"], Affine(*task["transform"])
+    x = None
+    for ci, path in enumerate(bands):
+        with rasterio.open(path) as src, WarpedVRT(src, crs=crs or src.crs, transform=transform,
+                                                   width=W, height=H, resampling=Resampling.nearest) as vrt:
+            if x is None:
+                x = np.zeros((len(xy), len(bands), S, S), dtype=vrt.dtypes[0])
+            for i, (px, py) in enumerate(xy):
+                x[i, ci] = vrt.read(1, window=Window(int(px), int(py), S, S))
+    # patches outside the band footprint (all bands nodata everywhere) are dropped here
+    keep = x.reshape(len(xy), -1).any(axis=1)
+    y = task["labels"][keep]
+    np.savez_compressed(task["path"], x=x[keep], y=y, xy=np.asarray(xy, dtype=np.int32)[keep])
+    return {"file": Path(task["path"]).name, "count": int(keep.sum()), "dropped": int((~keep).sum()),
+            "classes": np.bincount(y.ravel(), minlength=256)[:256].tolist()}
+
+
+def _pool_workers() -> int:
+    n = int(getattr(settings, "TRAIN_EXPORT_WORKERS", 0) or 0)
+    return n if n > 0 else _encode_workers()
+
+
+def export_training_patches(scene_id: str, source, bands: Optional[List[str]] = None,
+                            size: Optional[int] = None) -> dict:
+    """Write EXPORTS_DIR/<scene>/training/<u<user>|consensus>/shard_*.npz + index.json."""
+    man = load_grid_manifest(scene_id)
+    if not man or not man.get("transform"):
+        raise LookupError("tiles not found")
+    W, H = int(man["W"]), int(man["H"])
+    bands = _check_bands(settings.MODEL_BANDS if bands is None else bands)
+    S = int(size or settings.MODEL_INPUT_SIZE)
+    per_shard = max(1, int(settings.TRAIN_SHARD_PATCHES))
+    st, saved_keys = _label_store(scene_id, source)
+    if st.shape != (H, W):
+        raise LookupError("labels do not match the scene grid")
+    band_paths = scene_band_paths(scene_id, bands)
+    tiles = [t for t in man.get("tiles", []) if f"{int(t['r'])}_{int(t['c'])}" in saved_keys]
+    if not tiles:
+        raise LookupError("no saved tiles")
+
+    out = training_dir(scene_id, source)
+    work = out.with_name(f".{out.name}.work")
+    shutil.rmtree(work, ignore_errors=True)
+    work.mkdir(parents=True)
+    base = {"size": S, "width": W, "height": H, "crs": man.get("crs"),
+            "transform": list(man["transform"][:6]), "bands": [str(band_paths[b]) for b in bands]}
+
+    t0 = time.perf_counter()
+    ny = H // S
+    workers = _pool_workers()
+    shards: List[dict] = []
+    candidates = 0
+    pend_xy: List[tuple] = []
+    pend_y: List[np.ndarray] = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            running = set()
+
+            def _flush():
+                nonlocal running
+                task = {**base, "xy": list(pend_xy), "labels": np.stack(pend_y),
+                        "path": str(work / f"shard_{len(shards) + len(running):05d}.npz")}
+                pend_xy.clear()
+                pend_y.clear()
+                while len(running) >= 2 * workers:   # bounded number of shards in memory
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    shards.extend(f.result() for f in done)
+                running.add(ex.submit(_write_shard, task))
+
+            for py in range(ny):
+                y0 = py * S
+                strip = st.read_window(0, y0, W, S)
+                saved = np.zeros((S, W), dtype=bool)
+                for t in tiles:
+                    tx, ty, tw, th = (int(t[k]) for k in ("x", "y", "w", "h"))
+                    if ty < y0 + S and ty + th > y0:
+                        saved[max(0, ty - y0):min(S, ty + th - y0), tx:tx + tw] = True
+                keep = select_patches(strip, saved, S, float(settings.TRAIN_MIN_LABELLED))
+                for px in np.flatnonzero(keep):
+                    pend_xy.append((int(px) * S, y0))
+                    pend_y.append(strip[:, px * S:(px + 1) * S].copy())
+                    if len(pend_xy) >= per_shard:
+                        _flush()
+                candidates += int(keep.sum())
+                set_progress("training_export", _span(_P_PATCHES, (py + 1) / max(1, ny)), f"rows {py + 1}/{ny}")
+            if pend_xy:
+                _flush()
+            total = len(shards) + len(running)
+            while running:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                shards.extend(f.result() for f in done)
+                set_progress("shards", _span(_P_SHARDS, len(shards) / max(1, total)),
+                             f"shards {len(shards)}/{total}")
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)
+        raise
+
+    shards.sort(key=lambda s: s["file"])
+    classes = np.sum([s.pop("classes") for s in shards], axis=0) if shards else np.zeros(256, dtype=np.int64)
+    n = sum(s["count"] for s in shards)
+    res = {
+        "scene_id": scene_id, "source": str(source), "bands": bands, "size": S,
+        "crs": man.get("crs"), "transform": base["transform"], "width": W, "height": H,
+        "mean": list(settings.MODEL_MEAN), "std": list(settings.MODEL_STD),
+        "patches": n, "dropped_nodata": sum(s["dropped"] for s in shards),
+        "class_pixels": {str(k): int(v) for k, v in enumerate(classes) if v},
+        "shards": shards, "created": time.time(), "seconds": round(time.perf_counter() - t0, 3),
+    }
+    (work / INDEX_NAME).write_text(json.dumps(res, ensure_ascii=False, separators=(",", ":")), encoding="utf-8")
+    old = out.with_name(f".{out.name}.old")
+    shutil.rmtree(old, ignore_errors=True)
+    if out.exists():
+        os.replace(out, old)
+    os.replace(work, out)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f"[training_export] {scene_id}/{source}: {n} patches of {candidates} candidates "
+          f"in {len(shards)} shards, {res['seconds']:.2f}s")
+    set_progress("done", 100, f"{n} patches")
+    return res
+
+
+def load_training_index(scene_id: str, source) -> Optional[dict]:
+    try:
+        return json.loads((training_dir(scene_id, source) / INDEX_NAME).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
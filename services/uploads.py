@@ -0,0 +1,274 @@
+# services/uploads.py
+"""
+Chunked, resumable uploads of Sentinel-2 product ZIPs straight into SCENES_DIR.
+
+Flow: init → PUT chunks at increasing offsets → finalize.
+  - data is appended to  SCENES_DIR/.<upload_id>.part  (hidden, skipped by list_s2_scenes)
+  - a small sidecar      SCENES_DIR/.<upload_id>.upload.json  keeps the metadata
+  - the file size on disk is the resume offset; sha256 is updated per chunk
+    while one process has seen every byte, otherwise finalize re-reads the file
+  - finalize checks size, reads the ZIP central directory, and renames into place
+  - only the user who started an upload may touch it; stale uploads expire
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import zipfile
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from config import settings
+from services.fsutil import write_atomic
+
+# قفل فایل بین پروسه‌ها (چند worker)؛ روی ویندوز فقط قفل thread
+try:
+    import fcntl
+except Exception:
+    fcntl = None
+
+_LOCK = threading.Lock()
+_HASHERS: Dict[str, Tuple["hashlib._Hash", int]] = {}   # upload_id → (running sha256, bytes hashed); memory only
+_UPLOAD_LOCKS: Dict[str, threading.Lock] = {}
+_ID_RE = re.compile(r"^[0-9a-f]{24}$")
+
+class UploadError(Exception):
+    def __init__(self, msg: str, status: int = 400):
+        super().__init__(msg)
+        self.status = status
+
+@dataclass
+class UploadState:
+    id: str
+    filename: str
+    size: int
+    user_id: Optional[int] = None
+    created: float = field(default_factory=time.time)
+    sha256: Optional[str] = None        # expected digest (optional, from client)
+
+# -------------- paths --------------
+
+def _root() -> Path:
+    root = settings.SCENES_DIR
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+def _part_path(upload_id: str) -> Path:
+    return _root() / f".{upload_id}.part"
+
+def _meta_path(upload_id: str) -> Path:
+    return _root() / f".{upload_id}.upload.json"
+
+def _check_id(upload_id: str) -> str:
+    if not _ID_RE.match(upload_id or ""):
+        raise UploadError("bad upload id", 404)
+    return upload_id
+
+def _safe_zip_name(name: str) -> str:
+    name = os.path.basename(str(name or "")).strip()
+    name = "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in name)
+    if not name.lower().endswith(".zip"):
+        raise UploadError("only .zip products are accepted")
+    return name
+
+# -------------- state --------------
+
+def _load(upload_id: str) -> UploadState:
+    p = _meta_path(_check_id(upload_id))
+    if not p.exists():
+        raise UploadError("upload not found", 404)
+    return UploadState(**json.loads(p.read_text(encoding="utf-8")))
+
+def _save(st: UploadState) -> None:
+    write_atomic(_meta_path(st.id), json.dumps(asdict(st), ensure_ascii=False))
+
+def _upload_lock(upload_id: str) -> threading.Lock:
+    with _LOCK:
+        return _UPLOAD_LOCKS.setdefault(upload_id, threading.Lock())
+
+def _owned(upload_id: str, user_id) -> UploadState:
+    """State of an upload that `user_id` started (403 for anyone else)."""
+    st = _load(upload_id)
+    if st.user_id is not None and str(st.user_id) != str(user_id):
+        raise UploadError("not your upload", 403)
+    return st
+
+def sweep_expired(now: Optional[float] = None) -> int:
+    """Remove .part files and sidecars untouched for UPLOAD_EXPIRE_HOURS; returns how many uploads."""
+    ttl = float(settings.UPLOAD_EXPIRE_HOURS) * 3600.0
+    if ttl <= 0:
+        return 0
+    now = time.time() if now is None else now
+    removed = 0
+    for meta in _root().glob(".*.upload.json"):
+        upload_id = meta.name[1:-len(".upload.json")]
+        if not _ID_RE.match(upload_id):
+            continue
+        part = _part_path(upload_id)
+        try:
+            last = max(meta.stat().st_mtime, part.stat().st_mtime if part.exists() else 0.0)
+        except FileNotFoundError:
+            continue
+        if now - last > ttl:
+            _HASHERS.pop(upload_id, None)
+            part.unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+            removed += 1
+    for part in _root().glob(".*.part"):   # parts whose sidecar is gone
+        upload_id = part.name[1:-len(".part")]
+        if _ID_RE.match(upload_id) and not _meta_path(upload_id).exists():
+            try:
+                if now - part.stat().st_mtime > ttl:
+                    part.unlink(missing_ok=True)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    if removed:
+        print(f"[uploads] expired {removed} stale upload(s)")
+    return removed
+
+def _offset(upload_id: str) -> int:
+    try:
+        return _part_path(upload_id).stat().st_size
+    except FileNotFoundError:
+        return 0
+
+def status(upload_id: str, user_id=None) -> dict:
+    st = _owned(upload_id, user_id)
+    return {"upload_id": st.id, "filename": st.filename, "size": st.size,
+            "offset": _offset(st.id), "chunk_size": int(settings.UPLOAD_CHUNK_SIZE)}
+
+# -------------- API --------------
+
+def init_upload(filename: str, size: int, user_id: Optional[int] = None,
+                sha256: Optional[str] = None) -> dict:
+    name = _safe_zip_name(filename)
+    size = int(size)
+    if size <= 0:
+        raise UploadError("size must be > 0")
+    if size > int(settings.UPLOAD_MAX_BYTES):
+        raise UploadError("file too large", 413)
+    sweep_expired()
+    if (_root() / name).exists():
+        raise UploadError(f"{name} already exists", 409)
+    st = UploadState(id=secrets.token_hex(12), filename=name, size=size, user_id=user_id,
+                     sha256=(sha256 or "").lower() or None)
+    _part_path(st.id).touch()
+    _save(st)
+    return status(st.id, user_id)
+
+def write_chunk(upload_id: str, offset: int, stream: BinaryIO, length: int,
+                chunk_sha256: Optional[str] = None, user_id=None) -> dict:
+    """Append `length` bytes from `stream` at `offset` (must equal the current size).
+
+    The body is copied from the WSGI input in 1 MiB pieces into the part file, so
+    nothing is buffered to a temp file first. A repeated chunk (offset below the
+    current size, e.g. a retry after a lost response) is acknowledged without
+    rewriting anything.
+    """
+    st = _owned(upload_id, user_id)
+    offset, length = int(offset), int(length)
+    if length <= 0 or length > int(settings.UPLOAD_CHUNK_SIZE):
+        raise UploadError("bad chunk length")
+    with _upload_lock(st.id), open(_part_path(st.id), "r+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)   # another worker process may be appending too
+        cur = _offset(st.id)
+        if offset + length <= cur:
+            return {"upload_id": st.id, "offset": cur, "size": st.size, "duplicate": True}
+        if offset != cur:
+            raise UploadError(f"offset mismatch: expected {cur}", 409)
+        if offset + length > st.size:
+            raise UploadError("chunk exceeds declared size")
+        hasher, hashed = _HASHERS.get(st.id) or (None, 0)
+        if hasher is None and cur == 0:
+            hasher = hashlib.sha256()
+        elif hashed != cur:
+            # bytes were written by another process (or before a restart): finalize re-hashes
+            hasher = None
+        _HASHERS.pop(st.id, None)
+        out = _append(f, st, offset, length, stream, hasher, chunk_sha256)
+        if hasher is not None:
+            _HASHERS[st.id] = (hasher, offset + length)
+        return out
+
+def _append(f: BinaryIO, st: UploadState, offset: int, length: int, stream: BinaryIO,
+            hasher, chunk_sha256: Optional[str]) -> dict:
+    piece = hashlib.sha256() if chunk_sha256 else None
+    done = 0
+    f.seek(offset)
+    while done < length:
+        buf = stream.read(min(1 << 20, length - done))
+        if not buf:
+            break
+        f.write(buf)
+        if piece is not None:
+            piece.update(buf)
+        if hasher is not None:
+            hasher.update(buf)
+        done += len(buf)
+    if done != length or (piece is not None and piece.hexdigest() != chunk_sha256.lower()):
+        # roll back the partial / corrupt chunk; the running hash (already dropped) is no longer valid
+        f.truncate(offset)
+        raise UploadError("incomplete chunk" if done != length else "chunk checksum mismatch")
+    f.flush()
+    return {"upload_id": st.id, "offset": offset + length, "size": st.size}
+
+def _file_sha256(p: Path) -> str:
+    h = hashlib.sha256()
+    with open(p, "rb") as f:
+        for buf in iter(lambda: f.read(8 << 20), b""):
+            h.update(buf)
+    return h.hexdigest()
+
+def _validate_product_zip(p: Path) -> int:
+    """Read only the ZIP central directory; require at least one L2A band JP2."""
+    try:
+        with zipfile.ZipFile(p) as z:
+            names = z.namelist()
+    except zipfile.BadZipFile as e:
+        raise UploadError(f"bad zip: {e}")
+    if not any(re.search(r"_B(\d{2}|8A)_(10|20|60)m\.jp2$", n) for n in names):
+        raise UploadError("zip has no Sentinel-2 L2A band rasters")
+    return len(names)
+
+def finalize(upload_id: str, user_id=None) -> dict:
+    st = _owned(upload_id, user_id)
+    with _upload_lock(st.id):
+        out = _finalize_locked(st)
+    with _LOCK:
+        _UPLOAD_LOCKS.pop(st.id, None)
+    return out
+
+def _finalize_locked(st: UploadState) -> dict:
+    part = _part_path(st.id)
+    cur = _offset(st.id)
+    if cur != st.size:
+        raise UploadError(f"incomplete upload: {cur}/{st.size} bytes", 409)
+
+    hasher, hashed = _HASHERS.pop(st.id, None) or (None, 0)
+    # a hash that saw every byte in this process, else re-read (other worker, restart)
+    digest = hasher.hexdigest() if hasher is not None and hashed == cur else _file_sha256(part)
+    if st.sha256 and st.sha256 != digest:
+        raise UploadError("sha256 mismatch", 422)
+    entries = _validate_product_zip(part)
+
+    dst = _root() / st.filename
+    if dst.exists():
+        raise UploadError(f"{st.filename} already exists", 409)
+    os.replace(part, dst)
+    _meta_path(st.id).unlink(missing_ok=True)
+    return {"path": str(dst.resolve()), "name": dst.name, "size": st.size,
+            "sha256": digest, "entries": entries}
+
+def abort_upload(upload_id: str, user_id=None) -> None:
+    _owned(upload_id, user_id)
+    _HASHERS.pop(upload_id, None)
+    _part_path(upload_id).unlink(missing_ok=True)
+    _meta_path(upload_id).unlink(missing_ok=True)
@@ -0,0 +1,235 @@
+# services/vectorize.py
+"""
+Raster → vector export of class masks.
+
+Each non-empty chunk of a ChunkedMaskStore is polygonised on its own
+(rasterio.features.shapes, in a thread pool — chunk decode and GDAL release
+the GIL). Polygons that touch an inner chunk seam are held back and unioned
+per class with the pieces from the neighbouring chunks; everything else is
+written out immediately. Rows of chunks are processed top to bottom and only
+polygons reaching the bottom seam of the current row stay open, so memory is
+bounded by one row of chunks plus the shapes crossing it.
+
+Polygons are simplified in pixel space, georeferenced with the scene
+transform from the grid manifest, reprojected to WGS84 and streamed to
+GeoJSON; FlatGeobuf is produced from that file with ogr2ogr.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import rasterio
+import shapely
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.features import shapes
+from rasterio.warp import transform as warp_transform
+from shapely.ops import unary_union
+
+from config import settings
+from services.fsutil import safe_name, tmp_path
+from services.mask_store import ChunkedMaskStore, scene_mask_store
+from services.progress import set_progress
+from services.s2 import _encode_workers, load_grid_manifest
+from services.tile_masks import user_label_store
+
+FORMATS = {"geojson": ".geojson", "fgb": ".fgb"}
+
+_LOCKS: dict = {}
+_LOCKS_GUARD = threading.Lock()
+
+
+def export_dir(scene_id: str) -> Path:
+    return settings.EXPORTS_DIR / safe_name(scene_id)
+
+
+def label_source(scene_id: str, user_id=None) -> Tuple[ChunkedMaskStore, Affine, Optional[str]]:
+    """(store, pixel→map transform, CRS) of a user's labels, or of the scene mask when user_id is None."""
+    man = load_grid_manifest(scene_id) or {}
+    if man.get("transform"):
+        transform, crs = Affine(*man["transform"][:6]), man.get("crs")
+    elif settings.S2_RGB_TIF.exists():
+        with rasterio.open(settings.S2_RGB_TIF) as src:
+            transform, crs = src.transform, (src.crs.to_string() if src.crs else None)
+    else:
+        raise LookupError("scene has no georeference (grid manifest / s2_rgb.tif)")
+    st = scene_mask_store() if user_id is None else user_label_store(scene_id, user_id)
+    if not st.exists():
+        raise LookupError("no saved labels")
+    return st, transform, crs
+
+
+def _chunk_polygons(st: ChunkedMaskStore, ix: dict, cy: int, cx: int):
+    """(finished, on_seam) lists of (class, pixel-space polygon) for one chunk."""
+    if f"{cy}_{cx}" not in (ix.get("chunks") or {}):
+        return [], []
+    H, W = st.shape
+    ox, oy, cw, ch = st.chunk_rect(cy, cx)
+    arr = st.read_chunk(cy, cx, ix)
+    rings, ring_poly, vals = [], [], []
+    for i, (geom, val) in enumerate(shapes(arr, mask=arr > 0, connectivity=4,
+                                            transform=Affine.translation(ox, oy))):
+        rings += geom["coordinates"]
+        ring_poly += [i] * len(geom["coordinates"])
+        vals.append(int(val))
+    if not vals:
+        return [], []
+    # all rings → shapely in two vectorised calls (first ring of each polygon is the shell)
+    lens = [len(r) for r in rings]
+    xy = np.array(list(chain.from_iterable(rings)), dtype=np.float64)
+    lr = shapely.linearrings(xy, indices=np.repeat(np.arange(len(rings)), lens))
+    polys = shapely.polygons(lr, indices=np.asarray(ring_poly))
+    x0, y0, x1, y1 = shapely.bounds(polys).T
+    on_seam = (((x0 == ox) & (ox > 0)) | ((y0 == oy) & (oy > 0))
+               | ((x1 == ox + cw) & (ox + cw < W)) | ((y1 == oy + ch) & (oy + ch < H)))
+    done = [(k, g) for k, g, s in zip(vals, polys, on_seam) if not s]
+    seam = [(k, g) for k, g, s in zip(vals, polys, on_seam) if s]
+    return done, seam
+
+
+def iter_polygons(st: ChunkedMaskStore, workers: Optional[int] = None,
+                  on_row=None) -> Iterator[List[Tuple[int, object]]]:
+    """Yield one list of (class, polygon) per row of chunks, pixel coordinates, seams merged."""
+    ix = st.index()
+    H, W = st.shape
+    ny, nx = st.chunk_grid()
+    open_: List[Tuple[int, object]] = []
+    with ThreadPoolExecutor(max_workers=max(1, min(nx, workers or _encode_workers()))) as ex:
+        submit = lambda cy: [ex.submit(_chunk_polygons, st, ix, cy, cx) for cx in range(nx)]
+        nxt = submit(0)
+        for cy in range(ny):
+            cur, nxt = nxt, (submit(cy + 1) if cy + 1 < ny else [])   # next row polygonises meanwhile
+            out, cand = [], open_
+            for fut in cur:
+                done, seam = fut.result()
+                out += done
+                cand = cand + seam
+            y1 = min(H, (cy + 1) * st.chunk)
+            by_cls = defaultdict(list)
+            for k, g in cand:
+                by_cls[k].append(g)
+            open_ = []
+            for k, gs in by_cls.items():
+                merged = unary_union(gs) if len(gs) > 1 else gs[0]
+                for g in getattr(merged, "geoms", [merged]):
+                    if y1 < H and g.bounds[3] == y1:
+                        open_.append((k, g))   # may continue in the next row
+                    else:
+                        out.append((k, g))
+            if on_row:
+                on_row(cy + 1, ny)
+            yield out
+
+
+def _to_map(transform: Affine, crs: Optional[str]):
+    """Vectorised (N,2) pixel → WGS84 (or map units without a CRS) coordinate function."""
+    src = CRS.from_user_input(crs) if crs else None
+    m = np.array([[transform.a, transform.d], [transform.b, transform.e]])
+    off = np.array([transform.c, transform.f])
+
+    def fn(xy: np.ndarray) -> np.ndarray:
+        xy = xy @ m + off
+        if src is not None and src.to_epsg() != 4326:
+            xs, ys = warp_transform(src, "EPSG:4326", xy[:, 0], xy[:, 1])
+            xy = np.column_stack([xs, ys])
+        return xy
+    return fn
+
+
+def _features(st, transform: Affine, crs: Optional[str], simplify: float, on_row=None) -> Iterator[Tuple[int, str]]:
+    """(class, GeoJSON Feature text); simplify/georeference/serialise run on whole row batches."""
+    names = {int(c.get("id", i)): json.dumps(c.get("name"), ensure_ascii=False)
+             for i, c in enumerate(settings.CLASS_LIST)}
+    to_map = _to_map(transform, crs)
+    for batch in iter_polygons(st, on_row=on_row):
+        if not batch:
+            continue
+        cls = [k for k, _ in batch]
+        geoms = np.array([g for _, g in batch], dtype=object)
+        areas = shapely.area(geoms)
+        if simplify > 0:
+            geoms = shapely.simplify(geoms, simplify, preserve_topology=True)
+        geoms = shapely.transform(geoms, to_map)
+        for k, a, g, gj in zip(cls, areas, geoms, shapely.to_geojson(geoms)):
+            if g.is_empty:
+                continue
+            yield k, (f'{{"type":"Feature","geometry":{gj},"properties":'
+                      f'{{"class":{k},"name":{names.get(k, "null")},"area_px":{int(a)}}}}}')
+
+
+def _write_geojson(features, path: Path) -> dict:
+    """Stream a FeatureCollection to `path` (temp file + rename); returns per-class feature counts."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_path(path)
+    counts = defaultdict(int)
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write('{"type":"FeatureCollection","features":[\n')
+        n = 0
+        for k, text in features:
+            f.write((",\n" if n else "") + text)
+            counts[k] += 1
+            n += 1
+        f.write("\n]}\n")
+    os.replace(tmp, path)
+    return dict(counts)
+
+
+def _export_lock(key: str) -> threading.Lock:
+    with _LOCKS_GUARD:
+        return _LOCKS.setdefault(key, threading.Lock())
+
+
+def result_path(scene_id: str, user_id=None, fmt: str = "geojson") -> Path:
+    who = "scene" if user_id is None else f"u{safe_name(user_id)}"
+    return export_dir(scene_id) / f"polygons_{who}{FORMATS[fmt]}"
+
+
+def vectorize_labels(scene_id: str, user_id=None, fmt: str = "geojson",
+                     simplify: Optional[float] = None, publish: bool = False) -> dict:
+    """Vectorise a user's labels (or the scene mask) into EXPORTS_DIR/<scene>/polygons_<who>.<ext>.
+
+    publish=True also replaces POLYGONS_GEOJSON with the result.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown format: {fmt}")
+    st, transform, crs = label_source(scene_id, user_id)
+    tol = float(settings.VECTORIZE_SIMPLIFY_PX if simplify is None else simplify)
+    out = result_path(scene_id, user_id, fmt)
+    gj = result_path(scene_id, user_id, "geojson")
+    t0 = time.perf_counter()
+
+    def _row(done, total):
+        set_progress("vectorize", 100.0 * done / total * (0.9 if fmt == "fgb" else 1.0),
+                     f"rows {done}/{total}")
+
+    with _export_lock(str(out)):
+        with st.snapshot() as snap:   # one consistent version; saves are not blocked meanwhile
+            counts = _write_geojson(_features(snap, transform, crs, tol, on_row=_row), gj)
+        if fmt == "fgb":
+            exe = shutil.which("ogr2ogr")
+            if not exe:
+                raise RuntimeError("FlatGeobuf export needs ogr2ogr on PATH")
+            tmp = tmp_path(out)
+            subprocess.run([exe, "-f", "FlatGeobuf", "-nln", "labels", str(tmp), str(gj)], check=True)
+            os.replace(tmp, out)
+        if publish:
+            settings.POLYGONS_GEOJSON.parent.mkdir(parents=True, exist_ok=True)
+            tmp = tmp_path(settings.POLYGONS_GEOJSON)
+            shutil.copyfile(gj, tmp)
+            os.replace(tmp, settings.POLYGONS_GEOJSON)
+    dt = time.perf_counter() - t0
+    n = sum(counts.values())
+    print(f"[vectorize] {scene_id}/{'scene' if user_id is None else user_id}: {n} polygons in {dt:.2f}s → {out.name}")
+    set_progress("done", 100, f"{n} polygons")
+    return {"path": str(out), "features": n, "by_class": counts, "seconds": round(dt, 3)}
@@ -0,0 +1,421 @@
+# services_test.py
+"""Checks of the helpers and stores behind tiles, masks, consensus and exports: python -m pytest services_test.py"""
+from io import BytesIO
+import hashlib
+import subprocess
+import sys
+import threading
+import zipfile
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from Library.S2reader import SentinelProductReader
+import services.consensus as consensus
+from services.consensus import build_consensus, vote
+from config import settings
+from services.mask_history import add_version, blob_path, list_versions
+from services.mask_index import get_latest, png_hashes, record_latest, scene_latest
+from services.mask_store import LOCK_NAME, ChunkedMaskStore, mode2x2
+from services.progress import get_progress, start_job
+from services.s2 import _adler32_combine, _scene_lock, encode_png_parallel
+import services.tile_masks as tile_masks
+from services.tile_masks import (
+    _RECT_HDR, _RLE_REC, PatchConflict, ShapeConflict, _apply_ops, _parse_rects, _parse_rle, _patch_rect,
+    apply_tile_patch, save_tile_classes, tile_version, user_label_store,
+)
+from services.training_export import select_patches
+from services import uploads
+
+rng = np.random.default_rng(0)
+
+
+@pytest.fixture
+def out_dir(tmp_path, monkeypatch):
+    """OUTPUT_DIR/SCENES_DIR in a temp dir, for the services that write to disk."""
+    monkeypatch.setattr(settings, "OUTPUT_DIR", tmp_path / "output")
+    monkeypatch.setattr(settings, "SCENES_DIR", tmp_path / "scenes")
+    settings.OUTPUT_DIR.mkdir()
+    settings.SCENES_DIR.mkdir()
+    return settings.OUTPUT_DIR
+
+
+# ---------- PNG encoder ----------
+@pytest.mark.parametrize("shape", [(1, 1), (37, 53), (300, 129, 3), (257, 64, 4)])
+def test_encode_png_parallel_roundtrip(shape):
+    arr = rng.integers(0, 256, shape, dtype=np.uint8)
+    data = encode_png_parallel(arr, level=1, strip_rows=16, workers=2)
+    back = np.asarray(Image.open(BytesIO(data)))
+    assert back.shape == arr.shape and (back == arr).all()
+
+
+def test_adler32_combine_matches_whole_buffer():
+    a, b = rng.bytes(70000), rng.bytes(123)
+    assert _adler32_combine(zlib.adler32(a), zlib.adler32(b), len(b)) == zlib.adler32(a + b)
+    assert _adler32_combine(1, zlib.adler32(b), len(b)) == zlib.adler32(b)
+
+
+# ---------- tile saves ----------
+def _grid(W, H, n=2):
+    """Grid manifest of n×n equal tiles (W, H divisible by n)."""
+    tw, th = W // n, H // n
+    return {"W": W, "H": H, "rows": n, "cols": n,
+            "tiles": [{"r": r, "c": c, "x": c * tw, "y": r * th, "w": tw, "h": th}
+                      for r in range(n) for c in range(n)]}
+
+
+@pytest.fixture
+def grid(out_dir, monkeypatch):
+    """Scene grid of the tile services; set `grid["man"]` to change it."""
+    g = {"man": _grid(16, 12)}
+    monkeypatch.setattr(tile_masks, "load_grid_manifest", lambda scene_id: g["man"])
+    monkeypatch.setattr(tile_masks, "record_latest", lambda *a, **k: None)
+    return g
+
+
+def test_save_refuses_store_of_another_size(grid):
+    tile = np.full((6, 8), 1, np.uint8)
+    assert save_tile_classes("S", 7, 0, 1, tile.tobytes())["tile_version"] == 1
+    grid["man"] = _grid(20, 12)                    # scene re-sliced at another size
+    with pytest.raises(ShapeConflict):
+        save_tile_classes("S", 7, 0, 0, tile.tobytes()[:40] + tile.tobytes()[:20])
+    st = user_label_store("S", 7)
+    assert st.shape == (12, 16) and (st.read_window(8, 0, 8, 6) == 1).all()
+
+
+# ---------- tile patches ----------
+def _rect(x, y, data):
+    h, w = data.shape
+    return np.array([(x, y, w, h)], dtype=_RECT_HDR).tobytes() + data.tobytes()
+
+
+def test_parse_rects_and_apply():
+    a = np.full((2, 3), 5, np.uint8)
+    b = np.array([[1], [2]], np.uint8)
+    ops = _parse_rects(_rect(1, 2, a) + _rect(7, 0, b), 8, 8)
+    assert [(x, y, w, h) for x, y, w, h, _ in ops] == [(1, 2, 3, 2), (7, 0, 1, 2)]
+    assert _patch_rect("rects", ops, 8) == (1, 0, 7, 4)
+    tile = np.zeros((8, 8), np.uint8)
+    _apply_ops(tile, "rects", ops, 0, 0, 8)
+    assert (tile[2:4, 1:4] == 5).all() and tile[1, 7] == 2 and tile.sum() == 5 * 6 + 3
+
+
+def test_apply_patch_checks_base(grid):
+    save_tile_classes("S", 7, 1, 1, np.zeros((6, 8), np.uint8).tobytes())
+    st = user_label_store("S", 7)
+    info = apply_tile_patch("S", 7, 1, 1, 1, _rect(2, 1, np.full((2, 3), 4, np.uint8)))
+    assert info["tile_version"] == 2 and info["changed_chunks"] == 1
+    assert (st.read_window(8 + 2, 6 + 1, 3, 2) == 4).all() and st.histogram()[4] == 6
+
+    with pytest.raises(PatchConflict) as e:       # made on version 1, tile is at 2 now
+        apply_tile_patch("S", 7, 1, 1, 1, _rect(0, 0, np.full((1, 1), 5, np.uint8)))
+    assert e.value.current == 2
+    assert tile_version(st, 1, 1) == 2 and st.histogram()[5] == 0
+    with pytest.raises(PatchConflict):             # a tile never saved is at version 0
+        apply_tile_patch("S", 7, 0, 0, 1, _rect(0, 0, np.full((1, 1), 5, np.uint8)))
+
+
+@pytest.mark.parametrize("body", [
+    _rect(6, 0, np.ones((1, 3), np.uint8)),       # outside the tile
+    _rect(0, 0, np.ones((2, 2), np.uint8))[:-1],  # truncated data
+    b"\x00\x00\x00",                              # truncated header
+])
+def test_parse_rects_rejects(body):
+    with pytest.raises(ValueError):
+        _parse_rects(body, 8, 8)
+
+
+def test_parse_rle_and_apply():
+    runs = np.array([(3, 4, 1), (10, 6, 2)], dtype=_RLE_REC)
+    ops = _parse_rle(runs.tobytes(), 4, 4)
+    x, y, w, h = _patch_rect("rle", ops, 4)
+    assert (x, y, w, h) == (0, 0, 4, 4)
+    tile = np.zeros(16, np.uint8)
+    _apply_ops(tile.reshape(4, 4), "rle", ops, 0, 0, 4)
+    assert tile.tolist() == [0, 0, 0, 1, 1, 1, 1, 0, 0, 0, 2, 2, 2, 2, 2, 2]
+
+
+def test_parse_rle_rejects():
+    with pytest.raises(ValueError):
+        _parse_rle(np.array([(14, 3, 1)], dtype=_RLE_REC).tobytes(), 4, 4)
+    with pytest.raises(ValueError):
+        _parse_rle(b"\x00" * 5, 4, 4)
+
+
+# ---------- pyramid ----------
+def _mode2x2_ref(a):
+    h, w = a.shape
+    a = np.pad(a, ((0, h & 1), (0, w & 1)), mode="edge")
+    out = np.empty((a.shape[0] // 2, a.shape[1] // 2), np.uint8)
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            q = a[2 * i:2 * i + 2, 2 * j:2 * j + 2].ravel()
+            vals, n = np.unique(q, return_counts=True)
+            best = [v for v, k in zip(vals, n) if k == n.max()]
+            nz = [v for v in best if v]
+            # ties: a non-zero class wins; among equals, the first in block order
+            cand = nz or best
+            out[i, j] = next(v for v in q if v in cand)
+    return out
+
+
+@pytest.mark.parametrize("shape", [(2, 2), (7, 9), (32, 33)])
+def test_mode2x2_matches_reference(shape):
+    a = rng.integers(0, 3, shape, dtype=np.uint8)
+    assert (mode2x2(a) == _mode2x2_ref(a)).all()
+
+
+def test_mode2x2_keeps_thin_labels():
+    a = np.zeros((4, 4), np.uint8)
+    a[:, 1] = 3                                   # 1-px line: ties 2:2 with background
+    assert (mode2x2(a)[:, 0] == 3).all()
+
+
+# ---------- chunk store ----------
+def _chunk_files(st):
+    return sorted(p.name for p in st.root.glob("*.z"))
+
+
+def test_store_commit_dedup_and_drop(out_dir):
+    st = ChunkedMaskStore(out_dir / "store", chunk=8, levels=0)
+    st.create(20, 12)                              # 3×2 chunks, edge chunks 4 px
+    a = np.zeros((12, 20), np.uint8)
+    a[2:10, 3:17] = 2
+    assert sorted(st.write_window(0, 0, a)) == [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)]
+    v, files = st.index()["version"], _chunk_files(st)
+    assert len(files) == 6 and (st.read_full() == a).all()
+    assert st.histogram().tolist()[:3] == [240 - 112, 0, 112]
+
+    assert st.write_window(0, 0, a) == []          # same content: no files, no commit
+    assert st.index()["version"] == v and _chunk_files(st) == files
+
+    b = a.copy()
+    b[0:8, 0:8] = 0                                # chunk (0, 0) becomes empty
+    b[9, 18] = 1
+    assert sorted(st.write_window(0, 0, b)) == [(0, 0), (1, 2)]
+    now = _chunk_files(st)
+    assert len(now) == 5 and not any(f.startswith(("0_0_", "1_2_")) and f in now for f in files)
+    assert "0_0" not in st.index()["chunks"] and (st.read_full() == b).all()
+    assert st.index()["version"] == v + 1
+
+
+def test_store_lock_is_held_across_processes(out_dir):
+    st = ChunkedMaskStore(out_dir / "store", chunk=8, levels=0)
+    with st.lock:
+        with st.lock:                              # re-entrant in the owning thread
+            assert _other_process(_STORE_LOCK_SCRIPT, st.root / LOCK_NAME) == "busy"
+        assert _other_process(_STORE_LOCK_SCRIPT, st.root / LOCK_NAME) == "busy"
+    assert _other_process(_STORE_LOCK_SCRIPT, st.root / LOCK_NAME) == "claimed"
+
+
+# ---------- tile mask history ----------
+def _png(i):
+    return b"\x89PNG fake %d" % i                 # the history stores bytes as they come
+
+
+def test_history_dedup_compaction_and_pinning(out_dir, monkeypatch):
+    monkeypatch.setattr(settings, "MASK_HISTORY_KEEP_LAST", 2)
+    monkeypatch.setattr(settings, "MASK_HISTORY_HOURLY_HOURS", 0)
+    first = add_version("S", 0, 1, _png(1), user="a")
+    assert first["created"] and first["path"].read_bytes() == _png(1)
+    again = add_version("S", 0, 1, _png(1), user="a")
+    assert not again["created"] and len(list_versions("S", 0, 1)) == 1
+
+    for i in (2, 3, 4):
+        add_version("S", 0, 1, _png(i), user="b")
+    hashes = [v["hash"] for v in list_versions("S", 0, 1)]
+    # last 2 versions + user a's latest (pinned); version 2 is gone with its blob
+    assert len(hashes) == 3 and hashes[0] == first["version"]["hash"]
+    assert [blob_path("S", h).read_bytes() for h in hashes] == [_png(1), _png(3), _png(4)]
+    blobs = sorted(p.name for p in (out_dir / "masks" / "S" / "_blobs").rglob("*.png"))
+    assert blobs == sorted(f"{h}.png" for h in hashes)
+
+
+def test_latest_index(out_dir):
+    record_latest("S", 0, 1, "u_1", {"kind": "png", "hash": "aa"})
+    record_latest("S", 0, 1, "u_1", {"kind": "png", "hash": "bb"})    # replaces the entry
+    record_latest("S", 2, 0, 7, {"kind": "labels", "tile_version": 3})
+    assert get_latest("S", 0, 1, "u_1")["hash"] == "bb" and get_latest("S", 0, 1, 7) is None
+    assert set(scene_latest("S")) == {("0", "1", "u_1"), ("2", "0", "7")}
+    assert png_hashes("S") == {"bb"} and png_hashes("S", 2, 0) == set()
+    add_version("S", 1, 1, _png(9), user="u_1")                     # PNG saves update the index
+    assert get_latest("S", 1, 1, "u_1")["hash"] in png_hashes("S", 1, 1)
+
+
+# ---------- grid ----------
+@pytest.mark.parametrize("size,n,block,edges", [
+    (2500, 3, 1024, [0, 1024, 2048, 2500]),
+    (900, 3, 0, [0, 300, 600, 900]),
+    (2000, 3, 1024, [0, 666, 1333, 2000]),        # smaller than n blocks: even split
+    (5490, 6, 1024, [0, 1024, 2048, 3072, 4096, 5120, 5490]),
+    (10, 1, 1024, [0, 10]),
+])
+def test_grid_edges(size, n, block, edges):
+    assert SentinelProductReader.grid_edges(size, n, block) == edges
+
+
+# ---------- consensus ----------
+def test_vote():
+    stack = np.array([[[1, 0]], [[1, 2]], [[2, 2]]], np.uint8)   # 3 annotators, 1×2 pixels
+    top, agree, ent = vote(stack, 3)
+    assert top.tolist() == [[1, 2]]
+    assert np.allclose(agree, 2 / 3)
+    assert np.allclose(ent, -(2 / 3 * np.log2(2 / 3) + 1 / 3 * np.log2(1 / 3)) / np.log2(3))
+
+
+def test_vote_unanimous_and_ties():
+    top, agree, ent = vote(np.full((4, 2, 2), 3, np.uint8), 4)
+    assert (top == 3).all() and (agree == 1).all() and (ent == 0).all()
+    top, _, _ = vote(np.array([[[2]], [[1]]], np.uint8), 3)
+    assert top[0, 0] == 1                          # ties → lower class id
+
+
+def test_build_consensus_streams_chunks(grid, monkeypatch):
+    monkeypatch.setattr(settings, "MASK_CHUNK", 4)  # tiles span several chunks
+    monkeypatch.setattr(consensus, "load_grid_manifest", lambda scene_id: grid["man"])
+    monkeypatch.setattr(consensus, "set_progress", lambda *a, **k: None)
+    labels = {u: rng.integers(0, 3, (12, 16), dtype=np.uint8) for u in ("a", "b", "c")}
+    for u, a in labels.items():
+        for t in grid["man"]["tiles"]:
+            if u == "c" and t["r"] == 1:
+                continue                           # c never saved the bottom row
+            x, y, w, h = t["x"], t["y"], t["w"], t["h"]
+            save_tile_classes("S", u, t["r"], t["c"], a[y:y + h, x:x + w].tobytes())
+    res = build_consensus("S", ["a", "b", "c"])
+    out = ChunkedMaskStore(consensus.consensus_root("S") / "labels")
+    assert out.chunk == 4 and res["tiles"]["1_0"]["users"] == ["a", "b"]
+    for t in grid["man"]["tiles"]:
+        x, y, w, h = t["x"], t["y"], t["w"], t["h"]
+        voters = res["tiles"][f"{t['r']}_{t['c']}"]["users"]
+        top, agree, _ = vote(np.stack([labels[u][y:y + h, x:x + w] for u in voters]), 3)
+        assert (out.read_window(x, y, w, h) == top).all()
+        assert abs(res["tiles"][f"{t['r']}_{t['c']}"]["agreement"] - float(agree.mean())) < 1e-4
+
+
+# ---------- training export ----------
+def test_select_patches():
+    S = 4
+    labels = np.zeros((S, 4 * S + 2), np.uint8)
+    saved = np.ones_like(labels, dtype=bool)
+    labels[:, 0:S] = 1                             # fully labelled
+    labels[0, S] = 2                               # 1 of 16 pixels labelled
+    labels[:, 2 * S:3 * S] = 1
+    saved[0, 2 * S] = False                        # labelled, but partly outside the saved tiles
+    # patch 3 is empty; the 2-px remainder never forms a patch
+    assert select_patches(labels, saved, S, 0.0).tolist() == [True, True, False, False]
+    assert select_patches(labels, saved, S, 0.1).tolist() == [True, False, False, False]
+
+
+# ---------- uploads ----------
+def _product_zip():
+    bio = BytesIO()
+    with zipfile.ZipFile(bio, "w", zipfile.ZIP_STORED) as z:
+        z.writestr("S2B_TEST.SAFE/GRANULE/L2A/IMG_DATA/R10m/T39_B04_10m.jp2", rng.bytes(3000))
+    return bio.getvalue()
+
+
+def _send(up, offset, data, user=5, **kw):
+    return uploads.write_chunk(up, offset, BytesIO(data), len(data), user_id=user, **kw)
+
+
+def test_upload_resume_and_finalize(out_dir, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_CHUNK_SIZE", 1024)
+    data = _product_zip()
+    up = uploads.init_upload("S2B_TEST.zip", len(data), user_id=5,
+                             sha256=hashlib.sha256(data).hexdigest())["upload_id"]
+    assert _send(up, 0, data[:1024])["offset"] == 1024
+    assert _send(up, 0, data[:1024])["duplicate"]  # retry after a lost response
+    with pytest.raises(uploads.UploadError) as e:
+        _send(up, 2048, data[2048:3072])
+    assert e.value.status == 409
+    with pytest.raises(uploads.UploadError) as e:
+        _send(up, 1024, data[1024:2048], user=6)   # someone else's upload
+    assert e.value.status == 403
+    with pytest.raises(uploads.UploadError):       # corrupt chunk is rolled back
+        _send(up, 1024, data[1024:2048], chunk_sha256="0" * 64)
+    with pytest.raises(uploads.UploadError) as e:
+        uploads.finalize(up, user_id=5)
+    assert e.value.status == 409                   # incomplete
+
+    # resume from what the server has; the running hash is gone as after a worker switch
+    uploads._HASHERS.pop(up, None)
+    off = uploads.status(up, user_id=5)["offset"]
+    assert off == 1024
+    while off < len(data):
+        off = _send(up, off, data[off:off + 1024])["offset"]
+    res = uploads.finalize(up, user_id=5)
+    assert res["sha256"] == hashlib.sha256(data).hexdigest() and res["entries"] == 1
+    assert (settings.SCENES_DIR / "S2B_TEST.zip").read_bytes() == data
+    assert sorted(p.name for p in settings.SCENES_DIR.iterdir()) == ["S2B_TEST.zip"]
+    with pytest.raises(uploads.UploadError):       # name taken now
+        uploads.init_upload("S2B_TEST.zip", len(data), user_id=5)
+
+
+def test_upload_sha_mismatch(out_dir):
+    data = _product_zip()
+    up = uploads.init_upload("S2B_BAD.zip", len(data), user_id=5, sha256="ab" * 32)["upload_id"]
+    _send(up, 0, data)
+    with pytest.raises(uploads.UploadError) as e:
+        uploads.finalize(up, user_id=5)
+    assert e.value.status == 422 and not (settings.SCENES_DIR / "S2B_BAD.zip").exists()
+
+
+# ---------- background jobs ----------
+_CLAIM_SCRIPT = """
+import sys
+from pathlib import Path
+from config import settings
+settings.OUTPUT_DIR = Path(sys.argv[1])
+from services.progress import _claim_job
+print("claimed" if _claim_job(sys.argv[2]) else "busy")
+"""
+
+_SCENE_LOCK_SCRIPT = """
+import sys
+from pathlib import Path
+from config import settings
+settings.OUTPUT_DIR = Path(sys.argv[1])
+from services.s2 import _scene_lock
+print("claimed" if _scene_lock(sys.argv[2]).acquire(blocking=False) else "busy")
+"""
+
+
+_STORE_LOCK_SCRIPT = """
+import fcntl, sys
+with open(sys.argv[1], "a+") as f:
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        print("claimed")
+    except BlockingIOError:
+        print("busy")
+"""
+
+
+def _other_process(script, *args):
+    res = subprocess.run([sys.executable, "-c", script, *map(str, args)],
+                         capture_output=True, text=True, cwd=settings.BASE_DIR)
+    assert res.returncode == 0, res.stderr
+    return res.stdout.strip()
+
+
+def test_start_job_exclusive(out_dir):
+    gate = threading.Event()
+    th = start_job("test:excl", gate.wait, exclusive=True, phase="bands")
+    assert th is not None and get_progress("test:excl")["phase"] == "bands"
+    assert start_job("test:excl", lambda: None, exclusive=True) is None    # still running, whatever the phase
+    assert _other_process(_CLAIM_SCRIPT, out_dir, "test:excl") == "busy"
+    gate.set()
+    th.join(5)
+    th2 = start_job("test:excl", lambda: None, exclusive=True)
+    assert th2 is not None
+    th2.join(5)
+
+
+def test_scene_lock_across_processes(out_dir):
+    lock = _scene_lock("S2TEST")
+    with lock:
+        assert not lock.acquire(blocking=False)
+        assert _other_process(_SCENE_LOCK_SCRIPT, out_dir, "S2TEST") == "busy"
+    assert _other_process(_SCENE_LOCK_SCRIPT, out_dir, "S2TEST") == "claimed"
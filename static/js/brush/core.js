@@ -44,8 +44,9 @@ console.log("[BRUSH:core] loaded");
     // whole image meta
     imgW: 0, imgH: 0,
 
-    // per-tile masks: tileMasks[r][c] = { cnv, ctx, w, h, classBuf }
+    // per-tile masks: tileMasks[r][c] = { cnv, ctx, w, h, classBuf, dirty, version } (allocated on first visit)
     tileMasks: [],
+    dirtyTiles: new Set(),   // "r_c" of tiles with unsaved edits (autosave saves all of them)
 
     DPR: Math.max(1, window.devicePixelRatio || 1),
     MODE: "pan",
@@ -160,6 +161,24 @@ console.log("[BRUSH:core] loaded");
 
     const imgW = App.imgW|0, imgH = App.imgH|0;
 
+    // هندسه‌ی واقعی گرید از manifest سرور (پیکسل رکت + bounds هر تایل)
+    const man = App.gridManifest;
+    if (man && man.rows === rows && man.cols === cols && Array.isArray(man.items)) {
+      const byRC = new Map(man.items.map(it => [`${it.r},${it.c}`, it]));
+      for (let r = 0; r < rows; r++) {
+        for (let c = 0; c < cols; c++) {
+          const it = byRC.get(`${r},${c}`);
+          const b = it?.bounds_wgs84;
+          if (!it || !b) { App.grid.tiles.length = 0; break; }
+          const bounds = L.latLngBounds([b.lat_min, b.lon_min], [b.lat_max, b.lon_max]);
+          App.grid.tiles.push({ r, c, bounds, px: { x0: it.x, y0: it.y, w: it.w, h: it.h } });
+        }
+        if (!App.grid.tiles.length) break;
+      }
+      if (App.grid.tiles.length === rows * cols) { log('buildGrid: manifest', { rows, cols }); return; }
+      App.grid.tiles = [];
+    }
+
     for (let r = 0; r < rows; r++) {
       for (let c = 0; c < cols; c++) {
         // دقت جهت‌ها: ردیف 0 در شمال، با کاهش عرض به جنوب می‌رویم
@@ -212,8 +231,9 @@ console.log("[BRUSH:core] loaded");
     }
 
     App.grid.active = { r, c };
+    ensureTileMask(r, c);
 
-    const url = `/api/grid/tile?scene_id=${encodeURIComponent(App.sceneId)}&r=${r}&c=${c}&t=${Date.now()}`;
+    const url = `/api/grid/tile?scene_id=${encodeURIComponent(App.sceneId)}&r=${r}&c=${c}`;  // revalidated via ETag (no-cache)
 
     // reuse overlay: setUrl + setBounds (کمترین هزینه)
     if (App.grid.overlay) {
@@ -318,7 +338,7 @@ console.log("[BRUSH:core] loaded");
   async function tilesExist(sceneId) {
     const u = `/api/grid/list?scene_id=${encodeURIComponent(sceneId)}&t=${Date.now()}`;
     const r = await fetch(u, { cache: "no-store" });
-    if (r.status === 200) return true;
+    if (r.status === 200) { App.gridManifest = await r.json().catch(() => null); return true; }
     if (r.status === 404) return false;
     throw new Error("grid/list http " + r.status);
   }
@@ -377,25 +397,31 @@ console.log("[BRUSH:core] loaded");
       return;
     }
 
-    // ایجاد بوم برای هر گرید (فراخوانی حداقلی)
+    // فقط جای بوم‌ها؛ بوم هر تایل در اولین بازدید ساخته می‌شود (ensureTileMask)
     App.tileMasks = [];
     for (let rIdx = 0; rIdx < App.grid.rows; rIdx++) {
-      const row = [];
-      for (let cIdx = 0; cIdx < App.grid.cols; cIdx++) {
-        const t = App.grid.tiles[rIdx * App.grid.cols + cIdx];
-        const { w: tw, h: th } = t.px;
-        const cnv = document.createElement("canvas");
-        cnv.width = tw; cnv.height = th;
-        const ctx = cnv.getContext("2d", { willReadFrequently: true });
-        ctx.clearRect(0, 0, tw, th);
-        const classBuf = new Uint8Array(tw * th);
-        row.push({ cnv, ctx, w: tw, h: th, classBuf });
-      }
-      App.tileMasks.push(row);
+      App.tileMasks.push(new Array(App.grid.cols).fill(null));
     }
     log("allocTileMasks:new", { imgW: App.imgW, imgH: App.imgH, rows: App.grid.rows, cols: App.grid.cols });
   }
 
+  function ensureTileMask(r, c) {
+    const row = App.tileMasks?.[r];
+    if (!row) return null;
+    if (row[c]) return row[c];
+    const t = App.grid.tiles[r * App.grid.cols + c];
+    if (!t) return null;
+    const { w: tw, h: th } = t.px;
+    const cnv = document.createElement("canvas");
+    cnv.width = tw; cnv.height = th;
+    const ctx = cnv.getContext("2d", { willReadFrequently: true });
+    ctx.clearRect(0, 0, tw, th);
+    const classBuf = new Uint8Array(tw * th);
+    row[c] = { cnv, ctx, w: tw, h: th, classBuf };
+    return row[c];
+  }
+  App.ensureTileMask = ensureTileMask;
+
   // ---- Canvases ----
   const _sizeCanvasesRaf = makeRafThrottle(() => {
     if (!App.map) return;
@@ -539,6 +565,7 @@ console.log("[BRUSH:core] loaded");
         }
       }
     }
+    if (x1 >= x0 && y1 >= y0) App.markTileDirty(App.grid.active.r, App.grid.active.c, { x0, y0, x1, y1 });
   }
 
   const _dabRaf = makeRafThrottle((cx, cy) => {
@@ -625,27 +652,80 @@ console.log("[BRUSH:core] loaded");
     App.redrawMaskToScreen();
   };
 
+  // class indices (Uint8Array, tm.w*tm.h) → classBuf + رنگ روی بوم تایل
+  App.setTileClasses = function (r, c, classes) {
+    const tm = ensureTileMask(r, c);
+    if (!tm || !classes || classes.length !== tm.w * tm.h) return false;
+    tm.classBuf.set(classes);
+    const lut = new Uint32Array(256);
+    const le = new Uint8Array(new Uint32Array([1]).buffer)[0] === 1;
+    for (const k of Object.keys(App.PALETTE)) {
+      const h = (App.PALETTE[k]?.color || "").replace("#", "");
+      if (h.length !== 8 || (k|0) === 0) continue;
+      const [R, G, B, A] = [0, 2, 4, 6].map(i => parseInt(h.slice(i, i + 2), 16));
+      lut[k & 0xff] = le ? ((A << 24) | (B << 16) | (G << 8) | R) >>> 0 : ((R << 24) | (G << 16) | (B << 8) | A) >>> 0;
+    }
+    const img = tm.ctx.createImageData(tm.w, tm.h);
+    const px = new Uint32Array(img.data.buffer);
+    for (let i = 0; i < classes.length; i++) px[i] = lut[classes[i]];
+    tm.ctx.putImageData(img, 0, 0);
+    tm.loaded = true;
+    tm.dirty = null;
+    tm.version = undefined;   // server copy of this user is unknown → first save sends the full tile
+    App.redrawMaskToScreen();
+    return true;
+  };
+
   App.clearMask = function () {
     const tm = App.tileMasks?.[App.grid.active.r]?.[App.grid.active.c];
     if (tm) {
       tm.ctx.clearRect(0, 0, tm.w, tm.h);
       tm.classBuf.fill(0);
+      App.markTileDirty(App.grid.active.r, App.grid.active.c, { x0: 0, y0: 0, x1: tm.w - 1, y1: tm.h - 1 });
     }
     App.redrawMaskToScreen();
   };
 
+  // class indices compress ~100× with deflate; raw where CompressionStream is missing
+  App.deflateBody = async function (buf) {
+    if (typeof CompressionStream === "undefined") return { body: buf, encoding: null };
+    const cs = new Blob([buf]).stream().pipeThrough(new CompressionStream("deflate"));
+    return { body: await new Response(cs).arrayBuffer(), encoding: "deflate" };
+  };
+
+  // full tile → /api/save_mask_tile; sets tm.version (base for later delta patches)
+  App.uploadTileClasses = async function (r, c) {
+    const tm = App.tileMasks?.[r]?.[c];
+    if (!tm || !App.sceneId) return null;
+    const dirty = tm.dirty;
+    tm.dirty = null;
+    const params = new URLSearchParams({ scene_id: App.sceneId, r, c });
+    const { body, encoding } = await App.deflateBody(tm.classBuf);
+    const headers = { "Content-Type": "application/octet-stream" };
+    if (encoding) headers["Content-Encoding"] = encoding;
+    const resp = await fetch(`/api/save_mask_tile?${params}`, { method: "POST", headers, body });
+    if (!resp.ok) { App.markTileDirty(r, c, dirty); throw new Error("HTTP " + resp.status); }
+    const j = await resp.json();
+    tm.version = j.tile_version;
+    return j;
+  };
+
+  // union of edited pixels since the last save (tile-local, inclusive)
+  App.markTileDirty = function (r, c, d) {
+    const tm = App.tileMasks?.[r]?.[c];
+    if (!tm || !d) return;
+    const o = tm.dirty;
+    App.dirtyTiles.add(`${r}_${c}`);
+    tm.dirty = o ? { x0: Math.min(o.x0, d.x0), y0: Math.min(o.y0, d.y0),
+                     x1: Math.max(o.x1, d.x1), y1: Math.max(o.y1, d.y1) } : { ...d };
+  };
+
   // (اختیاری) ذخیرهٔ باینری کلاس‌ماسک تایل
   App.saveMaskTileBinary = async function () {
     const tm = App.tileMasks?.[App.grid.active.r]?.[App.grid.active.c];
     if (!tm) { alert("Mask not ready"); return; }
     try {
-      const params = new URLSearchParams({
-        scene_id: App.sceneId || '',
-        r: App.grid.active.r,
-        c: App.grid.active.c
-      });
-      const r = await fetch(`/api/save_mask_tile?${params}`, { method: "POST", body: tm.classBuf });
-      if (!r.ok) throw new Error("HTTP " + r.status);
+      await App.uploadTileClasses(App.grid.active.r, App.grid.active.c);
       alert("Mask saved.");
     } catch (e) {
       alert("Save failed: " + e);
@@ -705,15 +785,12 @@ console.log("[BRUSH:core] loaded");
     maskId = "maskCanvas",
     cursorId = "cursorCanvas",
     overlayBoundsURL = "/api/s2_bounds_wgs84",
-    gridRows = 3,
-    gridCols = 3,
+    gridRows = null,   // null → از manifest صحنه
+    gridCols = null,
     sceneId = null,
     autoPickVisibleTile = false, // (فعلاً استفاده نمی‌کنیم)
     autoFollowTiles = false
   } = {}) {
-    App.grid.rows = gridRows|0;
-    App.grid.cols = gridCols|0;
-
     createMap(mapId);
 
     await ensureSceneId(sceneId);
@@ -726,6 +803,8 @@ console.log("[BRUSH:core] loaded");
       ok = await tilesExist(App.sceneId);
       if (!ok) throw new Error("tiles still missing after build");
     }
+    App.grid.rows = (gridRows || App.gridManifest?.rows || 3)|0;
+    App.grid.cols = (gridCols || App.gridManifest?.cols || 3)|0;
 
     await loadSceneOverlay(overlayBoundsURL);
     await allocTileMasks(); // ← بوم‌های فول‌رز تایل
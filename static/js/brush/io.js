@@ -257,47 +257,150 @@ console.log('[BRUSH:io] loaded');
     }
   }
 
+  // آخرین ماسک ذخیره‌شده‌ی همین کاربر برای تایل (r,c): /api/masks/get با ETag (304 از کش مرورگر)
+  async function fetchLatestTileMask(r, c) {
+    if (!App.sceneId) return false;
+    const q = new URLSearchParams({ scene_id: App.sceneId, r, c });
+    const resp = await fetch(`/api/masks/get?${q}`, { cache: 'no-cache' });
+    if (resp.status === 404) return false;
+    if (!resp.ok) { warn('masks/get:http', resp.status); return false; }
+    if (resp.headers.get('X-Mask-Kind') === 'png') {
+      const active = App.grid?.active;
+      if (!active || active.r !== r || active.c !== c) return false;
+      await App.drawMaskImageToLocal?.(await resp.blob());
+      return true;
+    }
+    const buf = new Uint8Array(await resp.arrayBuffer());
+    if (!App.setTileClasses(r, c, buf)) { warn('masks/get:size', { r, c, bytes: buf.length }); return false; }
+    App.tileMasks[r][c].version = +resp.headers.get('X-Tile-Version');   // autosave can patch right away
+    return true;
+  }
+
   async function loadMaskForSelected() {
     try {
-      const layer = current();
-      if (!layer) { warn('loadMaskForSelected:no-current'); return; }
-
-      const tile = currentTileId();
-      const uid  = App.layerUid(layer);
-      const url  = `/api/masks/get?tile_id=${encodeURIComponent(tile)}&uid=${encodeURIComponent(uid)}&t=${Date.now()}`;
-      log('loadMaskForSelected:GET', { url, tile, uid });
-
-      const r = await fetch(url, { cache: 'no-store' });
-      if (r.status === 404) { log('loadMaskForSelected:none', { tile, uid }); return; }
-      if (!r.ok) { warn('loadMaskForSelected:http', r.status); return; }
-
-      const blob = await r.blob();
-      if (typeof App.drawMaskImageToLocal === 'function') {
-        await App.drawMaskImageToLocal(blob); // روی تایل فعال کشیده می‌شود
-        log('loadMaskForSelected:done', { tile, uid });
-      } else {
-        warn('loadMaskForSelected:no-drawMaskImageToLocal');
-      }
+      const { r, c } = App.grid?.active || {};
+      if (r == null || r < 0) { warn('loadMaskForSelected:no-active-tile'); return; }
+      const ok = await fetchLatestTileMask(r, c);
+      log('loadMaskForSelected', { r, c, ok });
     } catch (e) {
       warn('loadMaskForSelected:exception', e);
     }
   }
 
-  // ---------------- Autosave (tile-first, then polygon fallback) ----------------
+  // لیبل‌های تایل فعال: اول آخرین ذخیره‌ی کاربر، وگرنه پنجره‌ی /api/mask_raw (ماسک کل صحنه)
+  async function loadActiveTileLabels({ force = false } = {}) {
+    const { r, c } = App.grid?.active || {};
+    const t = App.grid?.tiles?.[r * App.grid.cols + c];
+    const tm = App.tileMasks?.[r]?.[c];
+    if (!t || !tm || (tm.loaded && !force)) return false;
+    try {
+      if (await fetchLatestTileMask(r, c)) { log('loadActiveTileLabels:latest', { r, c }); return true; }
+    } catch (e) {
+      warn('loadActiveTileLabels:latest', e);
+    }
+    const { x0, y0, w, h } = t.px;
+    const url = `/api/mask_raw?x=${x0}&y=${y0}&w=${w}&h=${h}`;
+    try {
+      const resp = await fetch(url, { cache: 'no-store' });
+      if (!resp.ok) { warn('loadActiveTileLabels:http', resp.status); return false; }
+      const rw = +resp.headers.get('X-Mask-Width'), rh = +resp.headers.get('X-Mask-Height');
+      const buf = new Uint8Array(await resp.arrayBuffer());
+      if (rw !== tm.w || rh !== tm.h) { warn('loadActiveTileLabels:size', { rw, rh, w: tm.w, h: tm.h }); return false; }
+      const ok = App.setTileClasses(r, c, buf);
+      log('loadActiveTileLabels', { r, c, bytes: buf.length, ok });
+      return ok;
+    } catch (e) {
+      warn('loadActiveTileLabels:exception', e);
+      return false;
+    }
+  }
+  document.addEventListener('brush:tilechange', () => { loadActiveTileLabels(); });
+
+  // ---------------- Delta save (dirty rectangle since the last save) ----------------
+  // body: [x,y,w,h uint16 LE][w*h class bytes] against base = tm.version
+  async function saveTileDelta(r, c) {
+    const tm = App.tileMasks?.[r]?.[c];
+    if (!tm || !App.sceneId) return false;
+    if (!tm.dirty) return true;
+    if (tm.version === undefined) {            // first save of this tile in the session: full tile
+      const j = await App.uploadTileClasses(r, c);
+      log('save_tile:full', j);
+      return !!j;
+    }
+    const d = tm.dirty;
+    tm.dirty = null;
+    const w = d.x1 - d.x0 + 1, h = d.y1 - d.y0 + 1;
+    const buf = new Uint8Array(8 + w * h);
+    new Uint16Array(buf.buffer, 0, 4).set([d.x0, d.y0, w, h]);
+    for (let y = 0; y < h; y++) {
+      const off = (d.y0 + y) * tm.w + d.x0;
+      buf.set(tm.classBuf.subarray(off, off + w), 8 + y * w);
+    }
+    const { body, encoding } = await App.deflateBody(buf);
+    const headers = { 'Content-Type': 'application/octet-stream' };
+    if (encoding) headers['Content-Encoding'] = encoding;
+    const q = new URLSearchParams({ scene_id: App.sceneId, r, c, base: tm.version, format: 'rects' });
+    const resp = await fetch(`/api/save_mask_tile_patch?${q}`, { method: 'POST', headers, body });
+    if (resp.status === 409) {                 // someone else (another tab) saved: resend everything
+      App.markTileDirty(r, c, d);
+      const j = await App.uploadTileClasses(r, c);
+      log('save_tile:conflict→full', j);
+      return !!j;
+    }
+    if (!resp.ok) { App.markTileDirty(r, c, d); warn('save_tile_patch:http', resp.status); return false; }
+    const j = await resp.json();
+    tm.version = j.tile_version;
+    log('save_tile_patch:ok', { r, c, w, h, bytes: body.byteLength ?? body.length, v: j.tile_version });
+    return true;
+  }
+
+  function saveActiveTileDelta() {
+    const { r, c } = App.grid?.active || {};
+    return saveTileDelta(r, c);
+  }
+
+  // every tile edited since its last save, not only the active one (the user may have moved on)
+  async function saveDirtyTiles() {
+    const failed = [];
+    for (const key of [...App.dirtyTiles]) {
+      App.dirtyTiles.delete(key);              // a failed save marks the tile dirty again
+      const [r, c] = key.split('_').map(Number);
+      const ok = await saveTileDelta(r, c).catch((e) => { warn('autosave:delta', key, e); return false; });
+      if (!ok) failed.push(key);
+    }
+    return failed;
+  }
+
+  // ---------------- Autosave (tile delta, then PNG, then polygon fallback) ----------------
   let _saveTimer = null;
-  function autosaveDebounced() {
+  let _saving = Promise.resolve();
+  function autosaveNow() {
     clearTimeout(_saveTimer);
-    _saveTimer = setTimeout(async () => {
-      // ابتدا تایل‌محور
-      const ok = await saveCurrentTilePng({ alsoDownload: false }).catch(() => false);
-      if (!ok) {
-        // اگر در مود پالیگون هستی و سرور قدیمی داری
-        try { await saveMaskForSelected(); } catch {}
+    // one save at a time so every patch is based on the version the previous one returned
+    _saving = _saving.then(async () => {
+      const failed = await saveDirtyTiles();
+      const { r, c } = App.grid?.active || {};
+      if (failed.includes(`${r}_${c}`)) {
+        let ok = await saveCurrentTilePng({ alsoDownload: false }).catch(() => false);
+        if (!ok) {
+          // اگر در مود پالیگون هستی و سرور قدیمی داری
+          try { await saveMaskForSelected(); } catch {}
+        }
       }
-      log('autosave:ok');
-    }, 450);
+      log('autosave:ok', { failed });
+    });
+    return _saving;
+  }
+  function autosaveDebounced() {
+    clearTimeout(_saveTimer);
+    _saveTimer = setTimeout(autosaveNow, 450);
   }
   App.onAfterStroke = autosaveDebounced;
+  // leaving a tile or the page: save pending edits now instead of waiting for the debounce
+  document.addEventListener('brush:tilechange', () => { if (App.dirtyTiles.size) autosaveNow(); });
+  document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden' && App.dirtyTiles.size) autosaveNow();
+  });
 
   // ---------------- Public API ----------------
   const api = {
@@ -316,7 +419,10 @@ console.log('[BRUSH:io] loaded');
 
     // masks
     saveMaskForSelected,      // backward-compatible (polygon)
-    loadMaskForSelected,
+    loadMaskForSelected,      // /api/masks/get for the active tile
+    loadActiveTileLabels,     // latest user save, else /api/mask_raw window of the active tile
+    saveActiveTileDelta,      // dirty rect -> /api/save_mask_tile_patch
+    saveDirtyTiles,           // the same for every tile edited since its last save
     saveCurrentTilePng,       // tile PNG -> server
     downloadActiveTilePNG     // tile PNG -> local download
   };
@@ -78,38 +78,72 @@
       hide(this.el);
     },
 
+    _es: null,
+
+    _apply(j){
+      const p = Number(j.percent || 0);
+      this.setPct(p);
+      this.setTitle(`${j.phase || 'Processing'} (${Math.round(p)}%)${j.note ? ' — ' + j.note : ''}`);
+      const ph = j.phase || '';
+      if (ph === 'done' || ph === 'error' || p >= 100) {
+        this.stopPoll();
+        setTimeout(()=> this.close(), 250);
+        return true;
+      }
+      return false;
+    },
+
+    // Server-Sent Events (/api/progress/stream); falls back to polling when unavailable
     startPoll(){
       this.stopPoll();
+      const t0 = Date.now() / 1000 - 1;   // ignore terminal states left over from an earlier job
+
+      if (window.EventSource) {
+        const es = new EventSource('/api/progress/stream');
+        this._es = es;
+        es.addEventListener('progress', (ev) => {
+          let j = {}; try { j = JSON.parse(ev.data || '{}'); } catch {}
+          const stale = (j.phase === 'done' || j.phase === 'error') && Number(j.ts || 0) < t0;
+          if (!stale) this._apply(j);
+        });
+        es.onerror = () => {
+          // stream closed by server after a terminal phase, or SSE blocked → poll instead
+          if (this._es !== es) return;
+          try { es.close(); } catch {}
+          this._es = null;
+          if (this.el && !this.el.hidden) this._startFetchPoll(t0);
+        };
+        return;
+      }
+      this._startFetchPoll(t0);
+    },
+
+    _startFetchPoll(t0){
       const ctrl = new AbortController();
       this._pollCtrl = ctrl;
 
       const tick = async () => {
         if (ctrl.signal.aborted) return;
         try {
-          const r = await fetch('/api/progress?ts='+Date.now(), { cache:'no-store', signal: ctrl.signal });
+          const r = await fetch('/api/progress', { cache:'no-store', signal: ctrl.signal });
           const j = await r.json().catch(()=>({}));
-          const p = Number(j.percent || 0);
-          this.setPct(p);
-          this.setTitle(`${j.phase || 'Processing'} (${Math.round(p)}%)${j.note ? ' — ' + j.note : ''}`);
-          if ((j.phase||'') === 'done' || p >= 100) {
-            this.stopPoll();
-            setTimeout(()=> this.close(), 250);
-            return;
-          }
+          const stale = (j.phase === 'done' || j.phase === 'error') && Number(j.ts || 0) < t0;
+          if (!stale && this._apply(j)) return;
         } catch { /* ignore */ }
-        if (!ctrl.signal.aborted) setTimeout(tick, 400);
+        if (!ctrl.signal.aborted) setTimeout(tick, 1000);
       };
       tick();
 
       // pause/resume on tab hide
       const vis = () => {
         if (document.hidden) ctrl.abort();
-        else if (!this._pollCtrl) this.startPoll();
+        else if (!this._pollCtrl) this._startFetchPoll(t0);
       };
       document.addEventListener('visibilitychange', vis, { once: true });
     },
 
     stopPoll(){
+      if (this._es) { try { this._es.close(); } catch {} this._es = null; }
       if (this._pollCtrl) { try { this._pollCtrl.abort(); } catch {} this._pollCtrl = null; }
     },
 
@@ -123,40 +157,76 @@
   };
   window.closeProgress = () => MOD.close();
 
-  // -------------------- Sentinel ZIP uploader (optional controls present) --------------------
+  // -------------------- Sentinel ZIP uploader (chunked + resumable) --------------------
+  // init → PUT /api/uploads/<id>?offset=N (raw chunk) → finalize
+  // upload id is remembered per file in localStorage, so a dropped connection resumes.
+  const sleep = (ms) => new Promise(res => setTimeout(res, ms));
+  const uploadKey = (f) => `s2upload:${f.name}:${f.size}:${f.lastModified}`;
+
+  async function jsonOrThrow(r){
+    const j = await r.json().catch(()=>({}));
+    if (!r.ok || j.ok === false) { const e = new Error(j.error || `HTTP ${r.status}`); e.status = r.status; throw e; }
+    return j;
+  }
+
+  async function resumeOrInit(file){
+    const saved = localStorage.getItem(uploadKey(file));
+    if (saved) {
+      try { return await jsonOrThrow(await fetch(`/api/uploads/${saved}`, { cache:'no-store' })); }
+      catch { localStorage.removeItem(uploadKey(file)); }
+    }
+    const st = await jsonOrThrow(await fetch('/api/uploads/init', {
+      method:'POST', headers:{'Content-Type':'application/json'},
+      body: JSON.stringify({ filename: file.name, size: file.size })
+    }));
+    localStorage.setItem(uploadKey(file), st.upload_id);
+    return st;
+  }
+
+  async function putChunk(id, offset, blob){
+    const headers = { 'Content-Type': 'application/octet-stream' };
+    if (window.crypto?.subtle) {
+      const d = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+      headers['X-Chunk-SHA256'] = Array.from(new Uint8Array(d)).map(b => b.toString(16).padStart(2,'0')).join('');
+    }
+    return jsonOrThrow(await fetch(`/api/uploads/${id}?offset=${offset}`, { method:'PUT', headers, body: blob }));
+  }
+
   async function uploadZipWithProgress(fileInput) {
     const file = fileInput?.files?.[0];
     if (!file) { alert('ZIP را انتخاب کنید'); return; }
 
     MOD.open('Uploading… (0%)');
-    const xhr = new XMLHttpRequest();
-    xhr.open('POST', '/api/upload_safe_zip', true);
-
-    xhr.upload.onprogress = e => {
-      if (!e.lengthComputable) { MOD.setPct(10); MOD.setTitle('Uploading…'); return; }
-      const pct = Math.round((e.loaded/e.total)*100);
-      MOD.setTitle(`Uploading… (${pct}%)`);
-      MOD.setPct(pct);
-    };
-    xhr.upload.onload = () => MOD.indeterminate('Extracting & Building Quicklook…');
-    xhr.onerror = () => { MOD.close(); alert('Network error'); };
-
-    xhr.onload = async () => {
-      MOD.close();
-      let j = {}; try { j = JSON.parse(xhr.responseText||'{}'); } catch {}
-      if (xhr.status >= 200 && xhr.status < 300 && j.ok) {
-        SceneStore.invalidate();
-        window.dispatchEvent(new CustomEvent('s2:scene-updated', { detail: j }));
-        alert('Scene uploaded and processed ✅');
-      } else {
-        alert('Upload/Process failed: ' + (j.error || xhr.statusText || `HTTP ${xhr.status}`));
+    try {
+      const st = await resumeOrInit(file);
+      const id = st.upload_id, step = st.chunk_size || (8 << 20);
+      let offset = st.offset || 0, tries = 0;
+
+      while (offset < file.size) {
+        const pct = Math.round((offset / file.size) * 100);
+        MOD.setTitle(`Uploading… (${pct}%)`); MOD.setPct(pct);
+        try {
+          const j = await putChunk(id, offset, file.slice(offset, Math.min(file.size, offset + step)));
+          offset = j.offset; tries = 0;
+        } catch (e) {
+          if (++tries > 8) throw e;
+          await sleep(Math.min(30000, 500 * 2 ** tries));
+          // server's offset is the source of truth after a failure
+          try { offset = (await jsonOrThrow(await fetch(`/api/uploads/${id}`, { cache:'no-store' }))).offset; } catch {}
+        }
       }
-    };
 
-    // درست کردن FormData
-    const fd = new FormData();
-    fd.append('file', file);
-    xhr.send(fd);
+      MOD.indeterminate('Validating ZIP…');
+      const j = await jsonOrThrow(await fetch(`/api/uploads/${id}/finalize`, { method:'POST' }));
+      localStorage.removeItem(uploadKey(file));
+      MOD.close();
+      SceneStore.invalidate();
+      window.dispatchEvent(new CustomEvent('s2:scene-updated', { detail: j }));
+      alert('Scene uploaded ✅');
+    } catch (e) {
+      MOD.close();
+      alert('Upload failed: ' + (e.message || e));
+    }
   }
 
   function wireUploader(inputId, btnId){
@@ -261,7 +331,7 @@
         try{
           const b = await fetch('/api/s2_bounds_wgs84', { cache:'no-store' }).then(r=>r.json());
           const A = window.BrushApp;
-          const url = '/api/output/rgb_quicklook.png?t=' + Date.now();
+          const url = (j?.meta?.quicklook_url || '/api/output/rgb_quicklook.png') + '?t=' + Date.now();
           if (A?.map){
             if (A.grid?.overlay){
               A.grid.overlay.setUrl(url);